@@ -0,0 +1,240 @@
+import asyncio
+import io
+import re
+import ssl
+import time
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence
+
+from loader import format_copy_row
+from main import (DEFAULT_OPTIONS, ProvinceResult, SyncOptions, build_plan,
+                  create_config, needs_names, selected_mappings)
+from mappings import (MARCADOS_LEVANTAMENTO, VISIT_MAPPINGS,
+                      VISIT_UNIQUE_COLUMNS, UniqueRows, ViewMapping,
+                      compile_batch_transformer)
+from watermark import (CREATE_WATERMARK_SQL, SELECT_WATERMARK_SQL,
+                       UPSERT_WATERMARK_SQL, WATERMARK_COLUMNS,
+                       watermark_column)
+
+
+# Views extracted at the same time across every province
+DEFAULT_CONCURRENCY = 8
+
+
+def _drivers():
+    """Import the async drivers, which are only needed by this engine."""
+    try:
+        import aiomysql
+        import asyncpg
+    except ImportError as e:
+        raise RuntimeError(
+            "The async engine needs the aiomysql and asyncpg packages "
+            "(pip install aiomysql asyncpg)") from e
+    return aiomysql, asyncpg
+
+
+def _numbered(query: str) -> str:
+    """Rewrite %s placeholders into asyncpg's $1, $2, ... style."""
+    counter = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda _: f'${next(counter)}', query)
+
+
+def _quote(name: str) -> str:
+    """Quote a PostgreSQL identifier."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def aiomysql_config(mysql_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Translate a mysql.connector configuration into aiomysql arguments."""
+    context = None
+    if not mysql_config.get('ssl_disabled'):
+        context = ssl.create_default_context(cafile=mysql_config.get('ssl_ca'))
+        if mysql_config.get('ssl_cert'):
+            context.load_cert_chain(mysql_config['ssl_cert'],
+                                    mysql_config.get('ssl_key'))
+        if not mysql_config.get('ssl_verify_cert'):
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    return {
+        'user': mysql_config.get('user'),
+        'password': mysql_config.get('password'),
+        'host': mysql_config.get('host'),
+        'port': mysql_config.get('port'),
+        'db': mysql_config.get('database'),
+        'ssl': context,
+    }
+
+
+class _ProvinceWriter:
+    """Serializes one province's writes on its PostgreSQL connection."""
+
+    def __init__(self, pg):
+        self.pg = pg
+        self.lock = asyncio.Lock()
+
+    async def execute(self, query: str, *args) -> str:
+        async with self.lock:
+            return await self.pg.execute(query, *args)
+
+    async def fetchval(self, query: str, *args) -> Any:
+        async with self.lock:
+            return await self.pg.fetchval(query, *args)
+
+    async def copy(self, table: str, columns: Sequence[str],
+                   rows: Sequence[tuple]):
+        data = ''.join(map(format_copy_row, rows)).encode()
+        async with self.lock:
+            await self.pg.copy_to_table(table, source=io.BytesIO(data),
+                                        columns=list(columns))
+
+
+def _merge_sql(mapping: ViewMapping, staging: str) -> str:
+    """Build the INSERT ... ON CONFLICT merging a staging table."""
+    columns = ', '.join(map(_quote, mapping.target_columns))
+    keys = ', '.join(map(_quote, mapping.conflict_columns))
+    table = _quote(mapping.table)
+    if mapping.update_columns:
+        action = "DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})".format(
+            ', '.join(f'{_quote(name)} = EXCLUDED.{_quote(name)}'
+                      for name in (*mapping.update_columns,
+                                   *mapping.reset_columns)),
+            ', '.join(f'{table}.{_quote(name)}'
+                      for name in mapping.update_columns),
+            ', '.join(f'EXCLUDED.{_quote(name)}'
+                      for name in mapping.update_columns))
+    else:
+        action = "DO NOTHING"
+    return (f"INSERT INTO {table} ({columns}) "
+            f"SELECT DISTINCT ON ({keys}) {columns} FROM {_quote(staging)} "
+            f"ON CONFLICT ({keys}) {action}")
+
+
+async def _describe(cursor, view: str) -> List[str]:
+    await cursor.execute(f"SELECT * FROM {view} LIMIT 0")
+    await cursor.fetchall()
+    return [column[0] for column in cursor.description]
+
+
+async def sync_view(mapping: ViewMapping, province: str,
+                    mysql_config: Dict[str, Any], writer: _ProvinceWriter,
+                    limit: asyncio.Semaphore,
+                    options: SyncOptions = DEFAULT_OPTIONS,
+                    unique: Optional[UniqueRows] = None) -> int:
+    """Extract one view on its own MySQL connection and load it.
+
+    Rows whose key `unique` already saw, from this view or another one
+    sharing it, are dropped before they are copied.
+    """
+    aiomysql, _ = _drivers()
+    async with limit:
+        cnx = await aiomysql.connect(**aiomysql_config(mysql_config))
+        try:
+            async with cnx.cursor(aiomysql.SSCursor) as cursor:
+                names = (await _describe(cursor, mapping.view)
+                         if needs_names(mapping, options) else None)
+                since = None
+                if options.incremental and mapping.view in WATERMARK_COLUMNS:
+                    since = await writer.fetchval(
+                        _numbered(SELECT_WATERMARK_SQL), province,
+                        mapping.view, watermark_column(mapping.view, names))
+                plan = build_plan(mapping, options, since, names)
+                await cursor.execute(plan.query, plan.params or None)
+
+                target = plan.mapping.table
+                staging = None
+                if options.load_mode == 'upsert':
+                    staging = f'stage_{mapping.view}'
+                    await writer.execute(
+                        f"DROP TABLE IF EXISTS {_quote(staging)}")
+                    await writer.execute(
+                        f"CREATE TEMP TABLE {_quote(staging)} ON COMMIT DROP "
+                        f"AS SELECT "
+                        f"{', '.join(map(_quote, mapping.target_columns))} "
+                        f"FROM {_quote(target)} WITH NO DATA")
+                    target = staging
+
+                transform = compile_batch_transformer(
+                    plan.mapping, province=province, created_at=date.today())
+                loaded = 0
+                while True:
+                    batch = await cursor.fetchmany(options.fetch_size)
+                    if not batch:
+                        break
+                    if plan.watermark:
+                        plan.watermark.update(batch)
+                    rows = transform(batch)
+                    if unique:
+                        rows = unique.filter(rows)
+                    await writer.copy(target, mapping.target_columns, rows)
+                    loaded += len(rows)
+        finally:
+            cnx.close()
+
+    if staging:
+        status = await writer.execute(_merge_sql(mapping, staging))
+        await writer.execute(f"DROP TABLE {_quote(staging)}")
+        loaded = int(status.split()[-1])
+    if plan.watermark and plan.watermark.value is not None:
+        await writer.execute(
+            _numbered(UPSERT_WATERMARK_SQL), province, mapping.view,
+            plan.watermark.column, plan.watermark.value)
+    return loaded
+
+
+async def sync_province(province: str, pg_pool, limit: asyncio.Semaphore,
+                        options: SyncOptions = DEFAULT_OPTIONS
+                        ) -> ProvinceResult:
+    """Sync every view of one province in a single PostgreSQL transaction."""
+    started = time.monotonic()
+    mysql_config, _ = create_config(province)
+    try:
+        async with pg_pool.acquire() as pg, pg.transaction():
+            writer = _ProvinceWriter(pg)
+            if options.incremental:
+                await writer.execute(CREATE_WATERMARK_SQL)
+            # The visit views feed core_visit as in the sync engine: a
+            # visit is only loaded once, whichever view yields it first
+            visits = UniqueRows(MARCADOS_LEVANTAMENTO.target_columns,
+                                VISIT_UNIQUE_COLUMNS)
+            results = await asyncio.gather(
+                *(sync_view(mapping, province, mysql_config, writer, limit,
+                            options,
+                            visits if mapping in VISIT_MAPPINGS else None)
+                  for mapping in selected_mappings(options)),
+                return_exceptions=True)
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+    except Exception as e:
+        print(f"An error occurred in {province}: {e}")
+        return ProvinceResult(province, False, time.monotonic() - started,
+                              str(e))
+    return ProvinceResult(province, True, time.monotonic() - started)
+
+
+async def _run(provinces: Sequence[str], options: SyncOptions,
+               concurrency: int) -> List[ProvinceResult]:
+    _, asyncpg = _drivers()
+    _, pg_config = create_config(provinces[0])
+    limit = asyncio.Semaphore(concurrency)
+    pool = await asyncpg.create_pool(min_size=1,
+                                     max_size=max(1, len(provinces)),
+                                     **pg_config)
+    try:
+        return list(await asyncio.gather(
+            *(sync_province(province, pool, limit, options)
+              for province in provinces)))
+    finally:
+        await pool.close()
+
+
+def run_provinces(provinces: Sequence[str],
+                  options: SyncOptions = DEFAULT_OPTIONS,
+                  concurrency: int = DEFAULT_CONCURRENCY
+                  ) -> List[ProvinceResult]:
+    """Sync every province and view on one event loop.
+
+    At most `concurrency` views are extracted at a time across all
+    provinces; each province still commits atomically.
+    """
+    return asyncio.run(_run(provinces, options, concurrency))
@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+from typing import Dict, Sequence
+
+
+# Bounds of an adaptive batch, in rows
+MIN_BATCH_ROWS = int(os.getenv('SYNC_MIN_BATCH_ROWS', 500))
+MAX_BATCH_ROWS = int(os.getenv('SYNC_MAX_BATCH_ROWS', 100000))
+
+# Memory a single batch may take, whatever its row count
+BATCH_MEMORY_BYTES = int(os.getenv('SYNC_BATCH_MEMORY_MB', 64)) * 2**20
+
+
+def estimate_row_bytes(row: Sequence) -> int:
+    """Roughly estimate the memory held by one row tuple."""
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+
+class AdaptiveBatchSize:
+    """Batch size tuned at runtime from the measured cost of each batch.
+
+    Starting from the initial size, the size doubles as long as a batch
+    gets noticeably cheaper per byte, which is the case while a fixed
+    round-trip latency dominates. When doubling stops paying off it
+    steps back once and holds; if batches later become much slower it
+    starts probing again. The size never exceeds what fits in the
+    memory budget.
+    """
+
+    def __init__(self, initial: int, minimum: int = MIN_BATCH_ROWS,
+                 maximum: int = MAX_BATCH_ROWS,
+                 memory: int = BATCH_MEMORY_BYTES,
+                 growth: float = 2.0, tolerance: float = 0.05):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.memory = memory
+        self.growth = growth
+        self.tolerance = tolerance
+        self.size = initial
+        self.best_cost = None
+        self.settled = False
+
+    def _clamp(self, size: float, row_bytes: int) -> int:
+        fits = self.memory // max(row_bytes, 1)
+        return int(max(self.minimum, min(size, self.maximum, fits)))
+
+    def observe(self, rows: int, seconds: float, row_bytes: int):
+        """Record how long a batch of rows, of about row_bytes each, took."""
+        if not rows or rows < self.size:
+            # A short final batch says nothing about the round-trip cost
+            return
+        cost = seconds / (rows * max(row_bytes, 1))
+        size = self.size
+        improved = (self.best_cost is None
+                    or cost < self.best_cost * (1 - self.tolerance))
+        if improved:
+            self.best_cost = cost
+            if not self.settled:
+                size *= self.growth
+        elif not self.settled:
+            # Growing no longer pays off: step back and hold
+            size /= self.growth
+            self.settled = True
+        elif cost > self.best_cost * 1.5:
+            # The link or the server changed; probe again from here
+            self.best_cost, self.settled = None, False
+        self.size = self._clamp(size, row_bytes)
+
+
+class ProvinceBatchSizes:
+    """The write batch size tuned for one province.
+
+    Only COPY chunks are tuned: each one is a round trip to PostgreSQL.
+    MySQL results are streamed unbuffered, so a fetchmany() only reads
+    rows already arriving on the socket and its timing says nothing
+    about the link; the fetch size stays fixed.
+    """
+
+    def __init__(self, province: str, chunk_size: int):
+        self.province = province
+        self.write = AdaptiveBatchSize(chunk_size)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {'chunk_size': self.write.size}
+
+    def describe(self) -> str:
+        return f"write {self.write.initial} -> {self.write.size} rows"
+
+
+# Sizes tuned so far, kept for the life of the process so later runs of
+# a province start from what worked before
+_sizes: Dict[str, ProvinceBatchSizes] = {}
+_lock = threading.Lock()
+
+
+def batch_sizes(province: str, chunk_size: int) -> ProvinceBatchSizes:
+    """Return the tuned batch sizes of a province, creating them once."""
+    with _lock:
+        if province not in _sizes:
+            _sizes[province] = ProvinceBatchSizes(province, chunk_size)
+        return _sizes[province]
@@ -0,0 +1,83 @@
+"""Compare the legacy strptime(str()) date handling with native pass-through.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_datetime --rows 100000
+"""
+import argparse
+import time
+from datetime import date, datetime, timedelta
+from itertools import chain
+from typing import Callable, List, Tuple
+
+from extract import DEFAULT_FETCH_SIZE
+from loader import chunked
+from mappings import (MARCADOS_SEGUIMENTO, Convert, transform_batches,
+                      with_columns)
+
+
+def legacy_parse(value) -> datetime:
+    """The conversion main.py used before native pass-through."""
+    return datetime.strptime(str(value), '%Y-%m-%d %H:%M:%S')
+
+
+LEGACY_SEGUIMENTO = with_columns(
+    MARCADOS_SEGUIMENTO,
+    appointment_date=Convert(2, legacy_parse),
+    next_appointment_date=Convert(3, legacy_parse))
+
+
+def visit_rows(count: int) -> List[Tuple]:
+    """Build marcados_seguimento-shaped rows with driver-native datetimes."""
+    start = datetime(2024, 1, 1, 8, 0)
+    return [(i, f'HF {i % 50}', start + timedelta(days=i % 30),
+             start + timedelta(days=i % 30 + 30), f'District {i % 7}',
+             None, None, f'Community {i % 90}', None,
+             f'Patient {i}', f'0101/{i:08d}', 'F', 30 + i % 40,
+             '84' + f'{i:07d}', None, 0, 0, 0, None, None, None)
+            for i in range(count)]
+
+
+def cpu_time(run: Callable[[], None], repeat: int) -> float:
+    """Return the best CPU time of several runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.process_time()
+        run()
+        best = min(best, time.process_time() - started)
+    return best
+
+
+def bench(mapping, rows: List[Tuple], batch_size: int, repeat: int) -> float:
+    """Time transforming every row of a visit extract with a mapping."""
+    def run():
+        batches = chunked(rows, batch_size)
+        for _ in chain.from_iterable(transform_batches(
+                mapping, batches, province='Sofala',
+                created_at=date.today())):
+            pass
+    return cpu_time(run, repeat)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_FETCH_SIZE)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rows = visit_rows(args.rows)
+    legacy = bench(LEGACY_SEGUIMENTO, rows, args.batch_size, args.repeat)
+    native = bench(MARCADOS_SEGUIMENTO, rows, args.batch_size, args.repeat)
+
+    per_row = 1e6 / args.rows
+    print(f"{args.rows} visit rows, batches of {args.batch_size}")
+    print(f"  strptime(str())   {legacy:7.3f}s  {legacy * per_row:6.2f} us/row")
+    print(f"  native datetimes  {native:7.3f}s  {native * per_row:6.2f} us/row")
+    print(f"  saved             {legacy - native:7.3f}s  "
+          f"{(legacy - native) * per_row:6.2f} us/row "
+          f"({legacy / native:.1f}x faster)")
+
+
+if __name__ == '__main__':
+    main()
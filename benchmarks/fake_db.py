@@ -0,0 +1,198 @@
+"""Synthetic in-process DB-API cursors for offline benchmarks.
+
+The MySQL side generates rows shaped like the provincial views on the
+fly; the PostgreSQL side accepts COPY and plain statements and only
+counts what it receives.
+"""
+import re
+import time
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+Column = Tuple[str, Callable[[int], Any]]
+
+_START = datetime(2024, 1, 1, 8, 0)
+
+
+def _text(prefix: str, modulo: int = 0) -> Callable[[int], str]:
+    if modulo:
+        return lambda i: f'{prefix} {i % modulo}'
+    return lambda i: f'{prefix} {i}'
+
+
+def _phone(i: int) -> Optional[str]:
+    return None if i % 5 == 0 else f'84{i:07d}'
+
+
+def _none(i: int) -> None:
+    return None
+
+
+_ELEGIVEIS_CV = [
+    ('health_facility', _text('HF', 50)),
+    ('district', _text('District', 7)),
+    ('patient_id', lambda i: i),
+    ('patient_identifier', lambda i: f'0101/{i:08d}'),
+    ('art_start_date', lambda i: _START - timedelta(days=i % 900)),
+    ('patient_name', _text('Patient')),
+    ('gender', lambda i: 'MF'[i % 2]),
+    ('age', lambda i: 15 + i % 60),
+    ('phone_number', _phone),
+    ('alternative_phone_number', lambda i: f'86{i:07d}'),
+    ('last_vl_date', lambda i: _START - timedelta(days=i % 365)),
+    ('last_vl_result', lambda i: i % 5000),
+    ('community', _text('Community', 90)),
+]
+
+_CV_ACIMA_DE_1000 = [
+    ('health_facility', _text('HF', 50)),
+    ('district', _text('District', 7)),
+    ('patient_id', lambda i: i),
+    ('patient_identifier', lambda i: f'0101/{i:08d}'),
+    ('patient_name', _text('Patient')),
+    ('gender', lambda i: 'MF'[i % 2]),
+    ('age', lambda i: 15 + i % 60),
+] + [(f'clinical_{n}', _none) for n in range(7, 19)] + [
+    ('phone_number', _phone),
+    ('alternative_phone_number', lambda i: f'86{i:07d}'),
+]
+
+
+def _visit_columns(next_date_column: str) -> List[Column]:
+    return [
+        ('patient_id', lambda i: i),
+        ('health_facility', _text('HF', 50)),
+        ('appointment_date', lambda i: _START + timedelta(days=i % 30)),
+        (next_date_column, lambda i: _START + timedelta(days=i % 30 + 30)),
+        ('district', _text('District', 7)),
+        ('locality', _text('Locality', 40)),
+        ('neighbourhood', _none),
+        ('community', _text('Community', 90)),
+        ('reference_point', _none),
+        ('patient_name', _text('Patient')),
+        ('patient_identifier', lambda i: f'0101/{i:08d}'),
+        ('gender', lambda i: 'MF'[i % 2]),
+        ('age', lambda i: 15 + i % 60),
+        ('phone_number', _phone),
+        ('alternative_phone_number', lambda i: f'86{i:07d}'),
+        ('pregnant', lambda i: int(i % 11 == 0)),
+        ('breastfeeding', lambda i: int(i % 13 == 0)),
+        ('tb', lambda i: int(i % 17 == 0)),
+    ]
+
+
+# Column names and value generators for each source view, in view order
+VIEW_SHAPES: Dict[str, List[Column]] = {
+    'elegiveis_cv': _ELEGIVEIS_CV,
+    'cv_acima_de_1000': _CV_ACIMA_DE_1000,
+    'marcados_levantamento': _visit_columns('next_dispensing_date'),
+    'marcados_seguimento': _visit_columns('next_appointment_date'),
+}
+
+_QUERY = re.compile(r"SELECT\s+(?P<columns>.+?)\s+FROM\s+`?(?P<view>\w+)`?",
+                    re.IGNORECASE | re.DOTALL)
+
+
+class SyntheticMySQLCursor:
+    """Unbuffered MySQL cursor serving generated view rows.
+
+    Projections are honoured; WHERE clauses are ignored, so every query
+    returns `rows` rows. `latency` seconds are slept per round trip to
+    mimic a WAN link.
+    """
+
+    def __init__(self, rows: int, shapes: Dict[str, List[Column]] = VIEW_SHAPES,
+                 latency: float = 0.0):
+        self.rows = rows
+        self.shapes = shapes
+        self.latency = latency
+        self.description = None
+        self.statements = 0
+        self._result: Iterator[Tuple] = iter(())
+
+    def execute(self, query: str, params: Optional[Sequence] = None):
+        self.statements += 1
+        match = _QUERY.search(query)
+        shape = self.shapes[match.group('view')]
+        names = [name for name, _ in shape]
+        selected = match.group('columns').strip()
+        if selected == '*':
+            positions = list(range(len(shape)))
+        else:
+            positions = [names.index(name.strip().strip('`'))
+                         for name in selected.split(',')]
+        self.description = [(names[p], None, None, None, None, None, True)
+                            for p in positions]
+        count = 0 if re.search(r'\bLIMIT\s+0\b', query, re.I) else self.rows
+        generators = [shape[p][1] for p in positions]
+        self._result = (tuple(gen(i) for gen in generators)
+                        for i in range(count))
+
+    def fetchmany(self, size: int = 1) -> List[Tuple]:
+        if self.latency:
+            time.sleep(self.latency)
+        return list(islice(self._result, size))
+
+    def fetchone(self) -> Optional[Tuple]:
+        return next(self._result, None)
+
+    def fetchall(self) -> List[Tuple]:
+        return list(self._result)
+
+    def __iter__(self):
+        return self._result
+
+    def close(self):
+        self._result = iter(())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SyntheticPGCursor:
+    """PostgreSQL cursor that accepts COPY and statements without a server.
+
+    `latency` seconds are slept per COPY to mimic a remote server.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.rowcount = 0
+        self.copy_rows = 0
+        self.copy_bytes = 0
+        self.statements = 0
+        self.closed = False
+
+    def copy_expert(self, statement, file, size: int = 8192):
+        if self.latency:
+            time.sleep(self.latency)
+        data = file.read()
+        self.copy_bytes += len(data.encode() if isinstance(data, str) else data)
+        rows = data.count('\n' if isinstance(data, str) else b'\n')
+        self.copy_rows += rows
+        self.rowcount = rows
+
+    def execute(self, query, params: Optional[Sequence] = None):
+        self.statements += 1
+        self.rowcount = 0
+
+    def fetchone(self) -> Optional[Tuple]:
+        return None
+
+    def fetchall(self) -> List[Tuple]:
+        return []
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
@@ -0,0 +1,121 @@
+"""Offline throughput benchmark for the main.py sync stages.
+
+Drives the real fetch_and_insert_* functions against synthetic MySQL
+and PostgreSQL cursors and reports rows/s, latency and peak memory per
+stage. Run from the repository root:
+
+    python -m benchmarks.run --rows 100000
+"""
+import argparse
+import time
+import tracemalloc
+from typing import Callable, List, NamedTuple
+
+import main
+from benchmarks.fake_db import SyntheticMySQLCursor, SyntheticPGCursor
+
+
+# Stage name and the function that loads it
+STAGES = {
+    'elegiveis_cv': main.fetch_and_insert_elegiveis_cv,
+    'cv_acima_de_1000': main.fetch_and_insert_carga_viral_alta,
+    'marcados_levantamento': main.fetch_and_insert_marcados_levantamento,
+    'marcados_seguimento': main.fetch_and_insert_marcados_seguimento,
+    # Both marcados views merged into one deduplicated core_visit load
+    'core_visit': main.fetch_and_insert_visits,
+}
+
+# The stages main.sync_province runs
+DEFAULT_STAGES = ['elegiveis_cv', 'cv_acima_de_1000', 'core_visit']
+
+
+class StageResult(NamedTuple):
+    """Measurements of one benchmarked stage."""
+    stage: str
+    # Rows written through COPY, into the target or a staging table
+    rows: int
+    seconds: float
+    copy_bytes: int
+    mysql_statements: int
+    pg_statements: int
+    peak_memory: int
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def run_stage(stage: str, func: Callable, rows: int,
+              options: main.SyncOptions, trace_memory: bool,
+              mysql_latency: float = 0.0,
+              pg_latency: float = 0.0) -> StageResult:
+    """Run one stage against fresh synthetic cursors."""
+    mysql_cursor = SyntheticMySQLCursor(rows, latency=mysql_latency)
+    pg_cursor = SyntheticPGCursor(latency=pg_latency)
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    func('Sofala', mysql_cursor, pg_cursor, options)
+    seconds = time.perf_counter() - started
+    peak = 0
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return StageResult(stage, pg_cursor.copy_rows, seconds,
+                       pg_cursor.copy_bytes,
+                       mysql_cursor.statements, pg_cursor.statements, peak)
+
+
+def print_report(results: List[StageResult], trace_memory: bool):
+    """Print one line per stage plus a total."""
+    print(f"{'stage':<24}{'rows':>9}{'seconds':>10}{'rows/s':>12}"
+          f"{'MB copied':>11}{'peak MB':>9}")
+    for result in results:
+        peak = (f"{result.peak_memory / 2**20:9.1f}" if trace_memory
+                else f"{'-':>9}")
+        print(f"{result.stage:<24}{result.rows:>9}{result.seconds:>10.3f}"
+              f"{result.rows_per_second:>12,.0f}"
+              f"{result.copy_bytes / 2**20:>11.1f}{peak}")
+    rows = sum(result.rows for result in results)
+    seconds = sum(result.seconds for result in results)
+    print(f"{'total':<24}{rows:>9}{seconds:>10.3f}"
+          f"{rows / seconds if seconds else 0:>12,.0f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000,
+                        help="rows served by each view (default: %(default)s)")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES),
+                        default=DEFAULT_STAGES)
+    parser.add_argument('--fetch-size', type=int, default=main.FETCH_SIZE)
+    parser.add_argument('--load-mode', choices=('insert', 'upsert'),
+                        default='insert')
+    parser.add_argument('--no-pushdown', dest='pushdown',
+                        action='store_false')
+    parser.add_argument('--pipeline-depth', type=int, default=0)
+    parser.add_argument('--mysql-latency-ms', type=float, default=0.0,
+                        help="simulated delay per fetchmany() round trip")
+    parser.add_argument('--pg-latency-ms', type=float, default=0.0,
+                        help="simulated delay per COPY chunk")
+    parser.add_argument('--no-memory', dest='trace_memory',
+                        action='store_false',
+                        help="skip tracemalloc, which slows every stage down")
+    return parser.parse_args()
+
+
+def bench_main():
+    args = parse_args()
+    options = main.SyncOptions(fetch_size=args.fetch_size,
+                               load_mode=args.load_mode,
+                               pushdown=args.pushdown,
+                               pipeline_depth=args.pipeline_depth)
+    results = [run_stage(stage, STAGES[stage], args.rows, options,
+                         args.trace_memory, args.mysql_latency_ms / 1000,
+                         args.pg_latency_ms / 1000)
+               for stage in args.stages]
+    print_report(results, args.trace_memory)
+
+
+if __name__ == '__main__':
+    bench_main()
@@ -0,0 +1,132 @@
+from datetime import date
+from typing import (Iterable, Iterator, List, NamedTuple, Optional, Sequence,
+                    Tuple)
+
+
+# PostgreSQL table holding the last committed key per (province, view)
+CHECKPOINT_TABLE = 'sync_checkpoint'
+
+# Source columns a view is ordered by so a run can resume after the last
+# committed row, with their positions in the view's SELECT * result
+CHECKPOINT_KEYS = {
+    'elegiveis_cv': (('patient_identifier', 3),),
+    'cv_acima_de_1000': (('patient_identifier', 3),),
+    'marcados_levantamento': (('patient_identifier', 10),
+                              ('next_dispensing_date', 3)),
+    'marcados_seguimento': (('patient_identifier', 10),
+                            ('next_appointment_date', 3)),
+}
+
+
+CREATE_CHECKPOINT_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+        province VARCHAR(100) NOT NULL,
+        view_name VARCHAR(100) NOT NULL,
+        run_date DATE NOT NULL,
+        last_key TEXT[] NOT NULL,
+        done BOOLEAN NOT NULL DEFAULT false,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (province, view_name)
+    )
+"""
+
+SELECT_CHECKPOINT_SQL = f"""
+    SELECT last_key, done FROM {CHECKPOINT_TABLE}
+    WHERE province = %s AND view_name = %s AND run_date = %s
+"""
+
+UPSERT_CHECKPOINT_SQL = f"""
+    INSERT INTO {CHECKPOINT_TABLE}
+        (province, view_name, run_date, last_key, done)
+    VALUES (%s, %s, %s, %s, %s)
+    ON CONFLICT (province, view_name) DO UPDATE
+    SET run_date = EXCLUDED.run_date,
+        last_key = EXCLUDED.last_key,
+        done = EXCLUDED.done,
+        updated_at = now()
+"""
+
+DELETE_CHECKPOINTS_SQL = f"""
+    DELETE FROM {CHECKPOINT_TABLE} WHERE province = %s AND view_name = ANY(%s)
+"""
+
+
+class Checkpoint(NamedTuple):
+    """Progress of a view in an unfinished run."""
+    # Last committed key, as text
+    last_key: List[str]
+    # Whether the view was loaded completely
+    done: bool
+
+
+def ensure_checkpoint_table(pg_cursor):
+    """Create the checkpoint table if it does not exist yet."""
+    pg_cursor.execute(CREATE_CHECKPOINT_SQL)
+
+
+def get_checkpoint(pg_cursor, province: str, view: str, run_date: date
+                   ) -> Optional[Checkpoint]:
+    """Return a view's progress in an unfinished run, or None.
+
+    Checkpoints left by a run on another day are ignored, since that
+    day's snapshot is not the one being loaded.
+    """
+    pg_cursor.execute(SELECT_CHECKPOINT_SQL, (province, view, run_date))
+    row = pg_cursor.fetchone()
+    return Checkpoint(*row) if row else None
+
+
+def set_checkpoint(pg_cursor, province: str, view: str, run_date: date,
+                   key: Sequence, done: bool = False):
+    """Record the last key whose rows are part of the current transaction.
+
+    A view marked done is skipped entirely when the run is resumed.
+    """
+    pg_cursor.execute(UPSERT_CHECKPOINT_SQL,
+                      (province, view, run_date,
+                       [str(value) for value in key], done))
+
+
+def clear_checkpoints(pg_cursor, province: str, views: Sequence[str]):
+    """Forget a province's checkpoints once all the views are loaded."""
+    pg_cursor.execute(DELETE_CHECKPOINTS_SQL, (province, list(views)))
+
+
+def resume_condition(view: str, last_key: Optional[Sequence]
+                     ) -> Tuple[str, Tuple]:
+    """Build the condition selecting rows after a committed key."""
+    if view not in CHECKPOINT_KEYS or not last_key:
+        return '', ()
+    columns = ', '.join(f'`{column}`' for column, _ in CHECKPOINT_KEYS[view])
+    placeholders = ', '.join(['%s'] * len(last_key))
+    return f"({columns}) > ({placeholders})", tuple(last_key)
+
+
+def keyed_chunks(batches: Iterable[List[Tuple]], key_indexes: Sequence[int],
+                 size: int) -> Iterator[Tuple[List[Tuple], Tuple]]:
+    """Regroup key-ordered row batches into chunks of about `size` rows.
+
+    Yields (rows, last key) pairs. A chunk only ends where the key
+    changes, so every row of its last key is in it and a resumed run can
+    safely skip everything up to that key. Keys containing NULL never end
+    a chunk, because MySQL cannot compare past them.
+    """
+    def key(row: Tuple) -> Tuple:
+        return tuple(row[index] for index in key_indexes)
+
+    pending: List[Tuple] = []
+    for batch in batches:
+        pending.extend(batch)
+        if len(pending) < size:
+            continue
+        cut = len(pending) - 1
+        while cut > 0:
+            last = key(pending[cut - 1])
+            if last != key(pending[cut]) and None not in last:
+                break
+            cut -= 1
+        if cut:
+            chunk, pending = pending[:cut], pending[cut:]
+            yield chunk, key(chunk[-1])
+    if pending:
+        yield pending, key(pending[-1])
@@ -0,0 +1,197 @@
+import re
+import signal
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from main import (DEFAULT_OPTIONS, ProvinceResult, SyncOptions, run_province,
+                  selected_stages)
+from metrics import write_json_lines, write_prometheus_textfile
+from mysql_pool import check_idle, close_mysql_pool
+from pg_pool import close_pool
+
+
+# Seconds between health checks of the idle MySQL connections
+DEFAULT_HEALTH_INTERVAL = 60.0
+
+# Longest the scheduler sleeps before looking at its jobs again
+_TICK_SECONDS = 5.0
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_duration(text: str) -> float:
+    """Parse a duration such as '90', '90s', '15m', '6h' or '1d' into seconds."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([smhd]?)\s*', text)
+    if not match:
+        raise ValueError(f"invalid duration: {text!r}")
+    value, unit = match.groups()
+    return float(value) * _UNITS[unit or 's']
+
+
+class Schedule(NamedTuple):
+    """How often one stage of one province is synced."""
+    province: str
+    stage: str
+    interval: float
+
+
+def parse_schedules(specs: Sequence[str], provinces: Sequence[str],
+                    stages: Sequence[str],
+                    default_interval: float) -> List[Schedule]:
+    """Build the schedule of every province and stage.
+
+    Each spec reads [province][/stage]=duration, e.g. 'Niassa=2h',
+    '/core_visit=30m' or 'Sofala/core_visit=15m'; '*' also matches any
+    province. The most specific spec wins and everything else runs every
+    default_interval seconds.
+    """
+    overrides: Dict[Tuple[str, str], float] = {}
+    for spec in specs:
+        target, _, duration = spec.partition('=')
+        province, _, stage = target.partition('/')
+        province, stage = province.strip() or '*', stage.strip() or '*'
+        if province != '*' and province not in provinces:
+            raise ValueError(f"{spec!r}: unknown province {province!r}")
+        if stage != '*' and stage not in stages:
+            raise ValueError(f"{spec!r}: unknown stage {stage!r}")
+        overrides[(province, stage)] = parse_duration(duration)
+
+    schedules = []
+    for province in provinces:
+        for stage in stages:
+            interval = default_interval
+            for key in ((province, stage), (province, '*'), ('*', stage),
+                        ('*', '*')):
+                if key in overrides:
+                    interval = overrides[key]
+                    break
+            schedules.append(Schedule(province, stage, interval))
+    return schedules
+
+
+class Daemon:
+    """Runs scheduled province syncs until stopped.
+
+    Every province/stage has its own interval. Stages of a province
+    that fall due together run as one sync, and a province never runs
+    twice at the same time: its due stages wait until the current run
+    finishes. Connections stay pooled between runs, and idle MySQL
+    connections are pinged every health_interval seconds so dead ones
+    are dropped before a run needs them.
+    """
+
+    def __init__(self, schedules: Sequence[Schedule],
+                 options: SyncOptions = DEFAULT_OPTIONS, workers: int = 1,
+                 health_interval: float = DEFAULT_HEALTH_INTERVAL,
+                 metrics_json: Optional[str] = None,
+                 metrics_textfile: Optional[str] = None):
+        self.schedules = list(schedules)
+        self.options = options
+        self.workers = max(1, workers)
+        self.health_interval = health_interval
+        self.metrics_json = metrics_json
+        self.metrics_textfile = metrics_textfile
+        self.stopping = threading.Event()
+        # Set whenever a sync finishes or a stop is requested
+        self.wake = threading.Event()
+        # Everything is due straight away on start
+        self.next_due = {schedule: 0.0 for schedule in self.schedules}
+        self.running: Dict[str, Future] = {}
+        self.latest: Dict[str, ProvinceResult] = {}
+
+    def stop(self, *_):
+        """Ask the daemon to finish its running syncs and exit."""
+        self.stopping.set()
+        self.wake.set()
+
+    def _due(self, now: float) -> Dict[str, List[Schedule]]:
+        due: Dict[str, List[Schedule]] = {}
+        for schedule, at in self.next_due.items():
+            if at <= now and schedule.province not in self.running:
+                due.setdefault(schedule.province, []).append(schedule)
+        return due
+
+    def _start(self, pool: ThreadPoolExecutor, province: str,
+               schedules: List[Schedule], now: float):
+        stages = tuple(schedule.stage for schedule in schedules)
+        for schedule in schedules:
+            self.next_due[schedule] = now + schedule.interval
+        print(f"Starting {province}: {', '.join(stages)}")
+        future = pool.submit(run_province, province,
+                             self.options._replace(stages=stages))
+        future.add_done_callback(lambda _: self.wake.set())
+        self.running[province] = future
+
+    def _finish(self, province: str, future: Future):
+        del self.running[province]
+        try:
+            result = future.result()
+        except Exception as e:
+            result = ProvinceResult(province, False, 0.0, str(e))
+        status = "ok" if result.ok else f"FAILED: {result.error}"
+        print(f"Finished {province} in {result.elapsed:.1f}s, {status}")
+        self.latest[province] = result
+        run_at = datetime.now()
+        if self.metrics_json:
+            write_json_lines(self.metrics_json, [result], run_at)
+        if self.metrics_textfile:
+            write_prometheus_textfile(self.metrics_textfile,
+                                      list(self.latest.values()), run_at)
+
+    def run(self):
+        """Schedule syncs until stop() is called."""
+        last_check = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while not self.stopping.is_set():
+                self.wake.clear()
+                for province, future in list(self.running.items()):
+                    if future.done():
+                        self._finish(province, future)
+
+                now = time.monotonic()
+                free = self.workers - len(self.running)
+                for province, schedules in list(self._due(now).items())[:free]:
+                    self._start(pool, province, schedules, now)
+
+                if now - last_check >= self.health_interval:
+                    dropped = check_idle()
+                    if dropped:
+                        print(f"Dropped {dropped} dead MySQL connections")
+                    last_check = now
+
+                waits = [at - now for schedule, at in self.next_due.items()
+                         if schedule.province not in self.running]
+                timeout = min([_TICK_SECONDS] + [max(wait, 0.1)
+                                                 for wait in waits])
+                self.wake.wait(timeout)
+
+            print("Stopping, waiting for running syncs to finish")
+            for province, future in list(self.running.items()):
+                future.result()
+                self._finish(province, future)
+
+
+def run_daemon(provinces: Sequence[str], options: SyncOptions,
+               default_interval: float, specs: Sequence[str] = (),
+               workers: int = 1,
+               health_interval: float = DEFAULT_HEALTH_INTERVAL,
+               metrics_json: Optional[str] = None,
+               metrics_textfile: Optional[str] = None):
+    """Run the sync daemon in the foreground until SIGINT or SIGTERM."""
+    stages = [name for name, _ in selected_stages(options)]
+    schedules = parse_schedules(specs, provinces, stages, default_interval)
+    daemon = Daemon(schedules, options, workers, health_interval,
+                    metrics_json, metrics_textfile)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    for schedule in schedules:
+        print(f"Scheduled {schedule.province}/{schedule.stage} every "
+              f"{schedule.interval:g}s")
+    try:
+        daemon.run()
+    finally:
+        close_mysql_pool()
+        close_pool()
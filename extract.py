@@ -0,0 +1,134 @@
+from datetime import date, timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+# Number of rows pulled from MySQL per fetchmany() call
+DEFAULT_FETCH_SIZE = 2000
+
+
+def iter_batches(mysql_cursor, fetch_size: int = DEFAULT_FETCH_SIZE
+                 ) -> Iterator[List[Tuple]]:
+    """Yield the pending result of a cursor in fetchmany batches.
+
+    The cursor must be unbuffered so that only one batch is held in
+    memory at a time; the result set is always drained completely so
+    the connection can execute the next statement, even when the
+    generator is closed early.
+    """
+    try:
+        while True:
+            batch = mysql_cursor.fetchmany(fetch_size)
+            if not batch:
+                return
+            yield batch
+    except GeneratorExit:
+        while mysql_cursor.fetchmany(fetch_size):
+            pass
+        raise
+
+
+def iter_rows(mysql_cursor, fetch_size: int = DEFAULT_FETCH_SIZE
+              ) -> Iterator[Tuple]:
+    """Yield the pending result of a cursor row by row, batch by batch."""
+    for batch in iter_batches(mysql_cursor, fetch_size):
+        yield from batch
+
+
+def describe_view(mysql_cursor, view: str) -> List[str]:
+    """Return the column names of a view without fetching any rows."""
+    mysql_cursor.execute(f"SELECT * FROM {view} LIMIT 0")
+    mysql_cursor.fetchall()
+    return [column[0] for column in mysql_cursor.description]
+
+
+def build_select(view: str, columns: Optional[Sequence[str]] = None,
+                 conditions: Sequence[str] = (),
+                 order_by: Sequence[str] = ()) -> str:
+    """Build the extraction query for a view.
+
+    Only the given columns are selected (all of them when omitted), the
+    conditions are ANDed into the WHERE clause and rows are sorted by the
+    order_by columns, if any.
+    """
+    select_list = (', '.join(f'`{column}`' for column in columns)
+                   if columns else '*')
+    query = f"SELECT {select_list} FROM {view}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if order_by:
+        query += " ORDER BY " + ", ".join(f'`{column}`' for column in order_by)
+    return query
+
+
+def explain_select(mysql_cursor, query: str, params: Tuple = ()
+                   ) -> List[Dict[str, Any]]:
+    """Return MySQL's plan for a query, one dict per step.
+
+    The traditional tabular EXPLAIN is used, which every server version
+    supports; values are made JSON-friendly.
+    """
+    mysql_cursor.execute("EXPLAIN " + query, params or None)
+    rows = mysql_cursor.fetchall()
+    names = [column[0] for column in mysql_cursor.description]
+    steps = []
+    for row in rows:
+        step = {}
+        for name, value in zip(names, row):
+            if isinstance(value, (bytes, bytearray)):
+                value = value.decode()
+            elif isinstance(value, Decimal):
+                value = float(value)
+            step[name] = value
+        steps.append(step)
+    return steps
+
+
+def summarize_plan(steps: Sequence[Dict[str, Any]]) -> str:
+    """Describe a query plan in one line.
+
+    Each step shows its table, access type, index and estimated rows;
+    full scans, temporary tables and filesorts are called out, since
+    they are what make an extraction slow.
+    """
+    parts, warnings = [], []
+    for step in steps:
+        table, rows = step.get('table'), step.get('rows') or 0
+        extra = step.get('Extra') or ''
+        parts.append(f"{table} {step.get('type')}"
+                     f"/{step.get('key') or '-'} ~{rows}")
+        if step.get('type') == 'ALL':
+            warnings.append(f"full scan of {table}")
+        if 'Using temporary' in extra:
+            warnings.append(f"temporary table for {table}")
+        if 'Using filesort' in extra:
+            warnings.append(f"filesort for {table}")
+    return '; '.join(parts) + (f" ({', '.join(warnings)})"
+                               if warnings else '')
+
+
+def date_window(days: int, today: Optional[date] = None
+                ) -> Tuple[date, date]:
+    """Return the appointment dates a reminder run covers.
+
+    The window starts two days ahead, or four on Fridays so the weekend
+    is skipped, and ends `days` days from today.
+    """
+    today = today or date.today()
+    # Check if today is Friday (4 in weekday() since Monday is 0)
+    if today.weekday() == 4:
+        start_date = today + timedelta(days=4)
+    else:
+        start_date = today + timedelta(days=2)
+    return start_date, today + timedelta(days=days)
+
+
+def date_window_filter(column: str, days: int, today: Optional[date] = None
+                       ) -> Tuple[str, Tuple]:
+    """Build the condition restricting a view to its date window.
+
+    The end date is included in full even for DATETIME columns.
+    """
+    start_date, end_date = date_window(days, today)
+    return (f"`{column}` >= %s AND `{column}` < %s",
+            (start_date, end_date + timedelta(days=1)))
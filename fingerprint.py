@@ -0,0 +1,180 @@
+from itertools import chain
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from checkpoint import CHECKPOINT_KEYS
+from extract import iter_batches
+from loader import TableWriter
+
+
+# PostgreSQL table holding the fingerprint of every row key last loaded
+FINGERPRINT_TABLE = 'sync_fingerprint'
+
+# Source columns identifying a row of each view, with their positions in
+# the view's SELECT * result; the same keys checkpoints resume on
+FINGERPRINT_KEYS = CHECKPOINT_KEYS
+
+# Changed keys fetched per query when only changed rows are extracted
+KEYS_PER_QUERY = 1000
+
+# Share of changed keys above which the whole view is extracted instead
+FULL_FETCH_RATIO = 0.5
+
+# Separates the parts of a compound key stored as text
+_KEY_SEPARATOR = '\x1f'
+
+
+CREATE_FINGERPRINT_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {FINGERPRINT_TABLE} (
+        province VARCHAR(100) NOT NULL,
+        view_name VARCHAR(100) NOT NULL,
+        row_key TEXT NOT NULL,
+        fingerprint CHAR(32) NOT NULL,
+        PRIMARY KEY (province, view_name, row_key)
+    )
+"""
+
+SELECT_FINGERPRINTS_SQL = f"""
+    SELECT row_key, fingerprint FROM {FINGERPRINT_TABLE}
+    WHERE province = %s AND view_name = %s
+"""
+
+DELETE_FINGERPRINTS_SQL = f"""
+    DELETE FROM {FINGERPRINT_TABLE}
+    WHERE province = %s AND view_name = %s AND row_key = ANY(%s)
+"""
+
+_FINGERPRINT_COLUMNS = ('province', 'view_name', 'row_key', 'fingerprint')
+
+
+def ensure_fingerprint_table(pg_cursor):
+    """Create the fingerprint table if it does not exist yet."""
+    pg_cursor.execute(CREATE_FINGERPRINT_SQL)
+
+
+def fingerprint_query(view: str, key_columns: Sequence[str],
+                      columns: Sequence[str],
+                      conditions: Sequence[str] = ()) -> str:
+    """Build the query hashing a view's rows on the MySQL side.
+
+    Returns one row per key: the key columns and an MD5 over the given
+    columns. QUOTE() tells NULL apart from the text 'NULL' and from an
+    empty string. Rows sharing a key are hashed together in a stable
+    order; groups beyond group_concat_max_len are only partly hashed.
+    """
+    keys = ', '.join(f'`{column}`' for column in key_columns)
+    row_hash = "MD5(CONCAT_WS(',', {}))".format(
+        ', '.join(f'QUOTE(`{column}`)' for column in columns))
+    query = f"SELECT {keys}, {row_hash} AS row_hash FROM {view}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return (f"SELECT {keys}, "
+            f"MD5(GROUP_CONCAT(row_hash ORDER BY row_hash SEPARATOR '')) "
+            f"FROM ({query}) AS row_hashes GROUP BY {keys}")
+
+
+def key_condition(key_columns: Sequence[str], count: int) -> str:
+    """Build the condition selecting rows with one of `count` keys."""
+    if len(key_columns) == 1:
+        return f"`{key_columns[0]}` IN ({', '.join(['%s'] * count)})"
+    columns = ', '.join(f'`{column}`' for column in key_columns)
+    row = f"({', '.join(['%s'] * len(key_columns))})"
+    return f"({columns}) IN ({', '.join([row] * count)})"
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode()
+    return str(value)
+
+
+def key_text(key: Sequence) -> str:
+    """Render a row key as the text stored in PostgreSQL."""
+    return _KEY_SEPARATOR.join(map(_text, key))
+
+
+class RowDiff:
+    """Row keys of a view that changed since its previous load.
+
+    Compares the fingerprints computed by MySQL this run with the ones
+    stored by the previous run. `changed` holds the native keys of new
+    or changed rows, and save() records the current fingerprints once
+    the rows have been loaded.
+    """
+
+    def __init__(self, view: str, current: Iterable[Tuple],
+                 stored: Dict[str, str]):
+        self.view = view
+        self.changed: List[Tuple] = []
+        self.updated: List[Tuple[str, str]] = []
+        self.total = 0
+        seen = set()
+        for *key, fingerprint in current:
+            text = key_text(key)
+            seen.add(text)
+            self.total += 1
+            fingerprint = _text(fingerprint)
+            if stored.get(text) != fingerprint:
+                self.changed.append(tuple(key))
+                self.updated.append((text, fingerprint))
+        self.removed = [text for text in stored if text not in seen]
+
+    @property
+    def full_fetch(self) -> bool:
+        """Whether extracting the whole view is cheaper than by key.
+
+        Also the case when a changed key contains NULL, which no key
+        condition can match.
+        """
+        return (len(self.changed) > self.total * FULL_FETCH_RATIO
+                or any(None in key for key in self.changed))
+
+    def key_batches(self, size: int = KEYS_PER_QUERY
+                    ) -> Iterable[List[Tuple]]:
+        """Split the changed keys into groups fetched by one query each."""
+        for start in range(0, len(self.changed), size):
+            yield self.changed[start:start + size]
+
+    def describe(self) -> str:
+        return (f"{len(self.changed)} of {self.total} keys changed, "
+                f"{len(self.removed)} gone")
+
+    def save(self, pg_cursor, province: str):
+        """Store the current fingerprints in the caller's transaction."""
+        if self.updated:
+            writer = TableWriter(pg_cursor, FINGERPRINT_TABLE,
+                                 _FINGERPRINT_COLUMNS,
+                                 staging=f'stage_fingerprint_{self.view}',
+                                 conflict_columns=_FINGERPRINT_COLUMNS[:3],
+                                 update_columns=('fingerprint',))
+            writer.load((province, self.view, text, fingerprint)
+                        for text, fingerprint in self.updated)
+        if self.removed:
+            pg_cursor.execute(DELETE_FINGERPRINTS_SQL,
+                              (province, self.view, self.removed))
+
+
+def get_fingerprints(pg_cursor, province: str, view: str) -> Dict[str, str]:
+    """Return the fingerprints stored for a view, by key text."""
+    pg_cursor.execute(SELECT_FINGERPRINTS_SQL, (province, view))
+    return dict(pg_cursor.fetchall())
+
+
+def diff_rows(mysql_cursor, stored: Dict[str, str], view: str,
+              columns: Sequence[str], conditions: Sequence[str] = (),
+              params: Tuple = (),
+              source: Optional[str] = None) -> Optional[RowDiff]:
+    """Fingerprint a view in MySQL and diff it against the last load.
+
+    `stored` holds the fingerprints from get_fingerprints. Only keys and
+    hashes cross the network. The rows are read from `source`, e.g. the
+    view's snapshot table, when given. Returns None for views without a
+    fingerprint key.
+    """
+    if view not in FINGERPRINT_KEYS:
+        return None
+    key_columns = [column for column, _ in FINGERPRINT_KEYS[view]]
+    mysql_cursor.execute(fingerprint_query(source or view, key_columns,
+                                           columns, conditions),
+                         params or None)
+    current = chain.from_iterable(iter_batches(mysql_cursor))
+    return RowDiff(view, current, stored)
@@ -1,11 +1,12 @@
 import os
 from dotenv import load_dotenv
 import mysql.connector
-import psycopg2
 from psycopg2 import sql
 from datetime import date
 from typing import Dict, Any, Tuple, Union, List
 
+from pg_pool import close_pool, pg_connection
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -83,6 +84,8 @@ def main():
             fetch_and_insert_data(mysql_cursor2, pg_config)
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        close_pool()
 
 
 def fetch_and_insert_data(mysql_cursor, pg_config):
@@ -91,7 +94,7 @@ def fetch_and_insert_data(mysql_cursor, pg_config):
     query = "SELECT * FROM elegiveis_cv"
     mysql_cursor.execute(query)
 
-    with psycopg2.connect(**pg_config) as pg_cnx, pg_cnx.cursor() as pg_cursor:
+    with pg_connection(pg_config) as pg_cnx, pg_cnx.cursor() as pg_cursor:
         # Insert fetched data into PostgreSQL
         for row in mysql_cursor:
             province = "Sofala"
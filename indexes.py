@@ -0,0 +1,278 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from typing import Dict, Iterator, List, NamedTuple, Sequence, Tuple, Union
+
+import psycopg2
+from psycopg2 import sql
+
+
+# PostgreSQL table remembering the indexes dropped for a bulk load, so
+# they are rebuilt even if the run that dropped them died
+DROPPED_INDEX_TABLE = 'sync_dropped_index'
+
+# PostgreSQL table remembering how many rows the last run of each kind
+# wrote into each table, to predict the next run of that kind
+LOAD_HISTORY_TABLE = 'sync_load_history'
+
+# Rows a run is expected to load, across all targets, before secondary
+# indexes are dropped around it
+BULK_LOAD_ROWS = int(os.getenv('SYNC_BULK_LOAD_ROWS', 100000))
+
+# Share of a table a load must be expected to add; below it, rebuilding
+# the indexes over the whole table costs more than maintaining them
+BULK_LOAD_RATIO = float(os.getenv('SYNC_BULK_LOAD_RATIO', 0.1))
+
+# Indexes rebuilt at the same time, each on its own connection
+REBUILD_WORKERS = int(os.getenv('SYNC_INDEX_REBUILD_WORKERS', 2))
+
+
+CREATE_DROPPED_INDEX_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {DROPPED_INDEX_TABLE} (
+        table_name VARCHAR(100) NOT NULL,
+        index_name VARCHAR(100) NOT NULL,
+        definition TEXT NOT NULL,
+        dropped_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (index_name)
+    )
+"""
+
+CREATE_LOAD_HISTORY_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {LOAD_HISTORY_TABLE} (
+        table_name VARCHAR(100) NOT NULL,
+        run_kind VARCHAR(20) NOT NULL,
+        rows_written BIGINT NOT NULL,
+        recorded_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (table_name, run_kind)
+    )
+"""
+
+SELECT_LOAD_HISTORY_SQL = f"""
+    SELECT rows_written FROM {LOAD_HISTORY_TABLE}
+    WHERE table_name = %s AND run_kind = %s
+"""
+
+UPSERT_LOAD_HISTORY_SQL = f"""
+    INSERT INTO {LOAD_HISTORY_TABLE} (table_name, run_kind, rows_written)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (table_name, run_kind) DO UPDATE
+    SET rows_written = EXCLUDED.rows_written, recorded_at = now()
+"""
+
+# Indexes nothing depends on: not the primary key, not unique (ON
+# CONFLICT needs those) and not backing a constraint
+SECONDARY_INDEXES_SQL = """
+    SELECT i.relname, pg_get_indexdef(x.indexrelid)
+    FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = %s::regclass AND i.relkind <> 'I'
+      AND NOT x.indisprimary AND NOT x.indisunique
+      AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                      WHERE c.conindid = x.indexrelid)
+"""
+
+INSERT_DROPPED_INDEX_SQL = f"""
+    INSERT INTO {DROPPED_INDEX_TABLE} (table_name, index_name, definition)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (index_name) DO NOTHING
+"""
+
+SELECT_DROPPED_INDEXES_SQL = f"""
+    SELECT table_name, index_name, definition FROM {DROPPED_INDEX_TABLE}
+    WHERE table_name = ANY(%s)
+"""
+
+DELETE_DROPPED_INDEX_SQL = f"""
+    DELETE FROM {DROPPED_INDEX_TABLE} WHERE index_name = %s
+"""
+
+INVALID_INDEX_SQL = """
+    SELECT 1 FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE i.relname = %s AND NOT x.indisvalid
+"""
+
+# Rows written to a table so far, as counted by the statistics system:
+# inserts and the updates that were not HOT, i.e. the writes that add
+# index entries; and the table's estimated size. Neither scans it.
+TABLE_WRITES_SQL = """
+    SELECT s.n_tup_ins + s.n_tup_upd - s.n_tup_hot_upd, c.reltuples::bigint
+    FROM pg_stat_user_tables s JOIN pg_class c ON c.oid = s.relid
+    WHERE s.relid = %s::regclass
+"""
+
+
+class SecondaryIndex(NamedTuple):
+    """A droppable index and the statement recreating it."""
+    table: str
+    name: str
+    definition: str
+
+
+def ensure_dropped_index_table(pg_cursor):
+    """Create the dropped index table if it does not exist yet."""
+    pg_cursor.execute(CREATE_DROPPED_INDEX_SQL)
+
+
+def ensure_load_history_table(pg_cursor):
+    """Create the load history table if it does not exist yet."""
+    pg_cursor.execute(CREATE_LOAD_HISTORY_SQL)
+
+
+def table_writes(pg_cursor, table: str) -> Tuple[int, int]:
+    """Return the rows written to a table so far and its estimated size."""
+    pg_cursor.execute(TABLE_WRITES_SQL, (table,))
+    row = pg_cursor.fetchone()
+    if row is None:
+        return 0, 0
+    writes, size = row
+    return writes, max(size, 0)
+
+
+def secondary_indexes(pg_cursor, table: str) -> List[SecondaryIndex]:
+    """Return the indexes of a table that a bulk load can drop.
+
+    Indexes of a partitioned table are left alone: they cannot be
+    rebuilt CONCURRENTLY.
+    """
+    pg_cursor.execute(SECONDARY_INDEXES_SQL, (table,))
+    return [SecondaryIndex(table, name, definition)
+            for name, definition in pg_cursor.fetchall()]
+
+
+def dropped_indexes(pg_cursor, tables: Sequence[str]
+                    ) -> List[SecondaryIndex]:
+    """Return the indexes dropped from the tables and not rebuilt yet."""
+    pg_cursor.execute(SELECT_DROPPED_INDEXES_SQL, (list(tables),))
+    return [SecondaryIndex(*row) for row in pg_cursor.fetchall()]
+
+
+def expected_load(pg_cursor, table: str, kind: str) -> Dict[str, int]:
+    """Estimate a run's load into a table from the last run of its kind.
+
+    Returns the rows that run wrote (0 if there was none), the table's
+    size, and its write counter now, which record_loads compares with
+    once the run is over.
+    """
+    writes, size = table_writes(pg_cursor, table)
+    pg_cursor.execute(SELECT_LOAD_HISTORY_SQL, (table, kind))
+    row = pg_cursor.fetchone()
+    return {'rows': row[0] if row else 0, 'size': size, 'writes': writes}
+
+
+def record_loads(pg_config: Dict[str, Union[str, int, None]], kind: str,
+                 writes: Dict[str, int]):
+    """Store what a run wrote into each table, from the write counters
+    taken before it.
+
+    The statistics system may report the last writes a moment late, and
+    a table whose counters were reset meanwhile is not recorded.
+    """
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        with pg_cnx.cursor() as pg_cursor:
+            for table, before in writes.items():
+                written = table_writes(pg_cursor, table)[0] - before
+                if written >= 0:
+                    pg_cursor.execute(UPSERT_LOAD_HISTORY_SQL,
+                                      (table, kind, written))
+        pg_cnx.commit()
+
+
+def drop_indexes(pg_cursor, indexes: Sequence[SecondaryIndex]):
+    """Record and drop indexes, in the caller's transaction."""
+    for index in indexes:
+        pg_cursor.execute(INSERT_DROPPED_INDEX_SQL, index)
+        pg_cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(
+            sql.Identifier(index.name)))
+
+
+def _concurrent(definition: str) -> str:
+    """Turn a pg_get_indexdef statement into a non-blocking rebuild."""
+    return definition.replace('CREATE INDEX ',
+                              'CREATE INDEX CONCURRENTLY IF NOT EXISTS ', 1)
+
+
+def rebuild_index(pg_config: Dict[str, Union[str, int, None]],
+                  index: SecondaryIndex) -> float:
+    """Rebuild one dropped index without blocking readers or writers.
+
+    CREATE INDEX CONCURRENTLY cannot run in a transaction, so it gets
+    its own autocommit connection. A leftover invalid index from an
+    interrupted rebuild is dropped first. Returns the seconds taken.
+    """
+    started = time.monotonic()
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        pg_cnx.autocommit = True
+        with pg_cnx.cursor() as pg_cursor:
+            pg_cursor.execute(INVALID_INDEX_SQL, (index.name,))
+            if pg_cursor.fetchone():
+                pg_cursor.execute(sql.SQL(
+                    "DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+                        sql.Identifier(index.name)))
+            pg_cursor.execute(_concurrent(index.definition))
+            pg_cursor.execute(DELETE_DROPPED_INDEX_SQL, (index.name,))
+    return time.monotonic() - started
+
+
+def rebuild_indexes(pg_config: Dict[str, Union[str, int, None]],
+                    tables: Sequence[str], analyze: bool = True,
+                    workers: int = REBUILD_WORKERS):
+    """Rebuild every index dropped from the tables, then ANALYZE them."""
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        pg_cnx.autocommit = True
+        with pg_cnx.cursor() as pg_cursor:
+            ensure_dropped_index_table(pg_cursor)
+            indexes = dropped_indexes(pg_cursor, tables)
+            if indexes:
+                with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                    for index, seconds in zip(indexes, pool.map(
+                            lambda index: rebuild_index(pg_config, index),
+                            indexes)):
+                        print(f"Rebuilt index {index.name} on {index.table} "
+                              f"in {seconds:.1f}s")
+            for table in tables if analyze else ():
+                pg_cursor.execute(sql.SQL("ANALYZE {}").format(
+                    sql.Identifier(table)))
+
+
+@contextmanager
+def bulk_load(pg_config: Dict[str, Union[str, int, None]],
+              tables: Sequence[str], min_rows: int = BULK_LOAD_ROWS,
+              ratio: float = BULK_LOAD_RATIO,
+              kind: str = 'full') -> Iterator[bool]:
+    """Drop the targets' secondary indexes around a large load.
+
+    The load is expected to be as large as the last one of the same
+    kind, e.g. 'incremental', so a small incremental run is not sized
+    like a full load. When that is at least min_rows in total, the secondary indexes of the tables
+    expecting at least `ratio` of their size are recorded and dropped
+    before the block, then rebuilt concurrently and the tables analyzed
+    after it, even if it failed. Smaller runs keep their indexes, but
+    still rebuild any left dropped by an earlier run that died. A run
+    that succeeds is recorded for the next one. Yields whether indexes
+    were dropped.
+    """
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        with pg_cnx.cursor() as pg_cursor:
+            ensure_dropped_index_table(pg_cursor)
+            ensure_load_history_table(pg_cursor)
+            estimates = {table: expected_load(pg_cursor, table, kind)
+                         for table in tables}
+            bulky = [table for table, estimate in estimates.items()
+                     if estimate['rows'] >= estimate['size'] * ratio]
+            expected = sum(estimate['rows'] for estimate in estimates.values())
+            indexes = []
+            if expected >= min_rows:
+                for table in bulky:
+                    indexes.extend(secondary_indexes(pg_cursor, table))
+                drop_indexes(pg_cursor, indexes)
+            pg_cnx.commit()
+    if indexes:
+        print(f"Bulk load of about {expected} rows: dropped "
+              f"{', '.join(index.name for index in indexes)}")
+    try:
+        yield bool(indexes)
+    finally:
+        rebuild_indexes(pg_config, tables, analyze=bool(indexes))
+    record_loads(pg_config, kind, {table: estimate['writes']
+                                   for table, estimate in estimates.items()})
@@ -0,0 +1,308 @@
+import io
+import time
+from contextlib import closing
+from datetime import date, datetime
+from itertools import islice
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple, Union)
+
+import psycopg2
+from psycopg2 import sql
+
+from batching import AdaptiveBatchSize, estimate_row_bytes
+
+
+# Number of rows buffered in memory before each COPY round trip
+DEFAULT_CHUNK_SIZE = 5000
+
+# Whether an index of a table exists and is valid
+INDEX_VALID_SQL = """
+    SELECT x.indisvalid FROM pg_index x
+    JOIN pg_class i ON i.oid = x.indexrelid
+    WHERE x.indrelid = %s::regclass AND i.relname = %s
+"""
+
+# Characters that must be escaped in the COPY text format
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+def format_copy_value(value: Any) -> str:
+    """Render a single value in PostgreSQL COPY text format."""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        # Text read from binary or BLOB columns comes back undecoded
+        value = value.decode()
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def format_copy_row(row: Sequence[Any]) -> str:
+    """Render a row as one line of COPY text format."""
+    return '\t'.join(map(format_copy_value, row)) + '\n'
+
+
+def chunked(rows: Iterable[Tuple], size: int) -> Iterator[List[Tuple]]:
+    """Split an iterable of rows into lists of at most size rows."""
+    iterator = iter(rows)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def copy_chunk(pg_cursor, table: str, columns: Sequence[str],
+               chunk: Sequence[Tuple]) -> int:
+    """COPY one chunk of rows into a PostgreSQL table."""
+    buffer = io.StringIO(''.join(map(format_copy_row, chunk)))
+    statement = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(table),
+        sql.SQL(', ').join(map(sql.Identifier, columns)))
+    pg_cursor.copy_expert(statement, buffer)
+    return len(chunk)
+
+
+def copy_rows(pg_cursor, table: str, columns: Sequence[str],
+              rows: Iterable[Tuple],
+              chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """Stream rows into a PostgreSQL table with COPY in bounded chunks.
+
+    Returns the number of rows written.
+    """
+    total = 0
+    for chunk in chunked(rows, chunk_size):
+        total += copy_chunk(pg_cursor, table, columns, chunk)
+    return total
+
+
+def conflict_index_name(table: str) -> str:
+    """Return the name of the unique index a table's upserts use."""
+    return f'{table}_sync_key'
+
+
+def check_insertable(pg_cursor, tables: Iterable[str]):
+    """Refuse to append to tables that upserts maintain.
+
+    A table with a conflict index holds one row per key, so appending
+    another day's snapshot would fail with a unique violation halfway
+    through; its loads must use --load-mode upsert.
+    """
+    indexed = []
+    for table in tables:
+        pg_cursor.execute(INDEX_VALID_SQL, (table, conflict_index_name(table)))
+        if pg_cursor.fetchone():
+            indexed.append(table)
+    if indexed:
+        raise RuntimeError(f"{', '.join(indexed)} can only be loaded with "
+                           f"--load-mode upsert: they have a unique sync "
+                           f"key index")
+
+
+def ensure_conflict_index(pg_cursor, table: str,
+                          conflict_columns: Sequence[str]):
+    """Create the unique index that ON CONFLICT upserts are keyed on.
+
+    Nothing is locked when the index already exists. Otherwise it is
+    built CONCURRENTLY, so the cursor must be in autocommit mode; an
+    invalid index left by an interrupted build is dropped first.
+    Existing duplicate rows in the target must be cleaned up before the
+    index can be built.
+    """
+    name = conflict_index_name(table)
+    pg_cursor.execute(INDEX_VALID_SQL, (table, name))
+    row = pg_cursor.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        pg_cursor.execute(sql.SQL(
+            "DROP INDEX CONCURRENTLY IF EXISTS {}").format(
+                sql.Identifier(name)))
+    pg_cursor.execute(sql.SQL(
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({})").format(
+            sql.Identifier(name),
+            sql.Identifier(table),
+            sql.SQL(', ').join(map(sql.Identifier, conflict_columns))))
+
+
+def ensure_conflict_indexes(pg_config: Dict[str, Union[str, int, None]],
+                            targets: Iterable[Tuple[str, Sequence[str]]]):
+    """Make sure every (table, conflict columns) target has its index.
+
+    Meant to run once before provinces load concurrently, on its own
+    autocommit connection: building an index inside a province's
+    transaction would hold a SHARE lock on the table until it commits,
+    deadlocking with the other provinces' merges.
+    """
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        pg_cnx.autocommit = True
+        with pg_cnx.cursor() as pg_cursor:
+            for table, conflict_columns in dict(targets).items():
+                ensure_conflict_index(pg_cursor, table, conflict_columns)
+
+
+def create_staging_table(pg_cursor, staging: str, table: str,
+                         columns: Sequence[str]):
+    """Create an empty temporary table shaped like the loaded columns."""
+    pg_cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(
+        sql.Identifier(staging)))
+    pg_cursor.execute(sql.SQL(
+        "CREATE TEMP TABLE {} ON COMMIT DROP AS "
+        "SELECT {} FROM {} WITH NO DATA").format(
+            sql.Identifier(staging),
+            sql.SQL(', ').join(map(sql.Identifier, columns)),
+            sql.Identifier(table)))
+
+
+def merge_staging_table(pg_cursor, staging: str, table: str,
+                        columns: Sequence[str],
+                        conflict_columns: Sequence[str],
+                        update_columns: Sequence[str],
+                        reset_columns: Sequence[str] = ()) -> int:
+    """Merge a staging table into its target with one INSERT ... ON CONFLICT.
+
+    Rows whose key already exists only touch the target when one of the
+    update columns actually changed; the reset columns are then set
+    from the new row too. Returns the number of rows written.
+    """
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    key_list = sql.SQL(', ').join(map(sql.Identifier, conflict_columns))
+    if update_columns:
+        conflict_action = sql.SQL(
+            "DO UPDATE SET {} WHERE ({}) IS DISTINCT FROM ({})").format(
+                sql.SQL(', ').join(
+                    sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(name))
+                    for name in (*update_columns, *reset_columns)),
+                sql.SQL(', ').join(
+                    sql.SQL("{}.{}").format(sql.Identifier(table),
+                                            sql.Identifier(name))
+                    for name in update_columns),
+                sql.SQL(', ').join(
+                    sql.SQL("EXCLUDED.{}").format(sql.Identifier(name))
+                    for name in update_columns))
+    else:
+        conflict_action = sql.SQL("DO NOTHING")
+    pg_cursor.execute(sql.SQL(
+        "INSERT INTO {table} ({columns}) "
+        "SELECT DISTINCT ON ({keys}) {columns} FROM {staging} "
+        "ON CONFLICT ({keys}) {action}").format(
+            table=sql.Identifier(table),
+            columns=column_list,
+            keys=key_list,
+            staging=sql.Identifier(staging),
+            action=conflict_action))
+    return pg_cursor.rowcount
+
+
+class TableWriter:
+    """Writes chunks of rows into one target table with COPY.
+
+    With a staging table the chunks are COPYed there instead and merged
+    into the target with ON CONFLICT by finish(). Chunks can be written
+    one at a time, or rows fed piecemeal and buffered into chunks, so
+    several writers can share a connection and be fed in any
+    interleaving.
+    """
+
+    def __init__(self, pg_cursor, table: str, columns: Sequence[str],
+                 staging: Optional[str] = None,
+                 conflict_columns: Sequence[str] = (),
+                 update_columns: Sequence[str] = (),
+                 reset_columns: Sequence[str] = ()):
+        self.pg_cursor = pg_cursor
+        self.table = table
+        self.columns = columns
+        self.staging = staging
+        self.conflict_columns = conflict_columns
+        self.update_columns = update_columns
+        self.reset_columns = reset_columns
+        self.copied = 0
+        self.pending: List[Tuple] = []
+
+    def begin(self):
+        """Prepare the staging table, if any."""
+        if self.staging:
+            create_staging_table(self.pg_cursor, self.staging, self.table,
+                                 self.columns)
+
+    def write(self, chunk: Sequence[Tuple]) -> int:
+        """COPY one chunk of rows."""
+        written = copy_chunk(self.pg_cursor, self.staging or self.table,
+                             self.columns, chunk)
+        self.copied += written
+        return written
+
+    def write_timed(self, chunk: Sequence[Tuple],
+                    batch_size: Optional[AdaptiveBatchSize] = None) -> int:
+        """COPY one chunk, tuning batch_size from its timing if given."""
+        if batch_size is None:
+            return self.write(chunk)
+        started = time.perf_counter()
+        written = self.write(chunk)
+        batch_size.observe(len(chunk), time.perf_counter() - started,
+                           estimate_row_bytes(chunk[0]))
+        return written
+
+    def feed(self, rows: Iterable[Tuple],
+             chunk_size: int = DEFAULT_CHUNK_SIZE,
+             batch_size: Optional[AdaptiveBatchSize] = None):
+        """Buffer rows, writing each chunk as soon as it is full.
+
+        Chunks hold chunk_size rows, or as many as batch_size is tuned
+        to; finish() writes the rows left over.
+        """
+        self.pending.extend(rows)
+        while True:
+            size = batch_size.size if batch_size else chunk_size
+            if len(self.pending) < size:
+                return
+            chunk = self.pending[:size]
+            del self.pending[:size]
+            self.write_timed(chunk, batch_size)
+
+    def finish(self) -> int:
+        """Merge the staging table, if any, and return the rows loaded."""
+        if self.pending:
+            self.write(self.pending)
+            self.pending = []
+        if not self.staging:
+            return self.copied
+        merged = merge_staging_table(self.pg_cursor, self.staging,
+                                     self.table, self.columns,
+                                     self.conflict_columns,
+                                     self.update_columns,
+                                     self.reset_columns)
+        self.pg_cursor.execute(sql.SQL("DROP TABLE {}").format(
+            sql.Identifier(self.staging)))
+        return merged
+
+    def load(self, rows: Iterable[Tuple],
+             chunk_size: int = DEFAULT_CHUNK_SIZE,
+             batch_size: Optional[AdaptiveBatchSize] = None) -> int:
+        """Write a whole stream of rows in bounded chunks.
+
+        With batch_size the chunk size is tuned from each COPY's timing
+        instead of fixed to chunk_size.
+        """
+        self.begin()
+        if batch_size is None:
+            for chunk in chunked(rows, chunk_size):
+                self.write(chunk)
+            return self.finish()
+        iterator = iter(rows)
+        while True:
+            chunk = list(islice(iterator, batch_size.size))
+            if not chunk:
+                return self.finish()
+            self.write_timed(chunk, batch_size)
+
@@ -1,15 +1,59 @@
+import argparse
 import os
+import sys
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+from contextlib import ExitStack, closing
 from dotenv import load_dotenv
-import mysql.connector
-import psycopg2
-from psycopg2 import sql
 from datetime import date, datetime, timedelta
-from typing import Dict, Any, Tuple, Union
+from itertools import chain
+from typing import (Dict, Any, Iterator, List, NamedTuple, Optional, Sequence,
+                    Tuple, Union)
+
+from batching import AdaptiveBatchSize, ProvinceBatchSizes, batch_sizes
+from checkpoint import (CHECKPOINT_KEYS, clear_checkpoints,
+                        ensure_checkpoint_table, get_checkpoint, keyed_chunks,
+                        resume_condition, set_checkpoint)
+from extract import (DEFAULT_FETCH_SIZE, build_select, date_window_filter,
+                     describe_view, explain_select, iter_batches,
+                     summarize_plan)
+from fingerprint import (FINGERPRINT_KEYS, RowDiff, diff_rows,
+                         ensure_fingerprint_table, get_fingerprints,
+                         key_condition)
+from indexes import BULK_LOAD_ROWS, bulk_load
+from loader import (DEFAULT_CHUNK_SIZE, TableWriter, check_insertable,
+                    ensure_conflict_indexes)
+from metrics import (ProvinceMetrics, StageMetrics, write_json_lines,
+                     write_prometheus_textfile)
+from mysql_pool import close_mysql_pool, mysql_connection
+from partitions import (PartitionWriter, check_partitioned,
+                        prepare_partition, swap_partitions)
+from pg_pool import close_pool, pg_connection
+from pipeline import interleave, prefetched
+from profiling import profile_stage, write_profile_summary
+from snapshot import materialize_view, snapshot_table
+from spool import (DEFAULT_SPOOL_DIR, read_spool, read_spool_header,
+                   spool_batches, spool_path)
+from mappings import (CV_ACIMA_DE_1000, ELEGIVEIS_CV, MARCADOS_LEVANTAMENTO,
+                      MARCADOS_SEGUIMENTO, VISIT_MAPPINGS,
+                      VISIT_UNIQUE_COLUMNS, UniqueRows, ViewMapping,
+                      compile_batch_transformer, project, source_indexes,
+                      transform_batches)
+from watermark import (WATERMARK_COLUMNS, HighWatermark,
+                       ensure_watermark_table, get_watermarks,
+                       watermark_column, watermark_condition)
 
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Provinces synced by a default run
+PROVINCES = ["Sofala", "Manica", "Niassa", "Tete"]
+
+# Rows pulled per fetchmany() call on the MySQL views
+FETCH_SIZE = int(os.getenv('MYSQL_FETCH_SIZE', DEFAULT_FETCH_SIZE))
+
 
 def create_config(province: str) -> Tuple[Dict[str, Union[str, int, bool, None]],
                                           Dict[str, Union[str, int, None]]]:
@@ -33,6 +77,7 @@ def create_config(province: str) -> Tuple[Dict[str, Union[str, int, bool, None]]
         'ssl_key': ssl_config['key'],
         'ssl_verify_cert': False,  # Verify server certificate
         'ssl_disabled': False,  # Enable SSL
+        'buffered': False,  # Stream results instead of buffering the view
     }
 
     # PostgreSQL connection configuration
@@ -47,191 +92,650 @@ def create_config(province: str) -> Tuple[Dict[str, Union[str, int, bool, None]]
     return mysql_config, pg_config
 
 
-def fetch_and_insert_elegiveis_cv(province: str, mysql_cursor, pg_cursor):
+class SyncOptions(NamedTuple):
+    """Run-wide options shared by every province."""
+    fetch_size: int = FETCH_SIZE
+    incremental: bool = False
+    # 'insert' appends a snapshot, 'upsert' merges through a staging table
+    # and 'swap' replaces the province's daily partitions
+    load_mode: str = 'insert'
+    # Select only consumed columns, through prepared statements
+    pushdown: bool = True
+    # Restrict the marcados views to their upcoming appointment window
+    date_window: bool = False
+    # Batches extracted ahead of the PostgreSQL writer (0 = no pipelining)
+    pipeline_depth: int = 0
+    # Extract the views of a province concurrently, one connection each
+    parallel_views: bool = False
+    # Commit every this many rows and resume after the last commit on a
+    # rerun the same day (0 = one transaction per province)
+    checkpoint_rows: int = 0
+    # Write per-stage cProfile and tracemalloc reports here, if set
+    profile_dir: Optional[str] = None
+    # '' reads MySQL and loads PostgreSQL; 'tee' also spools the raw rows,
+    # 'write' only spools them and 'read' loads from the spool instead
+    spool: str = ''
+    spool_dir: str = DEFAULT_SPOOL_DIR
+    # Run date of the spool read back, when not today's
+    spool_date: Optional[date] = None
+    # Tune each province's COPY chunk size while it runs
+    adaptive_batches: bool = False
+    # Load stages to run, by name (empty = all of them)
+    stages: Tuple[str, ...] = ()
+    # Only extract rows whose fingerprint changed since the last load
+    diff: bool = False
+    # Extract from indexed snapshot tables of the views, refreshed on the
+    # MySQL server first, instead of from the views themselves
+    materialize: bool = False
+    # Capture MySQL's plan of every extraction query for the run report
+    explain: bool = False
+
+
+DEFAULT_OPTIONS = SyncOptions()
+
+
+class ExtractPlan(NamedTuple):
+    """How a view is queried and how its rows map to the target."""
+    query: str
+    params: Tuple
+    # The mapping rewritten for the selected columns
+    mapping: ViewMapping
+    watermark: Optional[HighWatermark]
+    # Positions of the checkpoint key in each row, when checkpointing
+    key_indexes: Tuple[int, ...] = ()
+    # Positions in the view of the selected columns (None = all of them)
+    source_indexes: Optional[Tuple[int, ...]] = None
+    # With a row diff, the (query, params) fetching the changed rows a
+    # group of keys at a time, run instead of `query` (None = run query)
+    key_queries: Optional[Tuple[Tuple[str, Tuple], ...]] = None
+    diff: Optional[RowDiff] = None
+
+
+def window_condition(mapping: ViewMapping,
+                     options: SyncOptions = DEFAULT_OPTIONS
+                     ) -> Tuple[str, Tuple]:
+    """Build a view's date-window condition, if the window is on."""
+    if options.date_window and mapping.date_column:
+        return date_window_filter(mapping.date_column, mapping.window_days)
+    return '', ()
+
+
+def source_table(mapping: ViewMapping,
+                 options: SyncOptions = DEFAULT_OPTIONS) -> str:
+    """Return what a view's rows are extracted from: the view itself, or
+    its snapshot table when materializing."""
+    if options.materialize:
+        return snapshot_table(mapping.view)
+    return mapping.view
+
+
+def needs_names(mapping: ViewMapping,
+                options: SyncOptions = DEFAULT_OPTIONS) -> bool:
+    """Whether planning a view needs its column names from MySQL."""
+    return (options.pushdown or options.diff
+            or (options.incremental and mapping.view in WATERMARK_COLUMNS))
+
+
+def build_plan(mapping: ViewMapping, options: SyncOptions = DEFAULT_OPTIONS,
+               since: Optional[Any] = None,
+               names: Optional[Sequence[str]] = None,
+               resume_after: Optional[Sequence] = None,
+               diff: Optional[RowDiff] = None,
+               source: Optional[str] = None) -> ExtractPlan:
+    """Build the extraction query for a mapped view.
+
+    `since` is the view's stored watermark, `names` its column names,
+    `resume_after` the last committed checkpoint key and `diff` the keys
+    changed since the last load, all looked up by the caller. The rows
+    are selected from `source` (by default the view). With names given
+    and pushdown enabled only the consumed columns are selected and the
+    mapping is rewritten to match; the watermark, date-window and
+    checkpoint filters become WHERE conditions. Unless the diff asks for
+    the whole view, only the rows of its changed keys are fetched.
+    """
+    conditions, params = [], []
+    watermark_index, watermark_name = None, None
+    if options.incremental and mapping.view in WATERMARK_COLUMNS:
+        if names is None:
+            raise ValueError(f"Incremental extraction of {mapping.view} "
+                             f"needs the view's column names")
+        # Only extract rows newer than the last successful run
+        watermark_name = watermark_column(mapping.view, names)
+        condition, values = watermark_condition(watermark_name, since)
+        if condition:
+            conditions.append(condition)
+            params.extend(values)
+        watermark_index = WATERMARK_COLUMNS[mapping.view]
+    condition, values = window_condition(mapping, options)
+    if condition:
+        conditions.append(condition)
+        params.extend(values)
+    order_by, key_indexes = (), ()
+    if options.checkpoint_rows and mapping.view in CHECKPOINT_KEYS:
+        # Sort by the checkpoint key so a rerun can skip committed rows
+        condition, values = resume_condition(mapping.view, resume_after)
+        if condition:
+            conditions.append(condition)
+            params.extend(values)
+        order_by = [column for column, _ in CHECKPOINT_KEYS[mapping.view]]
+        key_indexes = tuple(index for _, index
+                            in CHECKPOINT_KEYS[mapping.view])
+
+    columns, selected = None, None
+    if names is not None and options.pushdown:
+        indexes = set(source_indexes(mapping))
+        if watermark_index is not None:
+            indexes.add(watermark_index)
+        indexes.update(key_indexes)
+        indexes = sorted(indexes)
+        columns = [names[index] for index in indexes]
+        if watermark_index is not None:
+            watermark_index = indexes.index(watermark_index)
+        key_indexes = tuple(indexes.index(index) for index in key_indexes)
+        mapping = project(mapping, indexes)
+        selected = tuple(indexes)
+
+    source = source or mapping.view
+    key_queries = None
+    if diff is not None and not diff.full_fetch:
+        key_columns = [column for column, _ in FINGERPRINT_KEYS[mapping.view]]
+        key_queries = tuple(
+            (build_select(source, columns,
+                          conditions + [key_condition(key_columns,
+                                                      len(keys))],
+                          order_by),
+             tuple(params) + tuple(chain.from_iterable(keys)))
+            for keys in diff.key_batches())
+
+    watermark = (HighWatermark(mapping.view, watermark_name, watermark_index)
+                 if watermark_index is not None else None)
+    return ExtractPlan(build_select(source, columns, conditions, order_by),
+                       tuple(params), mapping, watermark, key_indexes,
+                       selected, key_queries, diff)
+
+
+def run_date(options: SyncOptions = DEFAULT_OPTIONS) -> date:
+    """Return the date a run loads its snapshot for."""
+    return options.spool_date or date.today()
+
+
+def plan_from_spool(mapping: ViewMapping, province: str,
+                    options: SyncOptions = DEFAULT_OPTIONS) -> ExtractPlan:
+    """Plan loading a view from its spool instead of querying MySQL.
+
+    The mapping is projected onto the spooled columns, and the
+    watermark is taken from the spooled rows when running incrementally.
+    """
+    header = read_spool_header(spool_path(options.spool_dir, province,
+                                          mapping.view, run_date(options)))
+    selected = header['source_indexes']
+    if selected is not None:
+        mapping = project(mapping, selected)
+    watermark = None
+    if options.incremental and header['watermark_index'] is not None:
+        index = header['watermark_index']
+        watermark = HighWatermark(mapping.view, header['columns'][index],
+                                  index)
+    return ExtractPlan(header['query'], (), mapping, watermark, (), selected)
+
+
+class LoadState(NamedTuple):
+    """What the previous loads of a view left in PostgreSQL."""
+    # Stored watermarks, by column name
+    watermarks: Dict[str, Any] = {}
+    # Stored row fingerprints, when diffing
+    fingerprints: Optional[Dict[str, str]] = None
+
+
+def load_state(mapping: ViewMapping, province: str, pg_cursor,
+               options: SyncOptions = DEFAULT_OPTIONS) -> LoadState:
+    """Look up the stored state planning a view's extraction needs."""
+    watermarks = {}
+    if options.incremental and mapping.view in WATERMARK_COLUMNS:
+        watermarks = get_watermarks(pg_cursor, province, mapping.view)
+    fingerprints = None
+    if options.diff and mapping.view in FINGERPRINT_KEYS:
+        fingerprints = get_fingerprints(pg_cursor, province, mapping.view)
+    return LoadState(watermarks, fingerprints)
+
+
+def plan_source(mapping: ViewMapping, province: str, mysql_cursor,
+                state: LoadState, options: SyncOptions = DEFAULT_OPTIONS,
+                resume_after: Optional[Sequence] = None) -> ExtractPlan:
+    """Plan a view's extraction from its stored state.
+
+    Only MySQL is queried, so this can run in a reader thread. With
+    pushdown enabled the column names come from the view's description,
+    so only the consumed columns are selected. With options.diff the
+    view is first fingerprinted in MySQL and compared with the last
+    load.
+    """
+    source = source_table(mapping, options)
+    names = (describe_view(mysql_cursor, source)
+             if needs_names(mapping, options) else None)
+    since = None
+    if options.incremental and mapping.view in WATERMARK_COLUMNS:
+        since = state.watermarks.get(watermark_column(mapping.view, names))
+    diff = None
+    if state.fingerprints is not None:
+        condition, values = window_condition(mapping, options)
+        diff = diff_rows(mysql_cursor, state.fingerprints, mapping.view,
+                         [names[index] for index in source_indexes(mapping)],
+                         [condition] if condition else [], values, source)
+        print(f"Diffed {mapping.view} in {province}: {diff.describe()}")
+    return build_plan(mapping, options, since, names, resume_after, diff,
+                      source)
+
+
+def plan_extract(mapping: ViewMapping, province: str,
+                 mysql_cursor, pg_cursor,
+                 options: SyncOptions = DEFAULT_OPTIONS,
+                 resume_after: Optional[Sequence] = None) -> ExtractPlan:
+    """Look up a view's stored state, then plan its extraction.
+
+    When reading from the spool, MySQL is not queried at all.
+    """
+    if options.spool == 'read':
+        return plan_from_spool(mapping, province, options)
+    return plan_source(mapping, province, mysql_cursor,
+                       load_state(mapping, province, pg_cursor, options),
+                       options, resume_after)
+
+
+class ExtractStream(NamedTuple):
+    """Transformed row batches flowing out of one view."""
+    mapping: ViewMapping
+    batches: Iterator[List[Tuple]]
+    watermark: Optional[HighWatermark]
+    diff: Optional[RowDiff] = None
+
+
+def extract(mapping: ViewMapping, province: str, mysql_cursor, pg_cursor,
+            options: SyncOptions = DEFAULT_OPTIONS) -> ExtractStream:
+    """Run the extraction query for a view and stream its transformed rows."""
+    plan = plan_extract(mapping, province, mysql_cursor, pg_cursor, options)
+    return run_plan(plan, province, mysql_cursor, options)
+
+
+def province_batch_sizes(province: str,
+                         options: SyncOptions = DEFAULT_OPTIONS
+                         ) -> Optional[ProvinceBatchSizes]:
+    """Return the adaptive batch sizes of a province, if enabled."""
+    if not options.adaptive_batches:
+        return None
+    return batch_sizes(province, DEFAULT_CHUNK_SIZE)
+
+
+def write_batch_size(province: str, options: SyncOptions = DEFAULT_OPTIONS
+                     ) -> Optional[AdaptiveBatchSize]:
+    """Return the adaptive COPY chunk size of a province, if enabled."""
+    sizes = province_batch_sizes(province, options)
+    return sizes.write if sizes else None
+
+
+def source_batches(plan: ExtractPlan, province: str, mysql_cursor,
+                   options: SyncOptions = DEFAULT_OPTIONS
+                   ) -> Iterator[List[Tuple]]:
+    """Stream the raw rows of a planned extraction, spooling if asked.
+
+    With options.spool == 'read' the rows come from the spool file
+    rather than MySQL.
+    """
+    path = spool_path(options.spool_dir, province, plan.mapping.view,
+                      run_date(options))
+    if options.spool == 'read':
+        return read_spool(path)
+    if plan.key_queries is not None:
+        return changed_batches(plan, province, mysql_cursor, options)
+    mysql_cursor.execute(plan.query, plan.params or None)
+
+    # Stream rows in fetchmany batches instead of materializing the view
+    batches = iter_batches(mysql_cursor, options.fetch_size)
+    if options.spool in ('tee', 'write'):
+        header = {
+            'province': province,
+            'view': plan.mapping.view,
+            'run_date': run_date(options).isoformat(),
+            'query': plan.query,
+            'columns': [column[0] for column in mysql_cursor.description],
+            'source_indexes': plan.source_indexes,
+            'watermark_index': (plan.watermark.index if plan.watermark
+                                else None),
+        }
+        batches = spool_batches(path, header, batches)
+    return batches
+
+
+def changed_batches(plan: ExtractPlan, province: str, mysql_cursor,
+                    options: SyncOptions = DEFAULT_OPTIONS
+                    ) -> Iterator[List[Tuple]]:
+    """Stream the rows of a diffed view's changed keys, query by query."""
+    for query, params in plan.key_queries:
+        mysql_cursor.execute(query, params)
+        yield from iter_batches(mysql_cursor, options.fetch_size)
+
+
+def run_plan(plan: ExtractPlan, province: str, mysql_cursor,
+             options: SyncOptions = DEFAULT_OPTIONS) -> ExtractStream:
+    """Run a planned extraction and stream its transformed rows."""
+    batches = source_batches(plan, province, mysql_cursor, options)
+    if plan.watermark:
+        batches = plan.watermark.observe(batches)
+
+    batches = transform_batches(plan.mapping, batches, province=province,
+                                created_at=run_date(options))
+    return ExtractStream(plan.mapping, batches, plan.watermark, plan.diff)
+
+
+def create_writer(mapping: ViewMapping, province: str, pg_cursor,
+                  options: SyncOptions = DEFAULT_OPTIONS) -> TableWriter:
+    """Create the PostgreSQL writer for a view's target table."""
+    if options.load_mode == 'swap':
+        return PartitionWriter(pg_cursor, mapping.table,
+                               mapping.target_columns, province,
+                               run_date(options))
+    if options.load_mode == 'upsert':
+        return TableWriter(pg_cursor, mapping.table, mapping.target_columns,
+                           staging=f'stage_{mapping.view}',
+                           conflict_columns=mapping.conflict_columns,
+                           update_columns=mapping.update_columns,
+                           reset_columns=mapping.reset_columns)
+    return TableWriter(pg_cursor, mapping.table, mapping.target_columns)
+
+
+def fetch_and_insert(mapping: ViewMapping, province: str,
+                     mysql_cursor, pg_cursor,
+                     options: SyncOptions = DEFAULT_OPTIONS) -> int:
+    """Fetch data from a mapped MySQL view and insert into PostgreSQL.
+
+    Returns the number of rows loaded.
+    """
+    if options.checkpoint_rows and mapping.view in CHECKPOINT_KEYS:
+        return fetch_and_insert_checkpointed(mapping, province, mysql_cursor,
+                                             pg_cursor, options)
+    stream = extract(mapping, province, mysql_cursor, pg_cursor, options)
+    # Stream transformed rows into PostgreSQL with COPY, reading and
+    # transforming the next batches meanwhile when pipelining
+    writer = create_writer(stream.mapping, province, pg_cursor, options)
+    with prefetched(stream.batches, options.pipeline_depth) as batches:
+        loaded = writer.load(chain.from_iterable(batches),
+                             batch_size=write_batch_size(province, options))
+    if stream.watermark:
+        stream.watermark.save(pg_cursor, province)
+    if stream.diff:
+        stream.diff.save(pg_cursor, province)
+    return loaded
+
+
+def fetch_and_insert_merged(mappings: Sequence[ViewMapping],
+                            unique_columns: Sequence[str], province: str,
+                            mysql_cursor, pg_cursor,
+                            options: SyncOptions = DEFAULT_OPTIONS) -> int:
+    """Load several views feeding one table as a single row stream.
+
+    The views are extracted one after another on the same cursor, and
+    rows whose unique_columns were already seen are dropped before they
+    reach the writer, so the table gets one COPY (or staging merge) pass
+    and no duplicates across the views. Returns the number of rows
+    loaded.
+    """
+    # Plan up front: with pipelining the queries run in the reader thread,
+    # which must not touch the PostgreSQL cursor
+    plans = [plan_extract(mapping, province, mysql_cursor, pg_cursor, options)
+             for mapping in mappings]
+    unique = UniqueRows(plans[0].mapping.target_columns, unique_columns)
+
+    def merged_batches() -> Iterator[List[Tuple]]:
+        for plan in plans:
+            stream = run_plan(plan, province, mysql_cursor, options)
+            with closing(stream.batches) as batches:
+                for batch in batches:
+                    yield unique.filter(batch)
+
+    writer = create_writer(plans[0].mapping, province, pg_cursor,
+                           options)
+    with prefetched(merged_batches(), options.pipeline_depth) as batches:
+        loaded = writer.load(chain.from_iterable(batches),
+                             batch_size=write_batch_size(province, options))
+    for plan in plans:
+        if plan.watermark:
+            plan.watermark.save(pg_cursor, province)
+        if plan.diff:
+            plan.diff.save(pg_cursor, province)
+    return loaded
+
+
+def fetch_and_insert_checkpointed(mapping: ViewMapping, province: str,
+                                  mysql_cursor, pg_cursor,
+                                  options: SyncOptions = DEFAULT_OPTIONS
+                                  ) -> int:
+    """Load a view in committed chunks, resuming after the last checkpoint.
+
+    Rows are extracted in checkpoint key order and committed every
+    `options.checkpoint_rows` rows together with the last key written,
+    so a failed run can be rerun the same day without extracting the
+    committed rows again. The watermark is only saved, and the view
+    marked done, once the whole view has been loaded.
+
+    Returns the number of rows loaded by this run.
+    """
+    today = date.today()
+    checkpoint = get_checkpoint(pg_cursor, province, mapping.view, today)
+    resume_after = None
+    if checkpoint and checkpoint.done:
+        print(f"Skipping {mapping.view} in {province}, already loaded today")
+        return 0
+    if checkpoint and checkpoint.last_key:
+        resume_after = checkpoint.last_key
+        print(f"Resuming {mapping.view} in {province} after {resume_after}")
+    plan = plan_extract(mapping, province, mysql_cursor, pg_cursor, options,
+                        resume_after)
+    mysql_cursor.execute(plan.query, plan.params or None)
+
+    batches = iter_batches(mysql_cursor, options.fetch_size)
+    if plan.watermark:
+        batches = plan.watermark.observe(batches)
+
+    transform = compile_batch_transformer(plan.mapping, province=province,
+                                          created_at=today)
+    loaded, last_key = 0, resume_after or ()
+    with prefetched(batches, options.pipeline_depth) as batches:
+        for rows, last_key in keyed_chunks(batches, plan.key_indexes,
+                                           options.checkpoint_rows):
+            writer = create_writer(plan.mapping, province, pg_cursor,
+                                   options)
+            loaded += writer.load(
+                transform(rows),
+                batch_size=write_batch_size(province, options))
+            set_checkpoint(pg_cursor, province, mapping.view, today,
+                           last_key)
+            pg_cursor.connection.commit()
+
+    if plan.watermark:
+        plan.watermark.save(pg_cursor, province)
+    set_checkpoint(pg_cursor, province, mapping.view, today, last_key,
+                   done=True)
+    pg_cursor.connection.commit()
+    return loaded
+
+
+def fetch_and_insert_parallel(mappings: Sequence[ViewMapping], province: str,
+                              mysql_config: Dict[str, Any], pg_cursor,
+                              options: SyncOptions = DEFAULT_OPTIONS,
+                              metrics: Optional[ProvinceMetrics] = None
+                              ) -> Dict[str, int]:
+    """Extract several views concurrently and load them on one connection.
+
+    Each view gets its own MySQL connection and reader thread, which
+    plans (describing and diffing the view) and runs its extraction.
+    All PostgreSQL work stays on the calling thread: stored state is
+    looked up up front and every write goes through the caller's
+    cursor, so the caller can still commit the province atomically.
+    Views sharing a target table
+    share its writer, which buffers their rows into COPY chunks of the
+    usual (or adaptive) size, and the visit views are deduplicated as in
+    fetch_and_insert_visits, keeping whichever row arrives first.
+    The whole load is recorded as a single 'parallel_views' stage.
+    Returns the rows loaded per target table.
+    """
+    metrics = metrics or ProvinceMetrics(province)
+    visit_views = {mapping.view for mapping in VISIT_MAPPINGS}
+    unique = UniqueRows(MARCADOS_LEVANTAMENTO.target_columns,
+                        VISIT_UNIQUE_COLUMNS)
+    with metrics.stage('parallel_views') as stage, \
+            profile_stage(options.profile_dir, province, 'parallel_views'), \
+            ExitStack() as stack:
+        pg_cursor = stage.pg_cursor(pg_cursor)
+        # Plans made by the reader threads, by view
+        plans: Dict[str, ExtractPlan] = {}
+
+        def planned_batches(mapping: ViewMapping, mysql_cursor,
+                            state: LoadState) -> Iterator[List[Tuple]]:
+            plan = plan_source(mapping, province, mysql_cursor, state,
+                               options)
+            plans[mapping.view] = plan
+            yield from run_plan(plan, province, mysql_cursor,
+                                options).batches
+
+        # One set of counters per reader thread, summed once they finish
+        readers = []
+        sources, writers = [], {}
+        for mapping in mappings:
+            state = load_state(mapping, province, pg_cursor, options)
+            mysql_cnx = metrics.connect('mysql', stack.enter_context,
+                                        mysql_connection(mysql_config))
+            reader = StageMetrics(province, mapping.view)
+            readers.append(reader)
+            mysql_cursor = reader.mysql_cursor(stack.enter_context(
+                mysql_cnx.cursor(prepared=options.pushdown)))
+            sources.append(planned_batches(mapping, mysql_cursor, state))
+            if mapping.table not in writers:
+                writer = create_writer(mapping, province, pg_cursor, options)
+                writer.begin()
+                writers[mapping.table] = writer
+
+        # Closed before the cursors, so the readers are joined first
+        depth = max(options.pipeline_depth, len(sources))
+        batches = stack.enter_context(closing(interleave(sources, depth)))
+        batch_size = write_batch_size(province, options)
+        for index, batch in batches:
+            mapping = mappings[index]
+            if mapping.view in visit_views:
+                batch = unique.filter(batch)
+            writers[mapping.table].feed(batch, batch_size=batch_size)
+
+        loaded = {table: writer.finish() for table, writer in writers.items()}
+        for plan in plans.values():
+            if plan.watermark:
+                plan.watermark.save(pg_cursor, province)
+            if plan.diff:
+                plan.diff.save(pg_cursor, province)
+        stage.rows_read = sum(reader.rows_read for reader in readers)
+        stage.bytes_read = sum(reader.bytes_read for reader in readers)
+        stage.fetch_seconds = sum(reader.fetch_seconds for reader in readers)
+        stage.rows_written = sum(loaded.values())
+        return loaded
+
+
+def fetch_and_insert_elegiveis_cv(province: str, mysql_cursor, pg_cursor,
+                                  options: SyncOptions = DEFAULT_OPTIONS
+                                  ) -> int:
     """Fetch data from elegiveis_cv and insert into PostgreSQL."""
-    query = "SELECT * FROM elegiveis_cv"
-    mysql_cursor.execute(query)
-
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = province
-        health_facility = row[0]
-        district = row[1]
-        # patient_id = row[2]
-        patient_identifier = row[3]
-        patient_name = row[5]
-        age = row[7]
-        phone_number = row[8] if row[8] is not None else row[9]
-        community = row[12]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_patienteligiblevlcollection (province,district,
-            community,health_facility,
-            patient_name, patient_identifier, age,
-            phone_number, created_at, sent)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, community, health_facility,
-               patient_name, patient_identifier, age,
-               phone_number, created_at, sent))
-
-
-def fetch_and_insert_carga_viral_alta(province: str, mysql_cursor, pg_cursor):
+    return fetch_and_insert(ELEGIVEIS_CV, province, mysql_cursor, pg_cursor,
+                            options)
+
+
+def fetch_and_insert_carga_viral_alta(province: str, mysql_cursor, pg_cursor,
+                                      options: SyncOptions = DEFAULT_OPTIONS
+                                      ) -> int:
     """Fetch data from carga viral acima de 1000 and insert into PostgreSQL."""
-    # Execute MySQL query
-    query = "SELECT * FROM cv_acima_de_1000"
-    mysql_cursor.execute(query)
-
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = province
-        district = row[1]
-        health_facility = row[0]
-        #   patient_id = row[0]
-        patient_identifier = row[3]
-        patient_name = row[4]
-        # gender = row[5]
-        age = row[6]
-        phone_number = row[19] if row[19] is not None else row[20]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_viralloadtestresult (
-                province, district, health_facility,
-                patient_name, patient_identifier,
-                age, phone_number, created_at, sent
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, health_facility,
-               patient_name, patient_identifier,
-               age, phone_number, created_at, sent))
-
-
-def fetch_and_insert_marcados_levantamento(province: str, mysql_cursor, pg_cursor):
+    return fetch_and_insert(CV_ACIMA_DE_1000, province, mysql_cursor,
+                            pg_cursor, options)
+
+
+def fetch_and_insert_marcados_levantamento(province: str, mysql_cursor, pg_cursor,
+                                           options: SyncOptions = DEFAULT_OPTIONS
+                                           ) -> int:
     """Fetch data from marcados_para_o_levantamento 
     and insert into PostgreSQL."""
 
-    # Check if today is Friday (4 in weekday() since Monday is 0)
-    # if date.today().weekday() == 4:
-    #     start_date = date.today() + timedelta(days=4)
-    # else:
-    #     start_date = date.today() + timedelta(days=2)
-
-    # end_date = date.today() + timedelta(days=14)
-
-    query = "SELECT * FROM marcados_levantamento"  # \
-    #    WHERE next_dispensing_date >= %s AND next_dispensing_date <= %s"
-    # mysql_cursor.execute(query, (start_date, end_date))
-    mysql_cursor.execute(query)
-
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        district = row[4]
-        health_facility = row[1]
-        patient_identifier = row[10]
-        patient_name = row[9]
-        gender = row[11]
-        age = row[12]
-        # phone_number = row[13]
-        # Check if row[13] is None and assign phone_number accordingly
-        phone_number = row[13] if row[13] is not None else row[14]
-        appointment_date = datetime.strptime(
-            str(row[2]), '%Y-%m-%d %H:%M:%S')
-        next_appointment_date = datetime.strptime(
-            str(row[3]), '%Y-%m-%d %H:%M:%S')
-        community = row[7]
-        pregnant = row[15]
-        breastfeeding = row[16]
-        tb = row[17]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_visit (
-                province, district, health_facility,
-                patient_name, patient_identifier,
-                age, phone_number, appointment_date,
-                next_appointment_date, gender, community,
-                pregnant, breastfeeding, tb, created_at, sent
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, health_facility,
-               patient_name, patient_identifier,
-               age, phone_number, appointment_date,
-               next_appointment_date, gender, community,
-               pregnant, breastfeeding, tb, created_at, sent))
+    # Only upcoming appointments are extracted when the date window is on,
+    # see extract.date_window
+    return fetch_and_insert(MARCADOS_LEVANTAMENTO, province, mysql_cursor,
+                            pg_cursor, options)
 
 
 def fetch_and_insert_marcados_seguimento(province: str,
-                                         mysql_cursor, pg_cursor):
+                                         mysql_cursor, pg_cursor,
+                                         options: SyncOptions = DEFAULT_OPTIONS
+                                         ) -> int:
     """Fetch data from marcados_para_a consulta
     and insert into PostgreSQL."""
 
-    # Check if today is Friday (4 in weekday() since Monday is 0)
-    # if date.today().weekday() == 4:
-    #     start_date = date.today() + timedelta(days=4)
-    # else:
-    #     start_date = date.today() + timedelta(days=2)
-
-    # end_date = date.today() + timedelta(days=7)
-
-    query = "SELECT * FROM marcados_seguimento"  # \
-    #    WHERE next_appointment_date >= %s AND next_appointment_date <= %s"
-    # mysql_cursor.execute(query, (start_date, end_date))
-    mysql_cursor.execute(query)
-
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = province
-        district = row[4]
-        health_facility = row[1]
-        # patient_id = row[0]
-        patient_identifier = row[10]
-        patient_name = row[9]
-        gender = row[11]
-        age = row[12]
-        # phone_number = row[13]
-        # Check if row[13] is None and assign phone_number accordingly
-        phone_number = row[13] if row[13] is not None else row[14]
-        appointment_date = datetime.strptime(
-            str(row[2]), '%Y-%m-%d %H:%M:%S')
-        next_appointment_date = datetime.strptime(
-            str(row[3]), '%Y-%m-%d %H:%M:%S')
-        community = row[7]
-        pregnant = row[15]
-        breastfeeding = row[16]
-        tb = row[17]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_visit (
-                province, district, health_facility,
-                patient_name, patient_identifier,
-                age, phone_number, appointment_date,
-                next_appointment_date, gender, community,
-                pregnant, breastfeeding, tb, created_at, sent
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, health_facility,
-               patient_name, patient_identifier,
-               age, phone_number, appointment_date,
-               next_appointment_date, gender, community,
-               pregnant, breastfeeding, tb, created_at, sent))
+    # Only upcoming appointments are extracted when the date window is on,
+    # see extract.date_window
+    return fetch_and_insert(MARCADOS_SEGUIMENTO, province, mysql_cursor,
+                            pg_cursor, options)
+
+
+def fetch_and_insert_visits(province: str, mysql_cursor, pg_cursor,
+                            options: SyncOptions = DEFAULT_OPTIONS) -> int:
+    """Fetch both marcados views and insert them into core_visit in one pass.
+
+    A patient's visit on a given date is only loaded once, even when
+    both views announce it.
+    """
+    if options.checkpoint_rows:
+        # Checkpoints resume view by view, so load the views separately
+        return sum(fetch_and_insert(mapping, province, mysql_cursor,
+                                    pg_cursor, options)
+                   for mapping in VISIT_MAPPINGS)
+    return fetch_and_insert_merged(VISIT_MAPPINGS, VISIT_UNIQUE_COLUMNS,
+                                   province, mysql_cursor, pg_cursor, options)
+
+
+# Load stages run by sync_province, in order
+STAGES = (
+    ('elegiveis_cv', fetch_and_insert_elegiveis_cv),
+    ('cv_acima_de_1000', fetch_and_insert_carga_viral_alta),
+    ('core_visit', fetch_and_insert_visits),
+)
+
+# Views loaded by each stage
+STAGE_MAPPINGS = {
+    'elegiveis_cv': (ELEGIVEIS_CV,),
+    'cv_acima_de_1000': (CV_ACIMA_DE_1000,),
+    'core_visit': VISIT_MAPPINGS,
+}
+
+
+def selected_stages(options: SyncOptions = DEFAULT_OPTIONS
+                    ) -> List[Tuple[str, Any]]:
+    """Return the (name, function) of the stages a run includes."""
+    return [(name, stage) for name, stage in STAGES
+            if not options.stages or name in options.stages]
+
+
+def selected_mappings(options: SyncOptions = DEFAULT_OPTIONS
+                      ) -> List[ViewMapping]:
+    """Return the views loaded by the stages a run includes."""
+    return [mapping for name, _ in selected_stages(options)
+            for mapping in STAGE_MAPPINGS[name]]
+
+
+def target_tables(options: SyncOptions = DEFAULT_OPTIONS) -> List[str]:
+    """Return the tables loaded by the stages a run includes."""
+    return list(dict.fromkeys(mapping.table
+                              for mapping in selected_mappings(options)))
+
+
+def run_kind(options: SyncOptions = DEFAULT_OPTIONS) -> str:
+    """Name the kind of run, whose loads are of comparable size."""
+    if options.incremental:
+        return 'incremental'
+    if options.diff:
+        return 'diff'
+    return 'full'
 
 
 # def fetch_and_insert_marcados_seguimento7d(province: str,
@@ -285,31 +789,536 @@ def fetch_and_insert_marcados_seguimento(province: str,
 #                pregnant, breastfeeding, tb, created_at, sent))
 
 
-def main(province: str):
-    """Main function to fetch data from MySQL and insert into PostgreSQL."""
+def spool_view(mapping: ViewMapping, province: str, mysql_cursor,
+               options: SyncOptions = DEFAULT_OPTIONS) -> int:
+    """Extract a view into its spool file without loading it.
+
+    No watermark is applied, so the spool holds the whole view (within
+    the date window, if enabled). Returns the number of rows spooled.
+    """
+    source = source_table(mapping, options)
+    names = (describe_view(mysql_cursor, source)
+             if needs_names(mapping, options) else None)
+    plan = build_plan(mapping, options, None, names, source=source)
+    return sum(map(len, source_batches(plan, province, mysql_cursor,
+                                       options)))
+
+
+def prepare_sources(province: str, mysql_cnx, pg_cursor,
+                    options: SyncOptions = DEFAULT_OPTIONS,
+                    metrics: Optional[ProvinceMetrics] = None):
+    """Materialize a province's views and capture their query plans.
+
+    With options.materialize every view is refreshed into its snapshot
+    table, timed as a 'materialize' stage, before anything is extracted.
+    With options.explain the plan of each view's extraction query is
+    stored in metrics.explains. pg_cursor is only used to look up
+    watermarks, and may be None when there are none.
+    """
+    metrics = metrics or ProvinceMetrics(province)
+    mappings = selected_mappings(options)
+    if options.materialize:
+        with metrics.stage('materialize'):
+            for mapping in mappings:
+                started = time.monotonic()
+                refresh = materialize_view(mysql_cnx, mapping)
+                print(f"Materialized {mapping.view} in {province} "
+                      f"({refresh}) in {time.monotonic() - started:.1f}s")
+    if options.explain:
+        with mysql_cnx.cursor() as mysql_cursor:
+            for mapping in mappings:
+                source = source_table(mapping, options)
+                names = (describe_view(mysql_cursor, source)
+                         if needs_names(mapping, options) else None)
+                since = None
+                if (options.incremental and pg_cursor is not None
+                        and mapping.view in WATERMARK_COLUMNS):
+                    since = get_watermarks(
+                        pg_cursor, province, mapping.view).get(
+                            watermark_column(mapping.view, names))
+                plan = build_plan(mapping, options, since, names,
+                                  source=source)
+                metrics.explains[mapping.view] = explain_select(
+                    mysql_cursor, plan.query, plan.params)
+
+
+def spool_province(province: str, options: SyncOptions = DEFAULT_OPTIONS,
+                   metrics: Optional[ProvinceMetrics] = None):
+    """Spool every view of one province, without touching PostgreSQL."""
+    mysql_config, _ = create_config(province)
+    metrics = metrics or ProvinceMetrics(province)
+    with ExitStack() as stack:
+        mysql_cnx = metrics.connect('mysql', stack.enter_context,
+                                    mysql_connection(mysql_config))
+        prepare_sources(province, mysql_cnx, None, options, metrics)
+        mysql_cursor = stack.enter_context(
+            mysql_cnx.cursor(prepared=options.pushdown))
+        for mapping in selected_mappings(options):
+            with metrics.stage(mapping.view) as stage, \
+                    profile_stage(options.profile_dir, province,
+                                  mapping.view):
+                stage.rows_written = spool_view(
+                    mapping, province, stage.mysql_cursor(mysql_cursor),
+                    options)
+
+
+def sync_province(province: str, options: SyncOptions = DEFAULT_OPTIONS,
+                  metrics: Optional[ProvinceMetrics] = None):
+    """Fetch data for one province from MySQL and insert into PostgreSQL.
+
+    Errors are raised to the caller; the PostgreSQL transaction is only
+    committed once every stage has succeeded, unless checkpoints are
+    enabled, in which case each stage commits its own chunks. Stage and
+    connection timings are recorded into `metrics`, if given.
+    """
+    if options.spool == 'write':
+        return spool_province(province, options, metrics)
     mysql_config, pg_config = create_config(province)
+    metrics = metrics or ProvinceMetrics(province)
+    mappings = selected_mappings(options)
+
+    with ExitStack() as stack:
+        pg_cnx = metrics.connect('postgresql', stack.enter_context,
+                                 pg_connection(pg_config))
+        pg_cursor = stack.enter_context(pg_cnx.cursor())
+
+        if options.incremental:
+            ensure_watermark_table(pg_cursor)
+        if options.checkpoint_rows:
+            ensure_checkpoint_table(pg_cursor)
+        if options.diff:
+            ensure_fingerprint_table(pg_cursor)
+        if options.load_mode == 'swap':
+            for table in target_tables(options):
+                check_partitioned(pg_cursor, table)
+        if (options.materialize or options.explain) \
+                and options.spool != 'read':
+            with ExitStack() as sources:
+                mysql_cnx = metrics.connect('mysql', sources.enter_context,
+                                            mysql_connection(mysql_config))
+                prepare_sources(province, mysql_cnx, pg_cursor, options,
+                                metrics)
+
+        if options.parallel_views:
+            fetch_and_insert_parallel(mappings, province, mysql_config,
+                                      pg_cursor, options, metrics)
+        else:
+            mysql_cursor = None
+            if options.spool != 'read':
+                mysql_cnx = metrics.connect('mysql', stack.enter_context,
+                                            mysql_connection(mysql_config))
+                mysql_cursor = stack.enter_context(
+                    mysql_cnx.cursor(prepared=options.pushdown))
+            for name, fetch_and_insert_stage in selected_stages(options):
+                with metrics.stage(name) as stage, \
+                        profile_stage(options.profile_dir, province, name):
+                    stage.rows_written = fetch_and_insert_stage(
+                        province, stage.mysql_cursor(mysql_cursor),
+                        stage.pg_cursor(pg_cursor), options)
+
+        if options.checkpoint_rows:
+            # The views are complete, so their next run starts afresh
+            clear_checkpoints(pg_cursor, province,
+                              [mapping.view for mapping in mappings])
+        if options.load_mode == 'swap':
+            with metrics.stage('partition_swap') as stage:
+                swap_province(province, stage.pg_cursor(pg_cursor), options)
+        pg_cnx.commit()
+
+
+def swap_province(province: str, pg_cursor,
+                  options: SyncOptions = DEFAULT_OPTIONS):
+    """Attach a province's loaded tables as its partitions for the day.
+
+    The loaded tables are made durable and indexed, and committed
+    together with the rest of the load; the swap then replaces the
+    previous partitions of every table in one short transaction, left
+    for the caller to commit.
+    """
+    tables, day = target_tables(options), run_date(options)
+    for table in tables:
+        prepare_partition(pg_cursor, table, province, day)
+    pg_cursor.connection.commit()
+    swap_partitions(pg_cursor, tables, province, day)
+
+
+class ProvinceResult(NamedTuple):
+    """Outcome of syncing a single province."""
+    province: str
+    ok: bool
+    elapsed: float
+    error: Optional[str] = None
+    stages: Tuple[StageMetrics, ...] = ()
+    connects: Tuple[Any, ...] = ()
+    # Adaptive batch sizes reached by the end of the run, if enabled
+    batch_sizes: Optional[Dict[str, int]] = None
+    # MySQL's plan of each view's extraction query, if captured
+    explains: Optional[Dict[str, List[Dict[str, Any]]]] = None
+
 
+def run_province(province: str,
+                 options: SyncOptions = DEFAULT_OPTIONS) -> ProvinceResult:
+    """Sync one province, capturing its outcome instead of raising."""
+    started = time.monotonic()
+    metrics = ProvinceMetrics(province)
+    error = None
     try:
-        with mysql.connector.connect(**mysql_config) as mysql_cnx, \
-                mysql_cnx.cursor() as mysql_cursor, \
-                psycopg2.connect(**pg_config) as pg_cnx, \
+        sync_province(province, options, metrics)
+    except Exception as e:
+        print(f"An error occurred in {province}: {e}")
+        error = str(e)
+    sizes = province_batch_sizes(province, options)
+    if sizes:
+        print(f"Batch sizes for {province}: {sizes.describe()}")
+    return ProvinceResult(province, error is None, time.monotonic() - started,
+                          error, tuple(metrics.stages),
+                          tuple(metrics.connects),
+                          sizes.as_dict() if sizes else None,
+                          dict(metrics.explains) or None)
+
+
+def prepare_targets(provinces: Sequence[str],
+                    options: SyncOptions = DEFAULT_OPTIONS):
+    """Prepare the target tables once, before any province loads them.
+
+    Upserts need each target's conflict index, which is only built when
+    missing and outside the provinces' transactions. Inserts are refused
+    into targets that have one.
+    """
+    if options.load_mode == 'swap' or options.spool == 'write':
+        return
+    # Every province loads into the same PostgreSQL database
+    _, pg_config = create_config(provinces[0])
+    if options.load_mode == 'insert':
+        with pg_connection(pg_config) as pg_cnx, \
                 pg_cnx.cursor() as pg_cursor:
+            check_insertable(pg_cursor, target_tables(options))
+        return
+    ensure_conflict_indexes(pg_config,
+                            [(mapping.table, mapping.conflict_columns)
+                             for mapping in selected_mappings(options)])
 
-            fetch_and_insert_elegiveis_cv(province, mysql_cursor, pg_cursor)
-            fetch_and_insert_carga_viral_alta(
-                province, mysql_cursor, pg_cursor)
-            fetch_and_insert_marcados_levantamento(
-                province, mysql_cursor, pg_cursor)
-            fetch_and_insert_marcados_seguimento(
-                province, mysql_cursor, pg_cursor)
 
-            pg_cnx.commit()
-    except Exception as e:
-        print(f"An error occurred: {e}")
+def main(province: str, options: SyncOptions = DEFAULT_OPTIONS) -> bool:
+    """Main function to fetch data from MySQL and insert into PostgreSQL."""
+    prepare_targets([province], options)
+    return run_province(province, options).ok
+
+
+def run_provinces(provinces: Sequence[str], workers: int = 1,
+                  executor: str = 'thread',
+                  options: SyncOptions = DEFAULT_OPTIONS
+                  ) -> List[ProvinceResult]:
+    """Sync several provinces, optionally in parallel.
+
+    A failure in one province never affects the others. With workers=1
+    the provinces run serially in the given order.
+    """
+    if workers <= 1 or len(provinces) <= 1:
+        return [run_province(province, options) for province in provinces]
+
+    pool_class = (ProcessPoolExecutor if executor == 'process'
+                  else ThreadPoolExecutor)
+    with pool_class(max_workers=min(workers, len(provinces))) as pool:
+        futures = {pool.submit(run_province, province, options): province
+                   for province in provinces}
+        results = {}
+        for future in as_completed(futures):
+            province = futures[future]
+            try:
+                results[province] = future.result()
+            except Exception as e:
+                # e.g. a worker process that died before reporting back
+                results[province] = ProvinceResult(province, False, 0.0, str(e))
+    return [results[province] for province in provinces]
+
+
+def print_summary(results: Sequence[ProvinceResult], elapsed: float):
+    """Print a consolidated summary of a multi-province run."""
+    print("Sync summary:")
+    for result in results:
+        status = "ok" if result.ok else "FAILED"
+        line = f"  {result.province:<10} {status:<7} {result.elapsed:8.1f}s"
+        if result.error:
+            line += f"  {result.error}"
+        print(line)
+        for stage in result.stages:
+            print(f"    {stage.stage:<16} {stage.rows_read:>9} read "
+                  f"{stage.rows_written:>9} written {stage.seconds:8.1f}s  "
+                  f"(fetch {stage.fetch_seconds:.1f}s, "
+                  f"transform {stage.transform_seconds:.1f}s, "
+                  f"write {stage.write_seconds:.1f}s)")
+        for view, steps in (result.explains or {}).items():
+            print(f"    explain {view:<30} {summarize_plan(steps)}")
+    failed = sum(1 for result in results if not result.ok)
+    print(f"{len(results) - failed}/{len(results)} provinces succeeded "
+          f"in {elapsed:.1f}s")
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse command line options for the sync run."""
+    parser = argparse.ArgumentParser(
+        description="Sync provincial MySQL views into PostgreSQL.")
+    parser.add_argument(
+        '--provinces', nargs='+', default=PROVINCES,
+        help="provinces to sync (default: %(default)s)")
+    parser.add_argument(
+        '--workers', type=int, default=int(os.getenv('SYNC_WORKERS', 1)),
+        help="number of provinces to sync in parallel (default: 1)")
+    parser.add_argument(
+        '--executor', choices=('thread', 'process'),
+        default=os.getenv('SYNC_EXECUTOR', 'thread'),
+        help="worker pool type used when --workers > 1")
+    parser.add_argument(
+        '--incremental', action='store_true',
+        default=os.getenv('SYNC_INCREMENTAL', '') == '1',
+        help="only extract visits recorded since the last successful run, "
+             "less SYNC_WATERMARK_LOOKBACK_DAYS (needs --load-mode upsert)")
+    parser.add_argument(
+        '--load-mode', choices=('insert', 'upsert', 'swap'),
+        default=os.getenv('SYNC_LOAD_MODE', 'insert'),
+        help="append a daily snapshot, or merge into the targets through "
+             "staging tables so reruns are no-ops, or load each province's "
+             "day into an UNLOGGED table swapped in as its partition of "
+             "the targets (default: %(default)s)")
+    parser.add_argument(
+        '--no-pushdown', dest='pushdown', action='store_false',
+        default=os.getenv('SYNC_PUSHDOWN', '1') != '0',
+        help="run plain SELECT * queries instead of prepared statements "
+             "selecting only the consumed columns")
+    parser.add_argument(
+        '--date-window', action='store_true',
+        default=os.getenv('SYNC_DATE_WINDOW', '') == '1',
+        help="only extract appointments in the upcoming reminder window")
+    parser.add_argument(
+        '--pipeline-depth', type=int,
+        default=int(os.getenv('SYNC_PIPELINE_DEPTH', 0)),
+        help="overlap MySQL reads with PostgreSQL writes, buffering up to "
+             "this many batches (default: 0, no overlap)")
+    parser.add_argument(
+        '--parallel-views', action='store_true',
+        default=os.getenv('SYNC_PARALLEL_VIEWS', '') == '1',
+        help="extract each province's views concurrently on separate "
+             "MySQL connections")
+    parser.add_argument(
+        '--engine', choices=('sync', 'async'),
+        default=os.getenv('SYNC_ENGINE', 'sync'),
+        help="thread-based engine, or drive every province and view on "
+             "one asyncio event loop (needs aiomysql and asyncpg)")
+    parser.add_argument(
+        '--async-concurrency', type=int,
+        default=int(os.getenv('SYNC_ASYNC_CONCURRENCY', 8)),
+        help="views extracted at once by the async engine (default: 8)")
+    parser.add_argument(
+        '--checkpoint-rows', type=int,
+        default=int(os.getenv('SYNC_CHECKPOINT_ROWS', 0)),
+        help="commit every this many rows and let a failed run resume "
+             "after the last commit when rerun the same day; views are "
+             "then extracted in key order (default: 0, one transaction "
+             "per province)")
+    parser.add_argument(
+        '--metrics-json', metavar='PATH',
+        default=os.getenv('SYNC_METRICS_JSON'),
+        help="append per-stage and per-connection metrics to this JSON "
+             "lines file")
+    parser.add_argument(
+        '--metrics-textfile', metavar='PATH',
+        default=os.getenv('SYNC_METRICS_TEXTFILE'),
+        help="write the run's metrics to this Prometheus textfile, e.g. in "
+             "the node exporter's textfile collector directory")
+    parser.add_argument(
+        '--profile', metavar='DIR', default=os.getenv('SYNC_PROFILE_DIR'),
+        help="profile every province and stage with cProfile and "
+             "tracemalloc, writing dumps and hotspot summaries into a "
+             "per-run subdirectory of DIR")
+    parser.add_argument(
+        '--spool', choices=('tee', 'write', 'read'),
+        default=os.getenv('SYNC_SPOOL', '') or None,
+        help="'tee' keeps a compressed local copy of every extracted view "
+             "while syncing, 'write' only extracts views into the spool, "
+             "'read' loads PostgreSQL from the spool without touching MySQL")
+    parser.add_argument(
+        '--spool-dir', default=os.getenv('SYNC_SPOOL_DIR', DEFAULT_SPOOL_DIR),
+        help="directory holding the spool files (default: %(default)s)")
+    parser.add_argument(
+        '--spool-date', type=date.fromisoformat,
+        help="with --spool read, replay the spool of this YYYY-MM-DD run "
+             "date instead of today's")
+    parser.add_argument(
+        '--adaptive-batches', action='store_true',
+        default=os.getenv('SYNC_ADAPTIVE_BATCHES', '') == '1',
+        help="tune each province's COPY chunk size from measured latency "
+             "and throughput, within SYNC_BATCH_MEMORY_MB per chunk")
+    parser.add_argument(
+        '--diff', action='store_true',
+        default=os.getenv('SYNC_DIFF', '') == '1',
+        help="fingerprint every row in MySQL and only transfer rows that "
+             "are new or changed since the last load (needs --load-mode "
+             "upsert)")
+    parser.add_argument(
+        '--bulk-load', action='store_true',
+        default=os.getenv('SYNC_BULK_LOAD', '') == '1',
+        help="drop the target tables' secondary indexes before a large "
+             "run, then rebuild them concurrently and ANALYZE the tables")
+    parser.add_argument(
+        '--bulk-load-rows', type=int, default=BULK_LOAD_ROWS,
+        help="with --bulk-load, only drop indexes when the last run of "
+             "the same kind (full, incremental or diff) wrote at least "
+             "this many rows (default: %(default)s)")
+    parser.add_argument(
+        '--materialize', action='store_true',
+        default=os.getenv('SYNC_MATERIALIZE', '') == '1',
+        help="first refresh an indexed snapshot table of every view on the "
+             "MySQL server (incrementally where the view has a date "
+             "column) and extract from it; needs CREATE and DROP rights")
+    parser.add_argument(
+        '--explain', action='store_true',
+        default=os.getenv('SYNC_EXPLAIN', '') == '1',
+        help="capture MySQL's EXPLAIN of every extraction query in the run "
+             "summary and metrics")
+    parser.add_argument(
+        '--stages', nargs='+', choices=[name for name, _ in STAGES],
+        default=os.getenv('SYNC_STAGES', '').split() or None,
+        help="only sync these stages (default: all)")
+    parser.add_argument(
+        '--daemon', action='store_true',
+        default=os.getenv('SYNC_DAEMON', '') == '1',
+        help="keep running, syncing every province on a schedule over warm "
+             "pooled connections until SIGTERM or SIGINT; needs --load-mode "
+             "upsert or swap, since each insert run would append another "
+             "full copy of the targets")
+    parser.add_argument(
+        '--interval', default=os.getenv('SYNC_INTERVAL', '1h'),
+        help="with --daemon, how often each province and stage is synced, "
+             "e.g. 90s, 30m or 6h (default: %(default)s)")
+    parser.add_argument(
+        '--schedule', nargs='+', metavar='[PROVINCE][/STAGE]=INTERVAL',
+        default=os.getenv('SYNC_SCHEDULE', '').split(),
+        help="with --daemon, per-province and per-stage intervals "
+             "overriding --interval, e.g. Niassa=2h /core_visit=30m "
+             "Sofala/core_visit=15m")
+    parser.add_argument(
+        '--health-interval', type=float,
+        default=float(os.getenv('SYNC_HEALTH_INTERVAL', 60)),
+        help="with --daemon, seconds between pings of idle pooled MySQL "
+             "connections (default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.incremental and args.load_mode != 'upsert':
+        parser.error("--incremental extracts an overlapping lookback, so it "
+                     "needs --load-mode upsert")
+    if args.diff and (args.load_mode != 'upsert' or args.incremental
+                      or args.checkpoint_rows or args.spool
+                      or args.engine == 'async'):
+        parser.error("--diff needs the sync engine with --load-mode upsert, "
+                     "without --incremental, --checkpoint-rows or --spool")
+    if args.bulk_load and (args.daemon or args.spool == 'write'
+                           or args.load_mode == 'swap'):
+        parser.error("--bulk-load only applies to single runs loading "
+                     "PostgreSQL, not --daemon, --spool write or "
+                     "--load-mode swap")
+    if args.load_mode == 'swap' and (args.incremental or args.checkpoint_rows
+                                     or args.engine == 'async'):
+        parser.error("--load-mode swap replaces whole daily partitions, so "
+                     "it needs the sync engine without --incremental or "
+                     "--checkpoint-rows")
+    if (args.materialize or args.explain) and args.engine == 'async':
+        parser.error("--materialize and --explain need the sync engine")
+    if args.engine == 'async' and (args.profile or args.adaptive_batches
+                                   or args.pipeline_depth
+                                   or args.parallel_views
+                                   or args.metrics_json
+                                   or args.metrics_textfile):
+        parser.error("--engine async records no stages, so it does not "
+                     "support --profile, --adaptive-batches, "
+                     "--pipeline-depth, --parallel-views, --metrics-json "
+                     "or --metrics-textfile")
+    if args.daemon and (args.engine == 'async' or args.executor == 'process'):
+        parser.error("--daemon needs the sync engine with --executor thread "
+                     "so connections stay warm between runs")
+    if args.daemon and args.load_mode == 'insert':
+        parser.error("--daemon reruns every province on a schedule, so it "
+                     "needs --load-mode upsert or swap")
+    if args.spool and (args.parallel_views or args.checkpoint_rows
+                       or args.engine == 'async'):
+        parser.error("--spool needs the sync engine without --parallel-views "
+                     "or --checkpoint-rows")
+    if args.spool_date and args.spool != 'read':
+        parser.error("--spool-date only applies to --spool read")
+    if args.profile and args.workers > 1 and args.executor == 'thread':
+        parser.error("--profile can only profile one thread at a time; use "
+                     "--workers 1 or --executor process")
+    if args.checkpoint_rows and (args.parallel_views or args.engine == 'async'):
+        parser.error("--checkpoint-rows needs the sync engine without "
+                     "--parallel-views")
+    return args
+
+
+def create_options(args: argparse.Namespace,
+                   profile_dir: Optional[str] = None) -> SyncOptions:
+    """Build the run-wide options from parsed command line arguments."""
+    return SyncOptions(incremental=args.incremental,
+                       load_mode=args.load_mode,
+                       pushdown=args.pushdown,
+                       date_window=args.date_window,
+                       pipeline_depth=args.pipeline_depth,
+                       parallel_views=args.parallel_views,
+                       checkpoint_rows=args.checkpoint_rows,
+                       profile_dir=profile_dir,
+                       spool=args.spool or '',
+                       spool_dir=args.spool_dir,
+                       spool_date=args.spool_date,
+                       adaptive_batches=args.adaptive_batches,
+                       stages=tuple(args.stages or ()),
+                       diff=args.diff,
+                       materialize=args.materialize,
+                       explain=args.explain)
 
 
 if __name__ == "__main__":
-    # Call the main function for each province
-    provinces = ["Sofala", "Manica", "Niassa", "Tete"]
-    for province in provinces:
-        main(province)
+    if sys.argv[1:2] == ['retention']:
+        import retention
+        sys.exit(retention.main(sys.argv[2:]))
+    args = parse_args()
+    run_at = datetime.now()
+    profile_dir = (os.path.join(args.profile, run_at.strftime('%Y%m%d-%H%M%S'))
+                   if args.profile else None)
+    options = create_options(args, profile_dir)
+    prepare_targets(args.provinces, options)
+    if args.daemon:
+        from daemon import parse_duration, run_daemon
+        try:
+            interval = parse_duration(args.interval)
+            run_daemon(args.provinces, options, interval, args.schedule,
+                       args.workers, args.health_interval,
+                       args.metrics_json, args.metrics_textfile)
+        except ValueError as e:
+            sys.exit(f"error: {e}")
+        sys.exit(0)
+    started = time.monotonic()
+    with ExitStack() as stack:
+        if args.bulk_load:
+            # Every province loads into the same PostgreSQL database
+            _, pg_config = create_config(args.provinces[0])
+            stack.enter_context(bulk_load(pg_config, target_tables(options),
+                                          args.bulk_load_rows,
+                                          kind=run_kind(options)))
+        if args.engine == 'async':
+            import async_engine
+            results = async_engine.run_provinces(
+                args.provinces, options, args.async_concurrency)
+        else:
+            try:
+                results = run_provinces(args.provinces, args.workers,
+                                        args.executor, options)
+            finally:
+                close_mysql_pool()
+                close_pool()
+    print_summary(results, time.monotonic() - started)
+    if profile_dir and write_profile_summary(profile_dir):
+        print(f"Profile summary written to "
+              f"{os.path.join(profile_dir, 'summary.txt')}")
+    if args.metrics_json:
+        write_json_lines(args.metrics_json, results, run_at)
+    if args.metrics_textfile:
+        write_prometheus_textfile(args.metrics_textfile, results, run_at)
+    sys.exit(0 if all(result.ok for result in results) else 1)
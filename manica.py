@@ -2,14 +2,26 @@ import os
 from dotenv import load_dotenv
 import mysql.connector
 import psycopg2
-from psycopg2 import sql
-from datetime import date, datetime, timedelta
+from datetime import date, timedelta
 from typing import Dict, Any, Tuple, Union
 
+from extract import iter_rows
+from loader import check_insertable, copy_rows
+import mappings
+from mappings import transform_rows, with_columns
+
 
 # Load environment variables from .env file
 load_dotenv()
 
+PROVINCE = "Manica"
+
+# This script loads the primary phone number only, without the fallback
+ELEGIVEIS_CV = with_columns(mappings.ELEGIVEIS_CV, phone_number=8)
+CV_ACIMA_DE_1000 = with_columns(mappings.CV_ACIMA_DE_1000, phone_number=19)
+MARCADOS_LEVANTAMENTO = with_columns(mappings.MARCADOS_LEVANTAMENTO,
+                                     phone_number=13)
+
 
 def create_config() -> Tuple[Dict[str, Union[str, int, bool, None]],
                              Dict[str, Union[str, int, None]]]:
@@ -33,6 +45,7 @@ def create_config() -> Tuple[Dict[str, Union[str, int, bool, None]],
         'ssl_key': ssl_config['key'],
         'ssl_verify_cert': False,  # Verify server certificate
         'ssl_disabled': False,  # Enable SSL
+        'buffered': False,  # Stream results instead of buffering the view
     }
 
     # PostgreSQL connection configuration
@@ -55,32 +68,13 @@ def fetch_and_insert_elegiveis_cv(mysql_cursor, pg_cursor):
     query = "SELECT * FROM elegiveis_cv"
     mysql_cursor.execute(query)
 
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = "Manica"
-        health_facility = row[0]
-        district = row[1]
-        # patient_id = row[2]
-        patient_identifier = row[3]
-        patient_name = row[5]
-        age = row[7]
-        phone_number = row[8]
-        community = row[12]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_patienteligiblevlcollection (province,district,
-            community,health_facility,
-            patient_name, patient_identifier, age,
-            phone_number, created_at, sent)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, community, health_facility,
-               patient_name, patient_identifier, age,
-               phone_number, created_at, sent))
+    # Stream rows in fetchmany batches instead of materializing the view
+    rows = iter_rows(mysql_cursor)
+
+    # Stream transformed rows into PostgreSQL with COPY
+    copy_rows(pg_cursor, ELEGIVEIS_CV.table, ELEGIVEIS_CV.target_columns,
+              transform_rows(ELEGIVEIS_CV, rows, province=PROVINCE,
+                             created_at=date.today()))
 
 
 def fetch_and_insert_carga_viral_alta(mysql_cursor, pg_cursor):
@@ -89,33 +83,14 @@ def fetch_and_insert_carga_viral_alta(mysql_cursor, pg_cursor):
     query = "SELECT * FROM cv_acima_de_1000"
     mysql_cursor.execute(query)
 
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = "Manica"
-        district = row[1]
-        health_facility = row[0]
-        #   patient_id = row[0]
-        patient_identifier = row[3]
-        patient_name = row[4]
-        # gender = row[5]
-        age = row[6]
-        phone_number = row[19]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_viralloadtestresult (
-                province, district, health_facility,
-                patient_name, patient_identifier,
-                age, phone_number, created_at, sent
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, health_facility,
-               patient_name, patient_identifier,
-               age, phone_number, created_at, sent))
+    # Stream rows in fetchmany batches instead of materializing the view
+    rows = iter_rows(mysql_cursor)
+
+    # Stream transformed rows into PostgreSQL with COPY
+    copy_rows(pg_cursor, CV_ACIMA_DE_1000.table,
+              CV_ACIMA_DE_1000.target_columns,
+              transform_rows(CV_ACIMA_DE_1000, rows, province=PROVINCE,
+                             created_at=date.today()))
 
 
 def fetch_and_insert_marcados_levantamento(mysql_cursor, pg_cursor):
@@ -127,45 +102,14 @@ def fetch_and_insert_marcados_levantamento(mysql_cursor, pg_cursor):
     query = "SELECT * FROM marcados_levantamento WHERE next_dispensing_date = %s"
     mysql_cursor.execute(query, (next_appointment_date,))
 
-    # Fetch all rows
-    rows = mysql_cursor.fetchall()
-
-    # Insert fetched data into PostgreSQL
-    for row in rows:
-        province = "Manica"
-        district = row[4]
-        health_facility = row[1]
-        # patient_id = row[0]
-        patient_identifier = row[10]
-        patient_name = row[9]
-        gender = row[11]
-        age = row[12]
-        phone_number = row[13]
-        appointment_date = datetime.strptime(
-            str(row[2]), '%Y-%m-%d %H:%M:%S')
-        next_appointment_date = datetime.strptime(
-            str(row[3]), '%Y-%m-%d %H:%M:%S')
-        community = row[7]
-        pregnant = row[15]
-        breastfeeding = row[16]
-        tb = row[17]
-        created_at = date.today()
-        sent = False
-
-        pg_cursor.execute(sql.SQL("""
-            INSERT INTO core_visit (
-                province, district, health_facility,
-                patient_name, patient_identifier,
-                age, phone_number, appointment_date,
-                next_appointment_date, gender, community,
-                pregnant, breastfeeding, tb, created_at, sent
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """), (province, district, health_facility,
-               patient_name, patient_identifier,
-               age, phone_number, appointment_date,
-               next_appointment_date, gender, community,
-               pregnant, breastfeeding, tb, created_at, sent))
+    # Stream rows in fetchmany batches instead of materializing the view
+    rows = iter_rows(mysql_cursor)
+
+    # Stream transformed rows into PostgreSQL with COPY
+    copy_rows(pg_cursor, MARCADOS_LEVANTAMENTO.table,
+              MARCADOS_LEVANTAMENTO.target_columns,
+              transform_rows(MARCADOS_LEVANTAMENTO, rows, province=PROVINCE,
+                             created_at=date.today()))
 
 
 def main():
@@ -178,6 +122,9 @@ def main():
                 psycopg2.connect(**pg_config) as pg_cnx, \
                 pg_cnx.cursor() as pg_cursor:
 
+            check_insertable(pg_cursor, (ELEGIVEIS_CV.table,
+                                         CV_ACIMA_DE_1000.table,
+                                         MARCADOS_LEVANTAMENTO.table))
             fetch_and_insert_elegiveis_cv(mysql_cursor, pg_cursor)
             fetch_and_insert_carga_viral_alta(mysql_cursor, pg_cursor)
             fetch_and_insert_marcados_levantamento(mysql_cursor, pg_cursor)
@@ -0,0 +1,352 @@
+from datetime import date, datetime
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, NamedTuple,
+                    Optional, Sequence, Tuple, Union)
+
+from pipeline import close_iterator
+
+
+class Coalesce(NamedTuple):
+    """Source expression: the first non-NULL of several columns."""
+    indexes: Tuple[int, ...]
+
+
+class Convert(NamedTuple):
+    """Source expression: a column passed through a converter.
+
+    When every value of a batch already has the `native` type (or is
+    NULL), the converter is skipped for that batch.
+    """
+    index: int
+    func: Callable[[Any], Any]
+    native: Optional[type] = None
+
+
+class Const(NamedTuple):
+    """Source expression: the same value for every row."""
+    value: Any
+
+
+class Param(NamedTuple):
+    """Source expression: a per-run value supplied at compile time."""
+    name: str
+
+
+# A source is either a plain column position or one of the expressions above
+Source = Union[int, Coalesce, Convert, Const, Param]
+
+# Per-run values shared by every mapping
+PROVINCE = Param('province')
+CREATED_AT = Param('created_at')
+
+# Columns an upsert never overwrites on unchanged rows, so a rerun keeps
+# the original load date and the sender's delivery state
+PRESERVED_COLUMNS = ('created_at', 'sent')
+
+# Preserved columns still taken from the new row when any other column
+# changed, so a row is delivered again once its data changes
+RESET_COLUMNS = ('sent',)
+
+
+class ViewMapping(NamedTuple):
+    """Declarative mapping from a MySQL view to a PostgreSQL table."""
+    view: str
+    table: str
+    columns: Tuple[Tuple[str, Source], ...]
+    conflict_columns: Tuple[str, ...] = ()
+    # Optional appointment window pushed down to MySQL: the date column
+    # and how many days ahead the window ends
+    date_column: Optional[str] = None
+    window_days: int = 0
+
+    @property
+    def target_columns(self) -> Tuple[str, ...]:
+        """Target table columns, in load order."""
+        return tuple(name for name, _ in self.columns)
+
+    @property
+    def update_columns(self) -> Tuple[str, ...]:
+        """Target columns refreshed when an upsert hits an existing key."""
+        return tuple(name for name in self.target_columns
+                     if name not in self.conflict_columns
+                     and name not in PRESERVED_COLUMNS)
+
+    @property
+    def reset_columns(self) -> Tuple[str, ...]:
+        """Preserved target columns reset when an upsert changes a row."""
+        return tuple(name for name in self.target_columns
+                     if name in RESET_COLUMNS)
+
+
+def coalesce(*indexes: int) -> Coalesce:
+    """Take the first non-NULL value among the given columns."""
+    return Coalesce(indexes)
+
+
+def with_columns(mapping: ViewMapping, **sources: Source) -> ViewMapping:
+    """Return a copy of a mapping with some target columns re-sourced."""
+    unknown = set(sources) - set(mapping.target_columns)
+    if unknown:
+        raise ValueError(f"{mapping.table} has no columns {sorted(unknown)}")
+    return mapping._replace(columns=tuple(
+        (name, sources.get(name, source)) for name, source in mapping.columns))
+
+
+def _source_indexes(source: Source) -> Tuple[int, ...]:
+    """Return the view column positions a source reads."""
+    if isinstance(source, int):
+        return (source,)
+    if isinstance(source, Coalesce):
+        return source.indexes
+    if isinstance(source, Convert):
+        return (source.index,)
+    return ()
+
+
+def source_indexes(mapping: ViewMapping) -> Tuple[int, ...]:
+    """Return the sorted view column positions a mapping consumes."""
+    return tuple(sorted({index for _, source in mapping.columns
+                         for index in _source_indexes(source)}))
+
+
+def _reindex(source: Source, positions: Dict[int, int]) -> Source:
+    """Rewrite the column positions read by a source."""
+    if isinstance(source, int):
+        return positions[source]
+    if isinstance(source, Coalesce):
+        return Coalesce(tuple(positions[index] for index in source.indexes))
+    if isinstance(source, Convert):
+        return source._replace(index=positions[source.index])
+    return source
+
+
+def project(mapping: ViewMapping, indexes: Sequence[int]) -> ViewMapping:
+    """Rewrite a mapping to read rows holding only the given view columns.
+
+    `indexes` are the original positions, in the order they are selected.
+    """
+    positions = {index: new for new, index in enumerate(indexes)}
+    return mapping._replace(columns=tuple(
+        (name, _reindex(source, positions))
+        for name, source in mapping.columns))
+
+
+def _source_expr(source: Source, namespace: Dict[str, Any],
+                 params: Dict[str, Any]) -> str:
+    """Render one source as a Python expression over `row`."""
+    if isinstance(source, int):
+        return f'row[{source}]'
+    if isinstance(source, Coalesce):
+        *firsts, last = source.indexes
+        expr = f'row[{last}]'
+        for index in reversed(firsts):
+            expr = f'(row[{index}] if row[{index}] is not None else {expr})'
+        return expr
+    name = f'_v{len(namespace)}'
+    if isinstance(source, Convert):
+        namespace[name] = source.func
+        return f'{name}(row[{source.index}])'
+    if isinstance(source, Const):
+        namespace[name] = source.value
+        return name
+    if isinstance(source, Param):
+        namespace[name] = params[source.name]
+        return name
+    raise TypeError(f"Unsupported mapping source: {source!r}")
+
+
+def compile_transformer(mapping: ViewMapping, **params: Any
+                        ) -> Callable[[Tuple], Tuple]:
+    """Compile a mapping into a function turning a view row into a table row.
+
+    The whole projection is generated as a single tuple expression and
+    compiled once, so per-row work is just indexing plus any coalesce
+    and converter calls.
+    """
+    namespace: Dict[str, Any] = {}
+    exprs = [_source_expr(source, namespace, params)
+             for _, source in mapping.columns]
+    code = f"lambda row: ({', '.join(exprs)},)"
+    return eval(code, namespace)
+
+
+def transform_rows(mapping: ViewMapping, rows: Iterable[Tuple],
+                   **params: Any) -> Iterator[Tuple]:
+    """Lazily apply a compiled mapping to a stream of view rows."""
+    return map(compile_transformer(mapping, **params), rows)
+
+
+def _passthrough(mapping: ViewMapping) -> ViewMapping:
+    """Return a mapping reading native-typed converted columns as-is."""
+    return mapping._replace(columns=tuple(
+        (name, source.index
+         if isinstance(source, Convert) and source.native else source)
+        for name, source in mapping.columns))
+
+
+def _is_native(batch: Sequence[Tuple], index: int, native: type) -> bool:
+    """Check whether a column only holds native values or NULLs."""
+    accepted = (native, type(None))
+    return all(type(row[index]) in accepted for row in batch)
+
+
+def compile_batch_transformer(mapping: ViewMapping, **params: Any
+                              ) -> Callable[[Sequence[Tuple]], List[Tuple]]:
+    """Compile a mapping into a function transforming a whole row batch.
+
+    Drivers normally hand back native types already, so each batch is
+    checked once per converted column and transformed without the
+    converters when none of them would change anything.
+    """
+    converted = [(source.index, source.native)
+                 for _, source in mapping.columns
+                 if isinstance(source, Convert) and source.native]
+    convert = compile_transformer(mapping, **params)
+    passthrough = (compile_transformer(_passthrough(mapping), **params)
+                   if converted else convert)
+
+    def transform(batch: Sequence[Tuple]) -> List[Tuple]:
+        if all(_is_native(batch, index, native)
+               for index, native in converted):
+            return list(map(passthrough, batch))
+        return list(map(convert, batch))
+    return transform
+
+
+def transform_batches(mapping: ViewMapping,
+                      batches: Iterable[Sequence[Tuple]],
+                      **params: Any) -> Iterator[List[Tuple]]:
+    """Lazily apply a compiled mapping to a stream of row batches.
+
+    Closing the returned stream closes `batches` too.
+    """
+    transform = compile_batch_transformer(mapping, **params)
+    try:
+        for batch in batches:
+            yield transform(batch)
+    finally:
+        close_iterator(batches)
+
+
+class UniqueRows:
+    """Drops target rows whose key columns were already seen.
+
+    One instance can be shared by several row streams feeding the same
+    table, so a key is only kept the first time any of them yields it.
+    """
+
+    def __init__(self, columns: Sequence[str], key_columns: Sequence[str]):
+        self.indexes = tuple(columns.index(column) for column in key_columns)
+        self.seen = set()
+
+    def filter(self, batch: Sequence[Tuple]) -> List[Tuple]:
+        """Return the rows of a batch with a key not seen before."""
+        indexes, seen = self.indexes, self.seen
+        unique = []
+        for row in batch:
+            key = tuple(row[index] for index in indexes)
+            if key not in seen:
+                seen.add(key)
+                unique.append(row)
+        return unique
+
+
+def to_datetime(value: Any) -> Optional[datetime]:
+    """Convert a driver value to a datetime, passing datetimes through.
+
+    Dates become midnight of that day and text is parsed as ISO 8601,
+    which covers both MySQL DATETIME and DATE renderings.
+    """
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode()
+    return datetime.fromisoformat(str(value))
+
+
+def datetime_column(index: int) -> Convert:
+    """Read a column as a datetime, converting only non-native values."""
+    return Convert(index, to_datetime, datetime)
+
+
+ELEGIVEIS_CV = ViewMapping(
+    view='elegiveis_cv',
+    table='core_patienteligiblevlcollection',
+    columns=(
+        ('province', PROVINCE),
+        ('district', 1),
+        ('community', 12),
+        ('health_facility', 0),
+        ('patient_name', 5),
+        ('patient_identifier', 3),
+        ('age', 7),
+        ('phone_number', coalesce(8, 9)),
+        ('created_at', CREATED_AT),
+        ('sent', Const(False)),
+    ),
+    conflict_columns=('province', 'patient_identifier'))
+
+CV_ACIMA_DE_1000 = ViewMapping(
+    view='cv_acima_de_1000',
+    table='core_viralloadtestresult',
+    columns=(
+        ('province', PROVINCE),
+        ('district', 1),
+        ('health_facility', 0),
+        ('patient_name', 4),
+        ('patient_identifier', 3),
+        ('age', 6),
+        ('phone_number', coalesce(19, 20)),
+        ('created_at', CREATED_AT),
+        ('sent', Const(False)),
+    ),
+    conflict_columns=('province', 'patient_identifier'))
+
+# marcados_levantamento and marcados_seguimento share one layout
+_VISIT_COLUMNS = (
+    ('province', PROVINCE),
+    ('district', 4),
+    ('health_facility', 1),
+    ('patient_name', 9),
+    ('patient_identifier', 10),
+    ('age', 12),
+    ('phone_number', coalesce(13, 14)),
+    ('appointment_date', datetime_column(2)),
+    ('next_appointment_date', datetime_column(3)),
+    ('gender', 11),
+    ('community', 7),
+    ('pregnant', 15),
+    ('breastfeeding', 16),
+    ('tb', 17),
+    ('created_at', CREATED_AT),
+    ('sent', Const(False)),
+)
+
+# A visit is identified by the patient and the appointment it announces
+_VISIT_KEY = ('province', 'patient_identifier', 'next_appointment_date')
+
+MARCADOS_LEVANTAMENTO = ViewMapping(
+    view='marcados_levantamento',
+    table='core_visit',
+    columns=_VISIT_COLUMNS,
+    conflict_columns=_VISIT_KEY,
+    date_column='next_dispensing_date',
+    window_days=14)
+
+MARCADOS_SEGUIMENTO = ViewMapping(
+    view='marcados_seguimento',
+    table='core_visit',
+    columns=_VISIT_COLUMNS,
+    conflict_columns=_VISIT_KEY,
+    date_column='next_appointment_date',
+    window_days=7)
+
+# Both visit views feed core_visit and are loaded as one stream, keeping
+# the first row of each patient and appointment date
+VISIT_MAPPINGS = (MARCADOS_LEVANTAMENTO, MARCADOS_SEGUIMENTO)
+VISIT_UNIQUE_COLUMNS = ('patient_identifier', 'next_appointment_date')
+
+# Every view synced by main.py, in load order
+MAPPINGS = (ELEGIVEIS_CV, CV_ACIMA_DE_1000,
+            MARCADOS_LEVANTAMENTO, MARCADOS_SEGUIMENTO)
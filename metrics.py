@@ -0,0 +1,302 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Sequence)
+
+
+# Rows of each fetched batch sampled to estimate its size on the wire
+_SAMPLED_ROWS = 16
+
+
+def _value_bytes(value: Any) -> int:
+    if value is None:
+        return 1
+    if isinstance(value, (str, bytes, bytearray)):
+        return 1 + len(value)
+    return 1 + len(str(value))
+
+
+def estimate_wire_bytes(batch: Sequence[Sequence]) -> int:
+    """Roughly estimate the bytes a batch of rows took on the MySQL wire.
+
+    The text protocol sends every value as a length-prefixed string and
+    NULL as a single byte, so each value counts its text length plus
+    one. Only a sample of the rows is measured.
+    """
+    if not batch:
+        return 0
+    sample = batch[::max(1, len(batch) // _SAMPLED_ROWS)]
+    sampled = sum(_value_bytes(value) for row in sample for value in row)
+    return sampled * len(batch) // len(sample)
+
+
+class StageMetrics:
+    """Counters and timings of one load stage of a province.
+
+    Bytes read from MySQL are estimated from the fetched values, while
+    COPY bytes are counted exactly. Fetch time covers MySQL execute()
+    and fetchmany() calls and write
+    time the PostgreSQL COPYs and statements; what is left of the stage
+    is spent transforming rows in Python. With pipelining or parallel
+    views the fetches overlap the writes, so the parts can add up to
+    more than the stage itself.
+    """
+
+    def __init__(self, province: str, stage: str):
+        self.province = province
+        self.stage = stage
+        self.rows_read = 0
+        self.rows_written = 0
+        self.bytes_read = 0
+        self.copy_bytes = 0
+        self.fetch_seconds = 0.0
+        self.write_seconds = 0.0
+        self.seconds = 0.0
+        self.ok = True
+        self.error: Optional[str] = None
+
+    @property
+    def transform_seconds(self) -> float:
+        return max(0.0, self.seconds - self.fetch_seconds - self.write_seconds)
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows_read / self.seconds if self.seconds else 0.0
+
+    def mysql_cursor(self, cursor) -> 'MeteredMySQLCursor':
+        """Wrap a MySQL cursor so its reads count towards this stage."""
+        return MeteredMySQLCursor(cursor, self)
+
+    def pg_cursor(self, cursor) -> 'MeteredPGCursor':
+        """Wrap a PostgreSQL cursor so its writes count towards this stage."""
+        return MeteredPGCursor(cursor, self)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'event': 'stage',
+            'province': self.province,
+            'stage': self.stage,
+            'ok': self.ok,
+            'error': self.error,
+            'rows_read': self.rows_read,
+            'rows_written': self.rows_written,
+            'bytes_read': self.bytes_read,
+            'copy_bytes': self.copy_bytes,
+            'seconds': round(self.seconds, 6),
+            'fetch_seconds': round(self.fetch_seconds, 6),
+            'transform_seconds': round(self.transform_seconds, 6),
+            'write_seconds': round(self.write_seconds, 6),
+            'rows_per_second': round(self.rows_per_second, 1),
+        }
+
+
+class ConnectMetrics(NamedTuple):
+    """Time taken to open, or borrow, one database connection."""
+    province: str
+    database: str
+    seconds: float
+    ok: bool
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {'event': 'connect', 'province': self.province,
+                'database': self.database, 'seconds': round(self.seconds, 6),
+                'ok': self.ok}
+
+
+class MeteredMySQLCursor:
+    """MySQL cursor proxy timing queries and counting the rows and bytes
+    fetched."""
+
+    def __init__(self, cursor, metrics: StageMetrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._metrics.fetch_seconds += time.perf_counter() - started
+
+    def fetchmany(self, size: int = 1) -> List:
+        started = time.perf_counter()
+        try:
+            batch = self._cursor.fetchmany(size)
+        finally:
+            self._metrics.fetch_seconds += time.perf_counter() - started
+        self._metrics.rows_read += len(batch)
+        self._metrics.bytes_read += estimate_wire_bytes(batch)
+        return batch
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+
+class MeteredPGCursor:
+    """PostgreSQL cursor proxy timing writes and counting COPY bytes."""
+
+    def __init__(self, cursor, metrics: StageMetrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def copy_expert(self, statement, file, *args, **kwargs):
+        data = file.getvalue()
+        self._metrics.copy_bytes += len(
+            data.encode() if isinstance(data, str) else data)
+        started = time.perf_counter()
+        try:
+            return self._cursor.copy_expert(statement, file, *args, **kwargs)
+        finally:
+            self._metrics.write_seconds += time.perf_counter() - started
+
+    def execute(self, query, params=None):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._metrics.write_seconds += time.perf_counter() - started
+
+    def __getattr__(self, name: str):
+        return getattr(self._cursor, name)
+
+
+class ProvinceMetrics:
+    """Collects the stage and connection metrics of one province."""
+
+    def __init__(self, province: str):
+        self.province = province
+        self.stages: List[StageMetrics] = []
+        self.connects: List[ConnectMetrics] = []
+        # MySQL's EXPLAIN of each view's extraction query, when captured
+        self.explains: Dict[str, List[Dict[str, Any]]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[StageMetrics]:
+        """Time a stage, recording it as failed if it raises."""
+        metrics = StageMetrics(self.province, name)
+        self.stages.append(metrics)
+        started = time.perf_counter()
+        try:
+            yield metrics
+        except Exception as e:
+            metrics.ok = False
+            metrics.error = str(e)
+            raise
+        finally:
+            metrics.seconds = time.perf_counter() - started
+
+    def connect(self, kind: str, connect: Callable, *args, **kwargs):
+        """Open a `kind` connection with connect(*args, **kwargs), timing it.
+
+        The arguments are passed through untouched, so they may include
+        a 'database' setting.
+        """
+        started = time.perf_counter()
+        ok = False
+        try:
+            connection = connect(*args, **kwargs)
+            ok = True
+            return connection
+        finally:
+            self.connects.append(ConnectMetrics(
+                self.province, kind, time.perf_counter() - started, ok))
+
+
+def write_json_lines(path: str, results: Sequence, run_at: datetime):
+    """Append one JSON object per stage, connection and query plan to a
+    file."""
+    with open(path, 'a') as f:
+        for result in results:
+            for record in (*result.connects, *result.stages):
+                line = record.as_dict()
+                line['run_at'] = run_at.isoformat(timespec='seconds')
+                f.write(json.dumps(line) + '\n')
+            if result.batch_sizes:
+                f.write(json.dumps(dict(
+                    event='batch_sizes', province=result.province,
+                    run_at=run_at.isoformat(timespec='seconds'),
+                    **result.batch_sizes)) + '\n')
+            for view, steps in (result.explains or {}).items():
+                f.write(json.dumps(dict(
+                    event='explain', province=result.province, view=view,
+                    run_at=run_at.isoformat(timespec='seconds'),
+                    steps=steps), default=str) + '\n')
+
+
+def _labels(**labels: str) -> str:
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()) + '}'
+
+
+# Name, help text and value of each per-stage gauge
+_STAGE_GAUGES = (
+    ('sync_stage_success', "Whether the stage succeeded in the last run.",
+     lambda stage: int(stage.ok)),
+    ('sync_stage_rows_read', "Rows read from MySQL by the stage.",
+     lambda stage: stage.rows_read),
+    ('sync_stage_rows_written', "Rows loaded into PostgreSQL by the stage.",
+     lambda stage: stage.rows_written),
+    ('sync_stage_bytes_read', "Estimated bytes read from MySQL.",
+     lambda stage: stage.bytes_read),
+    ('sync_stage_copy_bytes', "Bytes sent to PostgreSQL with COPY.",
+     lambda stage: stage.copy_bytes),
+)
+
+
+def write_prometheus_textfile(path: str, results: Sequence, run_at: datetime):
+    """Write the last run's metrics for the node exporter textfile collector.
+
+    The file is replaced atomically so the exporter never scrapes a
+    half-written file.
+    """
+    lines = []
+
+    def gauge(name: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(f"{name}{labels} {value}" for labels, value in samples)
+
+    stages = [stage for result in results for stage in result.stages]
+    gauge('sync_last_run_timestamp_seconds',
+          "Unix time the last sync run started.",
+          [('', run_at.timestamp())])
+    gauge('sync_province_success', "Whether the province synced.",
+          [(_labels(province=result.province), int(result.ok))
+           for result in results])
+    gauge('sync_province_duration_seconds', "Wall time of the province.",
+          [(_labels(province=result.province), result.elapsed)
+           for result in results])
+    for name, help_text, value in _STAGE_GAUGES:
+        gauge(name, help_text,
+              [(_labels(province=stage.province, stage=stage.stage),
+                value(stage)) for stage in stages])
+    gauge('sync_stage_seconds', "Time spent by the stage, split by phase.",
+          [(_labels(province=stage.province, stage=stage.stage, phase=phase),
+            seconds)
+           for stage in stages
+           for phase, seconds in (('total', stage.seconds),
+                                  ('fetch', stage.fetch_seconds),
+                                  ('transform', stage.transform_seconds),
+                                  ('write', stage.write_seconds))])
+    gauge('sync_batch_size_rows', "Adaptive batch size reached, in rows.",
+          [(_labels(province=result.province, kind=kind), size)
+           for result in results if result.batch_sizes
+           for kind, size in result.batch_sizes.items()])
+    connect_seconds: Dict[tuple, float] = {}
+    for result in results:
+        for connect in result.connects:
+            key = (connect.province, connect.database)
+            connect_seconds[key] = connect_seconds.get(key, 0.0) + connect.seconds
+    gauge('sync_connect_seconds', "Time spent opening connections.",
+          [(_labels(province=province, database=database), seconds)
+           for (province, database), seconds in connect_seconds.items()])
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temporary, path)
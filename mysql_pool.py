@@ -0,0 +1,105 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+import mysql.connector
+
+
+# Idle connections kept per MySQL server between runs
+MYSQL_POOL_IDLE = int(os.getenv('MYSQL_POOL_IDLE', 4))
+
+_idle: Dict[Tuple, List[Any]] = {}
+_lock = threading.Lock()
+
+
+def _server(mysql_config: Dict[str, Any]) -> Tuple:
+    return (mysql_config.get('host'), mysql_config.get('port'),
+            mysql_config.get('user'), mysql_config.get('database'))
+
+
+def _healthy(cnx) -> bool:
+    """Check that an idle connection still answers."""
+    try:
+        cnx.ping(reconnect=False)
+        return True
+    except Exception:
+        return False
+
+
+def _close(cnx):
+    try:
+        cnx.close()
+    except Exception:
+        pass
+
+
+@contextmanager
+def mysql_connection(mysql_config: Dict[str, Any]) -> Iterator[Any]:
+    """Borrow a warm connection to a provincial MySQL server.
+
+    An idle connection is reused when it still answers a ping, saving
+    the TCP and SSL handshakes; otherwise a new one is opened. On
+    return the read transaction is ended, so the next borrower sees
+    fresh data, and the connection is kept idle unless enough already
+    are or it broke.
+    """
+    server = _server(mysql_config)
+    cnx = None
+    while cnx is None:
+        with _lock:
+            idle = _idle.get(server)
+            candidate = idle.pop() if idle else None
+        if candidate is None:
+            cnx = mysql.connector.connect(**mysql_config)
+        elif _healthy(candidate):
+            cnx = candidate
+        else:
+            _close(candidate)
+
+    keep = False
+    try:
+        yield cnx
+        keep = True
+    finally:
+        if keep:
+            try:
+                cnx.rollback()
+            except Exception:
+                keep = False
+        with _lock:
+            idle = _idle.setdefault(server, [])
+            if keep and len(idle) < MYSQL_POOL_IDLE:
+                idle.append(cnx)
+                cnx = None
+        if cnx is not None:
+            _close(cnx)
+
+
+def check_idle() -> int:
+    """Ping every idle connection, closing those that no longer answer.
+
+    Returns the number of connections dropped.
+    """
+    with _lock:
+        pooled = [(server, cnx) for server, idle in _idle.items()
+                  for cnx in idle]
+        _idle.clear()
+    dropped = 0
+    for server, cnx in pooled:
+        if _healthy(cnx):
+            with _lock:
+                _idle.setdefault(server, []).append(cnx)
+        else:
+            _close(cnx)
+            dropped += 1
+    return dropped
+
+
+def close_mysql_pool():
+    """Close every idle MySQL connection."""
+    with _lock:
+        pooled = [cnx for idle in _idle.values() for cnx in idle]
+        _idle.clear()
+    for cnx in pooled:
+        _close(cnx)
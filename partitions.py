@@ -0,0 +1,131 @@
+import re
+from datetime import date, timedelta
+from typing import Sequence
+
+from psycopg2 import sql
+
+from loader import TableWriter
+
+
+# Suffix of the UNLOGGED table a partition is loaded into before the swap
+LOAD_SUFFIX = '_load'
+
+# Matches the head of an index definition on a partitioned table
+_PARENT_INDEX = re.compile(r'^CREATE (UNIQUE )?INDEX \S+ ON ONLY \S+ ')
+
+
+def partition_name(table: str, province: str, day: date) -> str:
+    """Return the name of a table's partition for a province and day."""
+    province = re.sub(r'\W', '_', province.lower())
+    return f"{table}_{province}_{day:%Y%m%d}"
+
+
+def check_partitioned(pg_cursor, table: str):
+    """Make sure a target can take daily province partitions.
+
+    The table must be partitioned by RANGE (province, created_at), e.g.
+
+        CREATE TABLE core_visit (...) PARTITION BY RANGE (province, created_at)
+
+    which is a migration for the schema's owner, not something a sync
+    run does.
+    """
+    pg_cursor.execute(
+        "SELECT partstrat, ARRAY(SELECT attname FROM pg_attribute"
+        " WHERE attrelid = partrelid AND attnum = ANY(partattrs)"
+        " ORDER BY array_position(partattrs::int2[], attnum))"
+        " FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+        (table,))
+    row = pg_cursor.fetchone()
+    if row is None or row[0] != 'r' or row[1] != ['province', 'created_at']:
+        raise RuntimeError(f"{table} must be partitioned by RANGE (province, "
+                           f"created_at) to load it by partition swap")
+
+
+def create_load_table(pg_cursor, load_table: str, table: str):
+    """Create an empty UNLOGGED table shaped like a partitioned target.
+
+    Any table left by a failed swap is dropped first.
+    """
+    pg_cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(
+        sql.Identifier(load_table)))
+    pg_cursor.execute(sql.SQL(
+        "CREATE UNLOGGED TABLE {} (LIKE {} INCLUDING DEFAULTS)").format(
+            sql.Identifier(load_table), sql.Identifier(table)))
+
+
+def prepare_partition(pg_cursor, table: str, province: str, day: date):
+    """Get a loaded table ready to be attached without delay.
+
+    Adds the CHECK constraint that spares ATTACH from scanning it and
+    builds the parent's indexes on it, so the swap itself only has to
+    attach them.
+
+    It is made LOGGED first, which writes the whole table to WAL once.
+    That cannot be skipped: a logged parent cannot take an UNLOGGED
+    partition, and an UNLOGGED table is emptied by crash recovery and
+    never reaches replicas. Done here, after the COPY and before the
+    indexes exist, it is one sequential write of the heap rather than a
+    WAL record per row and per index entry, and the indexes built
+    afterwards are logged as whole pages.
+    """
+    load_table = partition_name(table, province, day) + LOAD_SUFFIX
+    identifier = sql.Identifier(load_table)
+    pg_cursor.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(identifier))
+    pg_cursor.execute(sql.SQL(
+        "ALTER TABLE {} ADD CHECK (province IS NOT NULL AND "
+        "created_at IS NOT NULL AND province = %s AND "
+        "created_at >= %s AND created_at < %s)").format(identifier),
+        (province, day, day + timedelta(days=1)))
+    pg_cursor.execute(
+        "SELECT pg_get_indexdef(indexrelid) FROM pg_index"
+        " WHERE indrelid = %s::regclass", (table,))
+    for definition, in pg_cursor.fetchall():
+        match = _PARENT_INDEX.match(definition)
+        if match:
+            pg_cursor.execute(
+                sql.SQL("CREATE {}INDEX ON {} ").format(
+                    sql.SQL(match.group(1) or ''), identifier)
+                + sql.SQL(definition[match.end():]))
+    pg_cursor.execute(sql.SQL("ANALYZE {}").format(identifier))
+
+
+def swap_partitions(pg_cursor, tables: Sequence[str], province: str,
+                    day: date):
+    """Replace a province's partitions for a day with the loaded tables.
+
+    Meant to run as one short transaction: the previous partitions, if
+    any, are dropped and the prepared tables attached in their place, so
+    readers see either the old or the new rows of every table.
+    """
+    for table in tables:
+        name = partition_name(table, province, day)
+        pg_cursor.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(
+            sql.Identifier(name)))
+        pg_cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+            sql.Identifier(name + LOAD_SUFFIX), sql.Identifier(name)))
+        pg_cursor.execute(sql.SQL(
+            "ALTER TABLE {} ATTACH PARTITION {} "
+            "FOR VALUES FROM (%s, %s) TO (%s, %s)").format(
+                sql.Identifier(table), sql.Identifier(name)),
+            (province, day, province, day + timedelta(days=1)))
+
+
+class PartitionWriter(TableWriter):
+    """Writes a province's rows for a day into an UNLOGGED load table.
+
+    Nothing reaches the target until prepare_partition and
+    swap_partitions attach the load table as the partition of that
+    province and day.
+    """
+
+    def __init__(self, pg_cursor, table: str, columns: Sequence[str],
+                 province: str, day: date):
+        super().__init__(pg_cursor,
+                         partition_name(table, province, day) + LOAD_SUFFIX,
+                         columns)
+        self.target = table
+
+    def begin(self):
+        """Create the load table."""
+        create_load_table(self.pg_cursor, self.table, self.target)
@@ -0,0 +1,86 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Union
+
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+
+# Connections kept open, and the most ever opened, per process
+POOL_MIN = int(os.getenv('PG_POOL_MIN', 1))
+POOL_MAX = int(os.getenv('PG_POOL_MAX', 8))
+
+_pool: Optional[ThreadedConnectionPool] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_lock = threading.Lock()
+
+
+def get_pool(pg_config: Dict[str, Union[str, int, None]],
+             minconn: int = POOL_MIN,
+             maxconn: int = POOL_MAX) -> ThreadedConnectionPool:
+    """Return the process-wide PostgreSQL pool, creating it on first use.
+
+    Every caller targets the same database, so the configuration of the
+    first call wins and later ones reuse its connections.
+    """
+    global _pool, _slots
+    with _lock:
+        if _pool is None or _pool.closed:
+            _pool = ThreadedConnectionPool(minconn, maxconn, **pg_config)
+            _slots = threading.BoundedSemaphore(maxconn)
+        return _pool
+
+
+def _healthy(cnx: extensions.connection) -> bool:
+    """Check that a pooled connection still answers."""
+    if cnx.closed:
+        return False
+    try:
+        with cnx.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        cnx.rollback()
+        return True
+    except Exception:
+        return False
+
+
+@contextmanager
+def pg_connection(pg_config: Dict[str, Union[str, int, None]]
+                  ) -> Iterator[extensions.connection]:
+    """Borrow a pooled connection for one unit of work.
+
+    Blocks while every pooled connection is in use. Connections that
+    stopped answering while idle (e.g. after a server restart) are
+    replaced. Work that was not committed is rolled back before the
+    connection goes back to the pool, and broken connections are
+    discarded instead of reused.
+    """
+    pool = get_pool(pg_config)
+    _slots.acquire()
+    try:
+        cnx = pool.getconn()
+        while not _healthy(cnx):
+            pool.putconn(cnx, close=True)
+            cnx = pool.getconn()
+        try:
+            yield cnx
+        finally:
+            discard = bool(cnx.closed)
+            if not discard and cnx.status != extensions.STATUS_READY:
+                try:
+                    cnx.rollback()
+                except Exception:
+                    discard = True
+            pool.putconn(cnx, close=discard)
+    finally:
+        _slots.release()
+
+
+def close_pool():
+    """Close every pooled connection."""
+    global _pool
+    with _lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+        _pool = None
@@ -0,0 +1,120 @@
+import queue
+import threading
+from contextlib import closing, contextmanager
+from typing import Iterable, Iterator, Sequence, Tuple, TypeVar
+
+
+T = TypeVar('T')
+
+# How long a blocked producer waits before re-checking for cancellation
+_POLL_SECONDS = 0.5
+
+
+class _Failure:
+    """Wraps an exception raised by the producer thread."""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+def close_iterator(items: Iterable):
+    """Close an iterator that can be closed, e.g. a generator.
+
+    Its cleanup then runs right away rather than whenever it is
+    collected; for a stream of cursor batches, that reads the rest of
+    the result so the cursor can be closed.
+    """
+    close = getattr(items, 'close', None)
+    if close is not None:
+        close()
+
+
+def prefetch(items: Iterable[T], depth: int) -> Iterator[T]:
+    """Iterate over items in a background thread, up to depth items ahead.
+
+    The producer keeps pulling (e.g. the next MySQL batch) while the
+    consumer is still busy with the previous item, and blocks once depth
+    items are waiting, so a slow consumer applies backpressure instead
+    of letting memory grow. Producer errors are re-raised in the
+    consumer; if the consumer stops early the producer is cancelled.
+    """
+    with closing(interleave((items,), depth)) as pairs:
+        for _, item in pairs:
+            yield item
+
+
+@contextmanager
+def prefetched(items: Iterable[T], depth: int) -> Iterator[Iterator[T]]:
+    """Prefetch items within a block, or pass them through if depth is 0.
+
+    When the block exits, even by an exception, the producer thread is
+    cancelled and joined, so it never keeps reading from a cursor the
+    caller is about to close or hand back to its pool.
+    """
+    if not depth:
+        try:
+            yield iter(items)
+        finally:
+            close_iterator(items)
+        return
+    with closing(prefetch(items, depth)) as prefetching:
+        yield prefetching
+
+
+def interleave(sources: Sequence[Iterable[T]], depth: int
+               ) -> Iterator[Tuple[int, T]]:
+    """Iterate over several sources concurrently, one thread each.
+
+    Yields (source index, item) pairs in arrival order through a single
+    queue holding at most depth items, so a slow consumer throttles
+    every producer. The first producer error cancels the others and is
+    re-raised in the consumer. Each source is closed by its producer
+    when it stops, however it stops.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    cancelled = threading.Event()
+
+    def put(item) -> bool:
+        while not cancelled.is_set():
+            try:
+                buffer.put(item, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce(index: int, items: Iterable[T]):
+        try:
+            try:
+                for item in items:
+                    if not put((index, item)):
+                        return
+            finally:
+                close_iterator(items)
+        except BaseException as e:
+            put((index, _Failure(e)))
+        else:
+            put((index, _DONE))
+
+    producers = [threading.Thread(target=produce, args=(index, items),
+                                  name=f'interleave-{index}', daemon=True)
+                 for index, items in enumerate(sources)]
+    for producer in producers:
+        producer.start()
+    try:
+        pending = len(producers)
+        while pending:
+            index, item = buffer.get()
+            if item is _DONE:
+                pending -= 1
+                continue
+            if isinstance(item, _Failure):
+                raise item.error
+            yield index, item
+    finally:
+        cancelled.set()
+        for producer in producers:
+            producer.join()
@@ -0,0 +1,129 @@
+import cProfile
+import glob
+import io
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+
+# Functions and allocation sites listed in each hotspot summary
+DEFAULT_TOP = 20
+
+# Where a function's own time goes, checked in order against its file
+# name and function name; anything else counts as 'other'
+_CATEGORIES: List[Tuple[str, Callable[[str, str], bool]]] = [
+    ('datetime parsing', lambda file, func:
+        'strptime' in file or 'strptime' in func or 'fromisoformat' in func),
+    ('sql composition', lambda file, func:
+        file.endswith(os.path.join('psycopg2', 'sql.py'))),
+    ('network wait', lambda file, func:
+        any(name in func for name in ('_ssl.', '_socket.', 'select.'))),
+    ('thread wait', lambda file, func: '_thread.lock' in func),
+    ('postgresql driver', lambda file, func:
+        'psycopg2' in file or 'psycopg2' in func),
+    ('mysql driver', lambda file, func:
+        'mysql' in file or '_mysql_connector' in func),
+    ('copy formatting', lambda file, func:
+        file.endswith('loader.py') or "of 'str' objects" in func
+        or 'isoformat' in func),
+    ('transform', lambda file, func:
+        file == '<string>' or file.endswith('mappings.py')),
+]
+
+
+def _category(file: str, func: str) -> str:
+    for name, matches in _CATEGORIES:
+        if matches(file, func):
+            return name
+    return 'other'
+
+
+def time_by_category(stats: pstats.Stats) -> Dict[str, float]:
+    """Sum each function's own time into coarse categories."""
+    totals: Dict[str, float] = {}
+    for (file, _, func), (_, _, own, _, _) in stats.stats.items():
+        category = _category(file, func)
+        totals[category] = totals.get(category, 0.0) + own
+    return dict(sorted(totals.items(), key=lambda item: -item[1]))
+
+
+def format_summary(stats: pstats.Stats, top: int = DEFAULT_TOP,
+                   allocations: Optional[tracemalloc.Snapshot] = None) -> str:
+    """Render the hotspots of a profile as text."""
+    out = io.StringIO()
+    out.write(f"Total time: {stats.total_tt:.3f}s\n\nOwn time by category:\n")
+    for category, seconds in time_by_category(stats).items():
+        share = seconds / stats.total_tt if stats.total_tt else 0.0
+        out.write(f"  {category:<20}{seconds:10.3f}s {share:7.1%}\n")
+    for order in ('tottime', 'cumulative'):
+        out.write(f"\nTop {top} functions by {order}:\n")
+        stats.stream = out
+        stats.sort_stats(order).print_stats(top)
+    if allocations is not None:
+        out.write(f"\nTop {top} allocation sites still held at the end:\n")
+        for stat in allocations.statistics('lineno')[:top]:
+            out.write(f"  {stat}\n")
+    return out.getvalue()
+
+
+@contextmanager
+def profile_stage(directory: Optional[str], province: str, stage: str,
+                  top: int = DEFAULT_TOP) -> Iterator[None]:
+    """Profile the CPU time and allocations of one stage.
+
+    Writes {province}-{stage}.prof, loadable with pstats or snakeviz,
+    and a {province}-{stage}.txt hotspot summary into the directory.
+    Only the calling thread is profiled, so work done by pipelining or
+    parallel-view reader threads shows up as waiting on their queue.
+    Does nothing when directory is None.
+    """
+    if directory is None:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        _, peak = tracemalloc.get_traced_memory()
+        if not tracing:
+            tracemalloc.stop()
+
+        base = os.path.join(directory, f'{province}-{stage}')
+        profiler.dump_stats(base + '.prof')
+        stats = pstats.Stats(profiler)
+        with open(base + '.txt', 'w') as f:
+            f.write(f"{province} {stage}\n")
+            f.write(f"Peak traced memory: {peak / 2**20:.1f} MB\n")
+            f.write(format_summary(stats, top, snapshot))
+        hotspots = ', '.join(f'{category} {seconds:.2f}s' for category, seconds
+                             in list(time_by_category(stats).items())[:3])
+        print(f"Profiled {province} {stage}: {stats.total_tt:.2f}s "
+              f"({hotspots}), peak {peak / 2**20:.1f} MB -> {base}.txt")
+
+
+def write_profile_summary(directory: str, top: int = DEFAULT_TOP
+                          ) -> Optional[str]:
+    """Combine every stage profile in a directory into summary.txt.
+
+    Returns the summary path, or None when nothing was profiled.
+    """
+    files = sorted(glob.glob(os.path.join(directory, '*.prof')))
+    if not files:
+        return None
+    stats = pstats.Stats(*files)
+    path = os.path.join(directory, 'summary.txt')
+    with open(path, 'w') as f:
+        f.write(f"Combined profile of {len(files)} stages\n")
+        f.write(format_summary(stats, top))
+    return path
@@ -0,0 +1,241 @@
+import argparse
+import os
+import time
+from contextlib import closing
+from datetime import date, timedelta
+from typing import Dict, List, NamedTuple, Optional, Sequence, Union
+
+import psycopg2
+from psycopg2 import sql
+
+from main import PROVINCES, create_config
+from mappings import MAPPINGS
+
+
+# Rows older than this many days, and already sent, are archived
+RETENTION_DAYS = int(os.getenv('SYNC_RETENTION_DAYS', 90))
+
+# Rows moved per transaction; small batches keep row locks short
+RETENTION_BATCH = int(os.getenv('SYNC_RETENTION_BATCH', 5000))
+
+# Seconds slept between batches, to leave I/O for the application
+RETENTION_PAUSE = float(os.getenv('SYNC_RETENTION_PAUSE', 0))
+
+# Suffix of the table each target's old rows are moved to
+ARCHIVE_SUFFIX = '_archive'
+
+# Tables loaded by main.py, in load order
+TABLES = list(dict.fromkeys(mapping.table for mapping in MAPPINGS))
+
+
+class RetentionResult(NamedTuple):
+    """What archiving one table moved and freed."""
+    table: str
+    rows: int
+    # Size of the moved rows' data, now reusable by the table
+    row_bytes: int
+    # On-disk size of the table with its indexes and TOAST
+    size_before: int
+    size_after: int
+    seconds: float
+
+
+def archive_table(pg_cursor, table: str) -> str:
+    """Create the archive of a table if needed and return its name.
+
+    The archive has the table's columns, without defaults, indexes or
+    constraints, so archiving never conflicts.
+    """
+    archive = table + ARCHIVE_SUFFIX
+    pg_cursor.execute(sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {} (LIKE {})").format(
+            sql.Identifier(archive), sql.Identifier(table)))
+    return archive
+
+
+def table_columns(pg_cursor, table: str) -> List[str]:
+    """Return a table's column names, in order."""
+    pg_cursor.execute(
+        "SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass"
+        " AND attnum > 0 AND NOT attisdropped ORDER BY attnum", (table,))
+    return [name for name, in pg_cursor.fetchall()]
+
+
+def keyset_column(pg_cursor, table: str) -> str:
+    """Return the column batches are paginated on.
+
+    That is the first primary key column, the id of the application's
+    tables.
+    """
+    pg_cursor.execute(
+        "SELECT a.attname FROM pg_index x JOIN pg_attribute a"
+        " ON a.attrelid = x.indrelid AND a.attnum = x.indkey[0]"
+        " WHERE x.indrelid = %s::regclass AND x.indisprimary", (table,))
+    row = pg_cursor.fetchone()
+    if row is None:
+        raise RuntimeError(f"{table} has no primary key to paginate on")
+    return row[0]
+
+
+def table_size(pg_cursor, table: str) -> int:
+    """Return the on-disk size of a table, including every partition."""
+    pg_cursor.execute(
+        "SELECT coalesce(sum(pg_total_relation_size(relid)), 0)"
+        " FROM pg_partition_tree(%s::regclass)", (table,))
+    return int(pg_cursor.fetchone()[0])
+
+
+def _move_batch_sql(table: str, archive: str, key: str,
+                    columns: Sequence[str], first: bool) -> sql.Composed:
+    after = sql.SQL("") if first else sql.SQL("{} > %(after)s AND ").format(
+        sql.Identifier(key))
+    column_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+    return sql.SQL(
+        "WITH batch AS ("
+        " SELECT {key} FROM {table}"
+        " WHERE {after}created_at < %(cutoff)s AND sent"
+        " ORDER BY {key} LIMIT %(limit)s"
+        " FOR UPDATE SKIP LOCKED"
+        "), moved AS ("
+        " DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM batch)"
+        " RETURNING *"
+        "), archived AS ("
+        " INSERT INTO {archive} ({columns}) SELECT {columns} FROM moved"
+        ") "
+        "SELECT count(*), coalesce(sum(pg_column_size(moved.*)), 0),"
+        " max({key}) FROM moved").format(
+            key=sql.Identifier(key), table=sql.Identifier(table),
+            after=after, archive=sql.Identifier(archive),
+            columns=column_list)
+
+
+def archive_rows(pg_config: Dict[str, Union[str, int, None]], table: str,
+                 cutoff: date, batch_size: int = RETENTION_BATCH,
+                 pause: float = RETENTION_PAUSE) -> RetentionResult:
+    """Move a table's sent rows created before cutoff into its archive.
+
+    Rows go in batches of batch_size paginated on the primary key, each
+    moved by one DELETE ... RETURNING feeding an INSERT and committed on
+    its own, so no lock is held for long and an interrupted run simply
+    resumes. The table is vacuumed afterwards, making the space reusable
+    and returning any free pages at its end to the operating system.
+    """
+    started = time.monotonic()
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        with pg_cnx.cursor() as pg_cursor:
+            archive = archive_table(pg_cursor, table)
+            columns = table_columns(pg_cursor, table)
+            key = keyset_column(pg_cursor, table)
+            size_before = table_size(pg_cursor, table)
+            pg_cnx.commit()
+
+            rows, row_bytes, after = 0, 0, None
+            while True:
+                pg_cursor.execute(
+                    _move_batch_sql(table, archive, key, columns,
+                                    after is None),
+                    {'after': after, 'cutoff': cutoff, 'limit': batch_size})
+                moved, moved_bytes, last = pg_cursor.fetchone()
+                pg_cnx.commit()
+                if not moved:
+                    break
+                rows, row_bytes, after = (rows + moved,
+                                          row_bytes + moved_bytes, last)
+                if pause:
+                    time.sleep(pause)
+
+            pg_cnx.autocommit = True
+            pg_cursor.execute(sql.SQL("VACUUM (ANALYZE) {}").format(
+                sql.Identifier(table)))
+            size_after = table_size(pg_cursor, table)
+    return RetentionResult(table, rows, int(row_bytes), size_before,
+                           size_after, time.monotonic() - started)
+
+
+def count_expired(pg_config: Dict[str, Union[str, int, None]], table: str,
+                  cutoff: date) -> RetentionResult:
+    """Count what archive_rows would move, without changing anything."""
+    started = time.monotonic()
+    with closing(psycopg2.connect(**pg_config)) as pg_cnx:
+        with pg_cnx.cursor() as pg_cursor:
+            pg_cursor.execute(sql.SQL(
+                "SELECT count(*), coalesce(sum(pg_column_size(t.*)), 0)"
+                " FROM {} t WHERE created_at < %s AND sent").format(
+                    sql.Identifier(table)), (cutoff,))
+            rows, row_bytes = pg_cursor.fetchone()
+            size = table_size(pg_cursor, table)
+    return RetentionResult(table, rows, int(row_bytes), size, size,
+                           time.monotonic() - started)
+
+
+def _mb(size: int) -> str:
+    return f"{size / 2**20:.1f} MB"
+
+
+def print_report(results: Sequence[RetentionResult], cutoff: date,
+                 dry_run: bool = False):
+    """Print the rows archived and space reclaimed per table."""
+    verb = "would archive" if dry_run else "archived"
+    print(f"Retention of sent rows created before {cutoff}:")
+    for result in results:
+        line = (f"  {result.table:<34} {verb} {result.rows:>9} rows "
+                f"({_mb(result.row_bytes)} of row data) "
+                f"in {result.seconds:.1f}s")
+        if not dry_run:
+            line += (f", size {_mb(result.size_before)} -> "
+                     f"{_mb(result.size_after)}")
+        print(line)
+    reclaimed = sum(result.size_before - result.size_after
+                    for result in results)
+    print(f"{sum(result.rows for result in results)} rows, "
+          f"{_mb(sum(result.row_bytes for result in results))} reusable"
+          + ("" if dry_run else f", {_mb(reclaimed)} returned to disk"))
+
+
+def parse_args(argv: Optional[Sequence[str]] = None) -> argparse.Namespace:
+    """Parse command line options for a retention run."""
+    parser = argparse.ArgumentParser(
+        prog='main.py retention',
+        description="Move old, already sent rows of the synced tables into "
+                    "archive tables.")
+    parser.add_argument(
+        '--days', type=int, default=RETENTION_DAYS,
+        help="archive rows created more than this many days ago "
+             "(default: %(default)s)")
+    parser.add_argument(
+        '--tables', nargs='+', choices=TABLES, default=TABLES,
+        help="tables to archive (default: all synced tables)")
+    parser.add_argument(
+        '--batch-size', type=int, default=RETENTION_BATCH,
+        help="rows moved per transaction (default: %(default)s)")
+    parser.add_argument(
+        '--pause', type=float, default=RETENTION_PAUSE,
+        help="seconds to sleep between batches (default: %(default)s)")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="only count the rows that would be archived")
+    args = parser.parse_args(argv)
+    if args.days < 1 or args.batch_size < 1:
+        parser.error("--days and --batch-size must be positive")
+    return args
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Run retention on the synced tables, returning the exit status."""
+    args = parse_args(argv)
+    cutoff = date.today() - timedelta(days=args.days)
+    # Every province loads into the same PostgreSQL database
+    _, pg_config = create_config(PROVINCES[0])
+    results = []
+    for table in args.tables:
+        try:
+            if args.dry_run:
+                results.append(count_expired(pg_config, table, cutoff))
+            else:
+                results.append(archive_rows(pg_config, table, cutoff,
+                                            args.batch_size, args.pause))
+        except Exception as e:
+            print(f"Retention of {table} failed: {e}")
+            return 1
+    print_report(results, cutoff, args.dry_run)
+    return 0
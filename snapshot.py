@@ -0,0 +1,169 @@
+import os
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Sequence, Tuple
+
+from checkpoint import CHECKPOINT_KEYS
+from mappings import ViewMapping
+from watermark import WATERMARK_COLUMNS, watermark_column
+
+
+# Prefix of the snapshot tables created next to the views on the source
+SNAPSHOT_PREFIX = 'sync_snapshot_'
+
+# Snapshots of views with a date column are refreshed by recomputing
+# only the rows dated from this many days ago onwards
+SNAPSHOT_LOOKBACK_DAYS = int(os.getenv('SYNC_SNAPSHOT_LOOKBACK_DAYS', 7))
+
+# Snapshots are rebuilt in full once they are this many days old, so
+# rows that dropped out of the view before the lookback go away too;
+# keep it no longer than the lookback, or rows changed between two
+# refreshes further apart than the lookback would be missed
+SNAPSHOT_FULL_REFRESH_DAYS = int(os.getenv('SYNC_SNAPSHOT_FULL_REFRESH_DAYS',
+                                           7))
+
+# Column types MySQL can only index by prefix, and the prefix used
+_PREFIXED_TYPES = ('text', 'tinytext', 'mediumtext', 'longtext', 'blob',
+                   'tinyblob', 'mediumblob', 'longblob')
+_INDEX_PREFIX = 191
+
+# Materializing at InnoDB's default REPEATABLE READ would take shared
+# next-key locks on every base table row the view reads, blocking the
+# source's writers until it is done; READ COMMITTED reads without them
+# (the source must log its binlog by ROW or MIXED for that)
+_READ_COMMITTED_SQL = "SET TRANSACTION ISOLATION LEVEL READ COMMITTED"
+
+
+def snapshot_table(view: str) -> str:
+    """Return the name of a view's snapshot table."""
+    return SNAPSHOT_PREFIX + view
+
+
+def snapshot_indexes(mapping: ViewMapping,
+                     names: Sequence[str]) -> List[Tuple[str, ...]]:
+    """Return the column lists a view's extraction filters or sorts on,
+    given the view's column names."""
+    indexes = []
+    if mapping.view in CHECKPOINT_KEYS:
+        indexes.append(tuple(column for column, _
+                             in CHECKPOINT_KEYS[mapping.view]))
+    if mapping.view in WATERMARK_COLUMNS:
+        indexes.append((watermark_column(mapping.view, names),))
+    if mapping.date_column:
+        indexes.append((mapping.date_column,))
+    return list(dict.fromkeys(indexes))
+
+
+def _created_at(mysql_cursor, table: str) -> Optional[datetime]:
+    """Return when a table in the current database was created, if it
+    exists."""
+    mysql_cursor.execute(
+        "SELECT create_time FROM information_schema.tables"
+        " WHERE table_schema = DATABASE() AND table_name = %s", (table,))
+    rows = mysql_cursor.fetchall()
+    if not rows:
+        return None
+    # A missing create_time still means the table exists
+    return rows[0][0] or datetime.min
+
+
+def _table_columns(mysql_cursor, table: str) -> List[Tuple[str, str]]:
+    """Return the names and data types of a table's columns, in order."""
+    mysql_cursor.execute(
+        "SELECT column_name, data_type FROM information_schema.columns"
+        " WHERE table_schema = DATABASE() AND table_name = %s"
+        " ORDER BY ordinal_position", (table,))
+    return [(name, data_type.lower())
+            for name, data_type in mysql_cursor.fetchall()]
+
+
+def _index_sql(columns: List[Tuple[str, str]],
+               indexes: List[Tuple[str, ...]]) -> str:
+    types = dict(columns)
+
+    def part(column: str) -> str:
+        if types.get(column) in _PREFIXED_TYPES:
+            return f'`{column}`({_INDEX_PREFIX})'
+        return f'`{column}`'
+    return ', '.join(f"ADD INDEX ({', '.join(map(part, columns))})"
+                     for columns in indexes)
+
+
+def rebuild_snapshot(mysql_cnx, mapping: ViewMapping):
+    """Recompute a view into a fresh, indexed snapshot table.
+
+    The new table is built aside, reading the view at READ COMMITTED,
+    and renamed over the old one in a single RENAME TABLE, so a
+    concurrent extraction never sees it missing or half-filled.
+    """
+    table = snapshot_table(mapping.view)
+    new, old = table + '_new', table + '_old'
+    with mysql_cnx.cursor() as mysql_cursor:
+        exists = _created_at(mysql_cursor, table) is not None
+        mysql_cursor.execute(f"DROP TABLE IF EXISTS `{new}`")
+        # The DROP committed, so this applies to the CREATE ... SELECT
+        mysql_cursor.execute(_READ_COMMITTED_SQL)
+        mysql_cursor.execute(
+            f"CREATE TABLE `{new}` AS SELECT * FROM {mapping.view}")
+        columns = _table_columns(mysql_cursor, new)
+        indexes = snapshot_indexes(mapping,
+                                   [name for name, _ in columns])
+        if indexes:
+            mysql_cursor.execute(f"ALTER TABLE `{new}` "
+                                 + _index_sql(columns, indexes))
+        if exists:
+            mysql_cursor.execute(f"DROP TABLE IF EXISTS `{old}`")
+            mysql_cursor.execute(
+                f"RENAME TABLE `{table}` TO `{old}`, `{new}` TO `{table}`")
+            mysql_cursor.execute(f"DROP TABLE `{old}`")
+        else:
+            mysql_cursor.execute(f"RENAME TABLE `{new}` TO `{table}`")
+
+
+def refresh_snapshot(mysql_cnx, mapping: ViewMapping, since: date):
+    """Recompute only the snapshot rows dated from `since` onwards.
+
+    Rows with no date are always recomputed. The rows are replaced in
+    one READ COMMITTED transaction, so extraction sees the old or the
+    new ones.
+    """
+    table = snapshot_table(mapping.view)
+    column = mapping.date_column
+    recent = f"`{column}` >= %s OR `{column}` IS NULL"
+    # SET TRANSACTION is refused while a transaction is open
+    mysql_cnx.commit()
+    with mysql_cnx.cursor() as mysql_cursor:
+        mysql_cursor.execute(_READ_COMMITTED_SQL)
+        mysql_cursor.execute(f"DELETE FROM `{table}` WHERE {recent}",
+                             (since,))
+        mysql_cursor.execute(f"INSERT INTO `{table}` "
+                             f"SELECT * FROM {mapping.view} WHERE {recent}",
+                             (since,))
+    mysql_cnx.commit()
+
+
+def materialize_view(mysql_cnx, mapping: ViewMapping,
+                     today: Optional[date] = None) -> str:
+    """Bring a view's snapshot table up to date on the source server.
+
+    Views with a date column are refreshed incrementally while their
+    snapshot is younger than SNAPSHOT_FULL_REFRESH_DAYS; other
+    views, missing or old snapshots, and failed incremental refreshes
+    (e.g. after the view's columns changed) are rebuilt in full.
+    Returns 'incremental' or 'full'.
+    """
+    today = today or date.today()
+    if mapping.date_column:
+        with mysql_cnx.cursor() as mysql_cursor:
+            created = _created_at(mysql_cursor, snapshot_table(mapping.view))
+        fresh = timedelta(days=SNAPSHOT_FULL_REFRESH_DAYS)
+        if created is not None and created.date() > today - fresh:
+            try:
+                refresh_snapshot(mysql_cnx, mapping, today - timedelta(
+                    days=SNAPSHOT_LOOKBACK_DAYS))
+                return 'incremental'
+            except Exception as e:
+                mysql_cnx.rollback()
+                print(f"Incremental refresh of {mapping.view} failed, "
+                      f"rebuilding: {e}")
+    rebuild_snapshot(mysql_cnx, mapping)
+    return 'full'
@@ -0,0 +1,78 @@
+import gzip
+import os
+import pickle
+from datetime import date
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+
+# Directory holding spooled view extracts, one subdirectory per run date
+DEFAULT_SPOOL_DIR = 'spool'
+
+# Bumped whenever the file layout changes
+SPOOL_VERSION = 1
+
+# gzip level trading CPU for size; the data is very repetitive text
+_COMPRESS_LEVEL = 5
+
+
+def spool_path(directory: str, province: str, view: str,
+               run_date: date) -> str:
+    """Return the spool file of a province's view on a run date."""
+    return os.path.join(directory, run_date.isoformat(),
+                        f'{province}-{view}.spool.gz')
+
+
+def spool_batches(path: str, header: Dict[str, Any],
+                  batches: Iterable[List[Tuple]]
+                  ) -> Iterator[List[Tuple]]:
+    """Pass row batches through unchanged while spooling them to a file.
+
+    The file is a gzip stream of pickles: the header, then each batch
+    stored column by column so similar values compress together, then
+    None. Pickle keeps the driver's types (datetime, Decimal, ...) as
+    they were read. The file only appears under its final name once
+    the stream has been consumed completely; an interrupted extraction
+    leaves no spool behind.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    partial = path + '.partial'
+    complete = False
+    try:
+        with gzip.open(partial, 'wb', compresslevel=_COMPRESS_LEVEL) as f:
+            pickle.dump(dict(header, version=SPOOL_VERSION), f,
+                        pickle.HIGHEST_PROTOCOL)
+            for batch in batches:
+                pickle.dump(tuple(zip(*batch)), f, pickle.HIGHEST_PROTOCOL)
+                yield batch
+            pickle.dump(None, f)
+        complete = True
+        os.replace(partial, path)
+    finally:
+        if not complete and os.path.exists(partial):
+            os.remove(partial)
+
+
+def read_spool_header(path: str) -> Dict[str, Any]:
+    """Read the header describing a spooled extract."""
+    with gzip.open(path, 'rb') as f:
+        header = pickle.load(f)
+    if header.get('version') != SPOOL_VERSION:
+        raise ValueError(f"{path} has spool version {header.get('version')}, "
+                         f"expected {SPOOL_VERSION}")
+    return header
+
+
+def read_spool(path: str) -> Iterator[List[Tuple]]:
+    """Yield the row batches of a spooled extract, as they were read.
+
+    Spool files are trusted local files written by spool_batches;
+    never read one from an untrusted source, since unpickling can run
+    arbitrary code.
+    """
+    with gzip.open(path, 'rb') as f:
+        pickle.load(f)
+        while True:
+            columns = pickle.load(f)
+            if columns is None:
+                return
+            yield list(zip(*columns))
@@ -0,0 +1,139 @@
+import os
+from datetime import timedelta
+from typing import (Any, Dict, Iterable, Iterator, List, Optional, Sequence,
+                    Tuple)
+
+from pipeline import close_iterator
+
+
+# PostgreSQL table holding the last extracted value per (province, view)
+WATERMARK_TABLE = 'sync_watermark'
+
+# Position, in each incremental view's SELECT * result, of the column
+# used as its high-watermark: the date of the visit that scheduled the
+# appointment, which only grows as visits are recorded. The scheduled
+# dates themselves lie in the future in no particular order, so a row
+# scheduled later for an earlier date would fall behind the watermark.
+# The column's name is read from the view's description.
+WATERMARK_COLUMNS = {
+    'marcados_levantamento': 2,
+    'marcados_seguimento': 2,
+}
+
+# Days before the watermark extracted again, so visits recorded a few
+# days late are still picked up; the overlap needs an upsert load
+WATERMARK_LOOKBACK_DAYS = int(os.getenv('SYNC_WATERMARK_LOOKBACK_DAYS', 7))
+
+
+CREATE_WATERMARK_SQL = f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        province VARCHAR(100) NOT NULL,
+        view_name VARCHAR(100) NOT NULL,
+        column_name VARCHAR(100) NOT NULL,
+        value TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT now(),
+        PRIMARY KEY (province, view_name)
+    )
+"""
+
+# A watermark stored for another column is ignored and replaced
+SELECT_WATERMARK_SQL = f"""
+    SELECT value FROM {WATERMARK_TABLE}
+    WHERE province = %s AND view_name = %s AND column_name = %s
+"""
+
+SELECT_WATERMARKS_SQL = f"""
+    SELECT column_name, value FROM {WATERMARK_TABLE}
+    WHERE province = %s AND view_name = %s
+"""
+
+UPSERT_WATERMARK_SQL = f"""
+    INSERT INTO {WATERMARK_TABLE} (province, view_name, column_name, value)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT (province, view_name) DO UPDATE
+    SET column_name = EXCLUDED.column_name,
+        value = CASE WHEN {WATERMARK_TABLE}.column_name = EXCLUDED.column_name
+                     THEN GREATEST({WATERMARK_TABLE}.value, EXCLUDED.value)
+                     ELSE EXCLUDED.value END,
+        updated_at = now()
+"""
+
+
+def ensure_watermark_table(pg_cursor):
+    """Create the watermark table if it does not exist yet."""
+    pg_cursor.execute(CREATE_WATERMARK_SQL)
+
+
+def watermark_column(view: str, names: Sequence[str]) -> str:
+    """Return the name of a view's watermark column, given its columns."""
+    return names[WATERMARK_COLUMNS[view]]
+
+
+def get_watermarks(pg_cursor, province: str, view: str) -> Dict[str, Any]:
+    """Return the stored high-watermark of a view by column name."""
+    pg_cursor.execute(SELECT_WATERMARKS_SQL, (province, view))
+    return dict(pg_cursor.fetchall())
+
+
+def set_watermark(pg_cursor, province: str, view: str, column: str,
+                  value: Any):
+    """Store the high-watermark for a view.
+
+    The update joins the caller's transaction, so it only becomes
+    visible once the loaded rows are committed.
+    """
+    pg_cursor.execute(UPSERT_WATERMARK_SQL, (province, view, column, value))
+
+
+def watermark_condition(column: str, since: Optional[Any]
+                        ) -> Tuple[str, Tuple]:
+    """Build the condition selecting rows newer than a watermark, less
+    the lookback.
+
+    Returns an empty condition before the first successful run.
+    """
+    if since is None:
+        return '', ()
+    return (f"`{column}` > %s",
+            (since - timedelta(days=WATERMARK_LOOKBACK_DAYS),))
+
+
+class HighWatermark:
+    """Running maximum of one column over a stream of rows."""
+
+    def __init__(self, view: str, column: str, index: Optional[int] = None):
+        self.view = view
+        self.column = column
+        self.index = WATERMARK_COLUMNS[view]
+        if index is not None:
+            # Position of the column in a projected query
+            self.index = index
+        self.value = None
+
+    def update(self, batch: List[Tuple]):
+        """Raise the maximum with the values of one row batch."""
+        index = self.index
+        values = [row[index] for row in batch if row[index] is not None]
+        if values:
+            value = max(values)
+            if self.value is None or value > self.value:
+                self.value = value
+
+    def observe(self, batches: Iterable[List[Tuple]]
+                ) -> Iterator[List[Tuple]]:
+        """Pass row batches through unchanged while tracking the maximum.
+
+        Closing the returned stream closes `batches` too.
+        """
+        try:
+            for batch in batches:
+                self.update(batch)
+                yield batch
+        finally:
+            close_iterator(batches)
+
+    def save(self, pg_cursor, province: str):
+        """Persist the maximum seen, if any rows were extracted."""
+        if self.value is not None:
+            set_watermark(pg_cursor, province, self.view, self.column,
+                          self.value)